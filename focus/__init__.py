@@ -1,10 +1,21 @@
+import carousel
+import color
+import equalization
+import fountain
+import framestore
 import link
+import live
 import mapping
 import modulation
 import multiprocreceiver
+import papr
 import phy
 import receiver
+import server
+import simpletxrx
 import spectrum
 import tests
+import tiling
 import transmitter
+import tune
 import video
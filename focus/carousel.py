@@ -0,0 +1,186 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Carousel transmission: loop over a payload, encoding every frame once.
+
+Frames are cached as PNG data, ready to be written to ffmpeg (see
+focus.video.render()), under the hash of their block of fragments. Frames
+are kept in memory up to a limit, and appended to a spill file beyond it.'''
+
+import hashlib
+import io
+import os
+import tempfile
+
+import numpy as np
+import PIL.Image
+
+
+def encode_png(frame):
+    buf = io.BytesIO()
+    PIL.Image.fromarray(frame).save(buf, format='png')
+    return buf.getvalue()
+
+
+class FrameCache(object):
+    '''Bounded cache of encoded frames (strings of PNG data), keyed by
+    content hash.
+
+    Holds up to `max_memory` bytes of frames in memory. Further frames are
+    appended to `spill_file` (a temporary file by default), unless `spill`
+    is False, in which case they are not cached.'''
+
+    def __init__(self, max_memory=256 << 20, spill=True, spill_file=None):
+        self.max_memory = max_memory
+        self.nbytes = 0
+        self.frames = dict()
+        # Keys of spilled frames -> (offset, length) in the spill file
+        self.spilled = dict()
+        self.spill = spill
+        self.remove_spill_file = spill_file is None
+        self.spill_file = spill_file
+        self.fout = None
+        self.fin = None
+        self.nhits = 0
+        self.nmisses = 0
+
+    @staticmethod
+    def key(fragments):
+        fragments = np.ascontiguousarray(fragments)
+        digest = hashlib.sha1(str(fragments.shape))
+        digest.update(fragments.data)
+        return digest.hexdigest()
+
+    def __contains__(self, key):
+        return key in self.frames or key in self.spilled
+
+    def get(self, key):
+        '''Return the frame cached under `key`, or None.'''
+        if key in self.frames:
+            self.nhits += 1
+            return self.frames[key]
+        if key in self.spilled:
+            # Make the frames appended since visible to the reader
+            self.fout.flush()
+            if self.fin is None:
+                self.fin = open(self.spill_file, 'rb')
+            offset, length = self.spilled[key]
+            self.fin.seek(offset)
+            self.nhits += 1
+            return self.fin.read(length)
+        self.nmisses += 1
+        return None
+
+    def put(self, key, frame):
+        if key in self:
+            return
+        if self.nbytes + len(frame) <= self.max_memory:
+            self.frames[key] = frame
+            self.nbytes += len(frame)
+        elif self.spill:
+            if self.fout is None:
+                if self.spill_file is None:
+                    fd, self.spill_file = tempfile.mkstemp(suffix='.png')
+                    os.close(fd)
+                self.fout = open(self.spill_file, 'wb')
+            self.spilled[key] = (self.fout.tell(), len(frame))
+            self.fout.write(frame)
+
+    def close(self):
+        if self.fin is not None:
+            self.fin.close()
+            self.fin = None
+        if self.fout is not None:
+            self.fout.close()
+            if self.remove_spill_file:
+                os.unlink(self.spill_file)
+            self.fout = None
+
+
+def carousel(transmitter, blocks, nloops=1, nframes=None, cache=None,
+             decorate=None):
+    '''Yield the PNG-encoded codes for `blocks` of fragments, looping over
+    them.
+
+    Stops after `nloops` passes over the blocks, or after `nframes` codes if
+    `nframes` is given. Each distinct frame is encoded only once, unless
+    `cache` (a FrameCache) is full and does not spill. `decorate(code,
+    idx)` may change the code of the idx-th block of a pass, e.g., to add a
+    frame number (see focus.video.add_frame_number()); codes are then only
+    reused at the same position in later passes.'''
+    if cache is None:
+        cache = FrameCache()
+    # Blocks are small compared to frames, so keep them all in case the
+    # cache does not hold their frames.
+    keys = list()
+    block_of = dict()
+    count = 0
+    loop = 0
+    while nframes is not None or loop < nloops:
+        source = blocks if loop == 0 else keys
+        for idx, item in enumerate(source):
+            if loop == 0:
+                key = cache.key(item)
+                if decorate is not None:
+                    key = '{}-{}'.format(key, idx)
+                keys.append(key)
+                block_of.setdefault(key, item)
+            else:
+                key = item
+            frame = cache.get(key)
+            if frame is None:
+                # Transmitter.encode() masks the fragments in-place
+                code = transmitter.encode(block_of[key].copy())
+                if decorate is not None:
+                    code = decorate(code, idx)
+                frame = encode_png(code)
+                cache.put(key, frame)
+            yield frame
+            count += 1
+            if nframes is not None and count >= nframes:
+                return
+        if len(keys) == 0:
+            return
+        loop += 1
+
+
+class _CountingTransmitter(object):
+    def __init__(self, transmitter):
+        self.transmitter = transmitter
+        self.nencoded = 0
+
+    def encode(self, data):
+        self.nencoded += 1
+        return self.transmitter.encode(data)
+
+
+def test_carousel(nsubchannels=2, shape=(128, 128)):
+    import focus.transmitter
+    transmitter = focus.transmitter.Transmitter(nsubchannels, shape=shape)
+    blocks = [np.random.randint(0, 256, (nsubchannels, 64)).astype(np.uint8)
+              for _ in xrange(3)]
+    blocks.append(blocks[0].copy())
+    expected = [transmitter.encode(b.copy()) for b in blocks]
+    frame_nbytes = max(len(encode_png(e)) for e in expected)
+
+    def decorate(code, idx):
+        return code + idx
+
+    # Without decoration, blocks 0 and 3 share a frame
+    for func, nencoded in ((None, 3), (decorate, 4)):
+        counting = _CountingTransmitter(transmitter)
+        # Room for one frame in memory, the others are spilled
+        cache = FrameCache(max_memory=frame_nbytes)
+        frames = list(carousel(counting, iter(blocks), nframes=10,
+                               cache=cache, decorate=func))
+        cache.close()
+        frames = [np.array(PIL.Image.open(io.BytesIO(f))) for f in frames]
+        offsets = range(4) if func is not None else [0] * 4
+        if len(frames) != 10 or counting.nencoded != nencoded or \
+           cache.nmisses != nencoded or len(cache.spilled) == 0 or \
+           not all(np.all(f == expected[i % 4] + offsets[i % 4])
+                   for i, f in enumerate(frames)):
+            raise RuntimeError('test_carousel: Unexpected frames or number of '
+                               'encoded frames.')
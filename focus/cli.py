@@ -47,17 +47,29 @@ def build_group(name, *commands):
 
 def main():
     benchmark = build_group('benchmark',
+                            build_command('extraction',
+                                          focus.receiver.benchmark_extraction),
                             build_command('fft', focus.fft.benchmark),
+                            build_command('pilots',
+                                          focus.equalization.benchmark),
                             build_command('multiprocreceiver',
                                           focus.multiprocreceiver.benchmark),
-                            build_command('receiver', focus.receiver.benchmark))
+                            build_command('papr', focus.papr.benchmark),
+                            build_command('parity', focus.link.benchmark),
+                            build_command('receiver', focus.receiver.benchmark),
+                            build_command('server', focus.server.benchmark))
 
     build_group('main',
                 benchmark,
                 build_command('test', focus.tests.run_tests),
+                focus.framestore.dump,
+                focus.live.rx,
                 focus.receiver.main,
+                focus.server.main,
                 focus.simpletxrx.tx,
                 focus.simpletxrx.rx,
+                focus.simpletxrx.batchrx,
+                focus.tune.main,
                 focus.video.rx,
                 focus.video.tx,
                 focus.video.multirate,
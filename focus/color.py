@@ -0,0 +1,140 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Three independent codes in the red, green and blue planes of one frame.
+
+The codes share their markers. Plane p (0 for red) carries subchannels
+p*nsubchannels, ..., so a color transmitter and receiver can be used in
+place of a Transmitter and Receiver with 3*nsubchannels subchannels.
+
+Cameras and displays leak some intensity from one color into the others.
+The receiver can undo this with a cross-talk matrix M, where M[i, j] is the
+fraction of displayed plane j that is captured in plane i (RGB order).'''
+
+import json
+
+import numpy as np
+
+import focus
+
+NPLANES = 3
+
+
+def parse_crosstalk(crosstalk):
+    '''Return a 3x3 cross-talk matrix from a nested list or its JSON.'''
+    if isinstance(crosstalk, basestring):
+        crosstalk = json.loads(crosstalk)
+    crosstalk = np.array(crosstalk, dtype=np.float32)
+    if crosstalk.shape != (NPLANES, NPLANES):
+        raise ValueError('Cross-talk matrix must be 3x3.')
+    return crosstalk
+
+
+class ColorTransmitter(object):
+    '''Encodes blocks of fragments into RGB frames of three codes.'''
+
+    def __init__(self, nsubchannels, **kwargs):
+        self.transmitter = focus.transmitter.Transmitter(nsubchannels,
+                                                         **kwargs)
+        self.nsubchannels = NPLANES * nsubchannels
+        self.fragment_size = self.transmitter.fragment_size
+
+    def encode(self, data):
+        # The markers are the same in every plane, so they are black
+        return np.dstack([self.transmitter.encode(plane)
+                          for plane in data.reshape((NPLANES, -1))])
+
+
+class ColorReceiver(object):
+    '''Decodes frames of three codes.
+
+    Frames are BGR, as from OpenCV and focus.video.video_frame_src(), unless
+    `bgr` is False. The code is located and extracted once for all planes.
+    `crosstalk` is an optional cross-talk matrix.'''
+
+    def __init__(self, nsubchannels, crosstalk=None, bgr=True, **kwargs):
+        # One receiver per plane, since each keeps its own history
+        self.receivers = [focus.receiver.Receiver(nsubchannels, **kwargs)
+                          for _ in xrange(NPLANES)]
+        self.nsubchannels = NPLANES * nsubchannels
+        self.fragment_size = self.receivers[0].fragment_size
+        self.unmix = None
+        if crosstalk is not None:
+            self.unmix = np.linalg.inv(parse_crosstalk(crosstalk)).T
+        self.bgr = bgr
+
+    def extract(self, frame, copy_frame=True):
+        '''Return the (code, corners) of `frame`, where the code has an RGB
+        plane for each code (see Receiver.extract()).'''
+        if frame.ndim != 3:
+            raise ValueError('Expected a color frame, got {}.'.format(
+                frame.shape))
+        code, corners = self.receivers[0].extract(frame, copy_frame,
+                                                  grayscale=False)
+        if self.bgr:
+            code = code[:, :, ::-1]
+        if self.unmix is not None:
+            code = np.dot(code.reshape((-1, NPLANES)), self.unmix).reshape(
+                code.shape)
+        return code, corners
+
+    def extract_many(self, frames, copy_frame=True):
+        '''Extract the codes of a batch of frames (see
+        Receiver.extract_many()).'''
+        extracted = list()
+        for frame in frames:
+            try:
+                extracted.append(self.extract(frame, copy_frame))
+            except ValueError as ve:
+                extracted.append((None, str(ve)))
+        return extracted
+
+    def decode_extracted(self, extracted, debug=False):
+        '''Decode the output of extract_many().'''
+        per_plane = [receiver.decode_extracted(
+            [(code if code is None else code[:, :, p], corners)
+             for code, corners in extracted], debug)
+            for p, receiver in enumerate(self.receivers)]
+        return tuple(self.merge(planes, debug) for planes in zip(*per_plane))
+
+    def decode_many(self, frames, debug=False, copy_frame=True):
+        return self.decode_extracted(self.extract_many(frames, copy_frame),
+                                     debug)
+
+    def decode(self, frame, debug=False, copy_frame=True):
+        return self.decode_many([frame], debug, copy_frame)[0]
+
+    def merge(self, planes, debug=False):
+        '''Combine the DecodeResults of the planes of one frame.'''
+        nsubchannels = self.nsubchannels // NPLANES
+        data = np.zeros((self.nsubchannels, self.fragment_size),
+                        dtype=np.uint8)
+        nerrors = np.empty(self.nsubchannels, dtype=np.int)
+        nerrors.fill(-1)
+        for p, plane in enumerate(planes):
+            n = len(plane.valid)
+            data[p*nsubchannels:p*nsubchannels+n] = plane.data
+            nerrors[p*nsubchannels:p*nsubchannels+n] = plane.nerrors
+        result = focus.receiver.DecodeResult(data, nerrors)
+        if debug:
+            result.update(planes[0].info)
+            result['planes'] = [plane.info for plane in planes]
+        return result
+
+
+def test_color_tx_rx(nsubchannels=4, shape=(256, 256)):
+    transmitter = ColorTransmitter(nsubchannels, shape=shape)
+    data = np.random.randint(0, 256, (transmitter.nsubchannels, 64))
+    data = data.astype(np.uint8)
+    frame = transmitter.encode(data.copy())
+    # Leak some of each plane into the others, and capture as BGR
+    crosstalk = np.array([[.8, .15, .05], [.1, .8, .1], [.05, .15, .8]])
+    captured = np.dot(frame.reshape((-1, 3)), crosstalk.T).reshape(
+        frame.shape)[:, :, ::-1].astype(np.uint8)
+    receiver = ColorReceiver(nsubchannels, crosstalk.tolist(), shape=shape)
+    result = receiver.decode(captured, debug=True)
+    if result['status'] != 'found' or not np.all(result.valid) or \
+       not np.all(result.data == data):
+        raise RuntimeError('test_color_tx_rx: Fragments do not match.')
@@ -0,0 +1,157 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Pilot-based phase equalization of received spectra.
+
+A small misalignment of the extracted code shifts the code, which shows up as
+a phase ramp across the spectrum: the phase of element (v, u) is rotated by
+a + bv*v + bu*u, where v and u are (signed) frequencies. Known pilot symbols
+allow to estimate a, bv and bu by least squares.'''
+
+import numpy as np
+
+import focus.spectrum
+
+
+def pilot_symbols(npilots):
+    '''Returns the known QPSK symbols that are sent on the pilots.'''
+    rand = np.random.RandomState(seed=52018)
+    phases = rand.randint(0, 4, npilots) * np.pi/2 + np.pi/4
+    return np.exp(1j*phases)
+
+
+def frequencies(height, width):
+    '''Returns the signed frequencies of the elements of a cropped spectrum.
+
+    `height` and `width` are the bounding box that was used for cropping (see
+    focus.spectrum.get_bbox() and focus.spectrum.crop()).'''
+    v = np.arange(2*height)
+    v[height:] -= 2*height
+    return np.meshgrid(v, np.arange(width), indexing='ij')
+
+
+class PilotEqualizer(object):
+    def __init__(self, pilot_idx, idxs, bbox):
+        '''`pilot_idx` and `idxs` must be cropped to `bbox`.'''
+        self.pilot_idx = pilot_idx
+        self.pilots = pilot_symbols(pilot_idx.sum())
+        v, u = frequencies(*bbox)
+        # Frequencies of the symbols in each subchannel, in the order in
+        # which focus.spectrum.unload() returns them
+        self.v = np.array([v[idx] for idx in idxs])
+        self.u = np.array([u[idx] for idx in idxs])
+
+        # Least squares fits of a + bv*v + bu*u. The first pass only uses
+        # the inner half of the pilots, where the ramp is unlikely to wrap
+        # around; the second pass refines the fit with all pilots.
+        pilot_v, pilot_u = v[pilot_idx], u[pilot_idx]
+        design = np.vstack((np.ones(len(pilot_v)), pilot_v, pilot_u)).T
+        radius = pilot_v**2 + pilot_u**2
+        self.inner = radius <= np.median(radius)
+        self.pinv_inner = np.linalg.pinv(design[self.inner])
+        self.pinv = np.linalg.pinv(design)
+        self.design = design
+
+    def estimate(self, spectrum):
+        '''Returns the phase offset and slopes (a, bv, bu) of `spectrum`.'''
+        rx_pilots = focus.spectrum.unload_subchannel(spectrum.copy(),
+                                                     self.pilot_idx)
+        rotation = rx_pilots * np.conj(self.pilots)
+        # Initial estimate of the phase offset: circular mean
+        params = np.array([np.angle(np.sum(rotation)), 0., 0.])
+        for pinv, sel in ((self.pinv_inner, self.inner), (self.pinv, None)):
+            residual = rotation * np.exp(-1j*self.design.dot(params))
+            residual = np.angle(residual if sel is None else residual[sel])
+            params += pinv.dot(residual)
+        return params
+
+    def equalize(self, spectrum, symbols, channel_idxs=None, params=None):
+        '''Remove the estimated phase ramp from the unloaded `symbols`.
+
+        `symbols` holds the subchannels in `channel_idxs` (default: all).
+        `params` may hold a previous estimate for `spectrum`.'''
+        if params is None:
+            params = self.estimate(spectrum)
+        v, u = self.v, self.u
+        if channel_idxs is not None:
+            v, u = v[channel_idxs], u[channel_idxs]
+        return self.correct(symbols, v, u, params)
+
+    @staticmethod
+    def correct(symbols, v, u, params):
+        '''Remove the phase ramp `params` from symbols at frequencies v, u.'''
+        a, bv, bu = params
+        return symbols * np.exp(-1j*(a + bv*v + bu*u))
+
+
+def test_equalize(nsubchannels=4, npilots=32, shape=(512, 512)):
+    idxs, pilot_idx, _ = focus.spectrum.layout(nsubchannels, 320, shape,
+                                               npilots)
+    rand = np.random.RandomState(seed=1)
+    symbols = np.exp(1j*(rand.randint(0, 4, (nsubchannels, 320)) *
+                         np.pi/2 + np.pi/4))
+    spectrum = focus.spectrum.construct(symbols, shape, idxs)
+    focus.spectrum.load_subchannel(spectrum, pilot_idx, pilot_symbols(npilots))
+    # Crop like the receiver does
+    bbox = focus.spectrum.get_bbox(np.vstack((idxs, pilot_idx[np.newaxis])))
+    spectrum = focus.spectrum.crop(spectrum, *bbox)
+    idxs = np.array([focus.spectrum.crop(i, *bbox) for i in idxs])
+    pilot_idx = focus.spectrum.crop(pilot_idx, *bbox)
+    # Apply a phase ramp and some noise
+    v, u = frequencies(*bbox)
+    spectrum *= np.exp(1j*(2.5 + 0.04*v - 0.03*u))
+    spectrum += 0.1 * (rand.randn(*spectrum.shape) +
+                       1j*rand.randn(*spectrum.shape))
+
+    equalizer = PilotEqualizer(pilot_idx, idxs, bbox)
+    rx_symbols = np.array(focus.spectrum.unload(spectrum, idxs))
+    rx_symbols = equalizer.equalize(spectrum, rx_symbols)
+    if np.max(np.abs(focus.util.phase_diff(rx_symbols, symbols))) > np.pi/4:
+        raise RuntimeError('test_equalize: Failed to remove phase ramp.')
+
+
+def benchmark(nsubchannels=16, npilots=(0, 16, 32, 64, 128), nframes=10,
+              shape=(512, 512), blur=1.5, noise=4., shift=0.75):
+    '''Compare error rates for different numbers of pilots.
+
+    Simulates residual misalignment by shifting extracted codes by up to
+    `shift` pixels.'''
+    import cv2
+    import focus.tune
+
+    rand = np.random.RandomState(seed=1)
+    shifts = rand.uniform(-shift, shift, (nframes, 2))
+    nelements = nsubchannels*(64+16)*4
+    print '{:>7} {:>9} {:>11} {:>10}'.format('pilots', 'overhead',
+                                             'byte errors', 'fragments')
+    for n in npilots:
+        transmitter = focus.transmitter.Transmitter(nsubchannels, shape=shape,
+                                                    npilots=n)
+        receiver = focus.receiver.Receiver(nsubchannels, shape=shape,
+                                           npilots=n, use_hints=False)
+        nerrors = nfragments = 0
+        for i in xrange(nframes):
+            data = rand.randint(0, 256, nsubchannels*64).astype(np.uint8)
+            debug_info = dict()
+            frame = transmitter.encode(data, debug_info=debug_info)
+            frame = np.pad(frame, frame.shape[0]/8, 'constant',
+                           constant_values=255)
+            frame = focus.tune.impair(frame, blur, noise)
+            try:
+                code, _ = receiver.extract(frame)
+            except ValueError:
+                continue
+            move = np.array([[1, 0, shifts[i, 0]], [0, 1, shifts[i, 1]]])
+            code = cv2.warpAffine(code, move, code.shape[::-1],
+                                  flags=cv2.INTER_LINEAR,
+                                  borderMode=cv2.BORDER_WRAP)
+            result = receiver.decode_code(code, debug=True)
+            nerrors += np.sum(result['coded_fragments'] !=
+                              debug_info['coded_fragments'])
+            nfragments += sum(f is not None for f in result['fragments'])
+        print '{:>7} {:>8.1f}% {:>10.2f}% {:>9.1f}%'.format(
+            n, 100. * n / (nelements + n),
+            100. * nerrors / (nframes * nsubchannels * (64+16)),
+            100. * nfragments / (nframes * nsubchannels))
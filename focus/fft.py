@@ -7,6 +7,7 @@ import cPickle as pickle
 import os
 import subprocess
 import sys
+import threading
 
 import numpy as np
 import pyfftw
@@ -64,17 +65,72 @@ class FFT(object):
                         protocol=pickle.HIGHEST_PROTOCOL)
 
 
-_fft_cache = dict()
+class CroppedFFT(FFT):
+    '''Real 2D FFT that only computes the low frequencies.
+
+    Computes the real FFT of each row, but the FFT of only the first `width`
+    columns. The result matches focus.spectrum.crop() of the full FFT.'''
+
+    def __init__(self, shape, width):
+        have_wisdom = self.load_wisdom()
+
+        self.width = width
+        self.floatbuf = pyfftw.n_byte_align_empty(shape, pyfftw.simd_alignment,
+                                                  dtype=np.float32)
+        self._rfft = pyfftw.builders.rfft(self.floatbuf, axis=1,
+                                          planner_effort='FFTW_MEASURE')
+        self.complexbuf = pyfftw.n_byte_align_empty((shape[0], width),
+                                                    pyfftw.simd_alignment,
+                                                    dtype=np.complex64)
+        self._fft = pyfftw.builders.fft(self.complexbuf, axis=0,
+                                        planner_effort='FFTW_MEASURE')
+        if not have_wisdom:
+            self.save_wisdom()
+
+    def rfft2(self, data, height):
+        self.floatbuf[:] = data
+        self.complexbuf[:] = self._rfft(self.floatbuf)[:, :self.width]
+        spectrum = self._fft(self.complexbuf)
+        return np.vstack((spectrum[:height], spectrum[-height:]))
+
+
+# FFTs reuse their buffers, so each thread has its own (see focus.tiling).
+_local = threading.local()
 _use_numpy = False
 
 
+def _cache(name):
+    try:
+        return getattr(_local, name)
+    except AttributeError:
+        setattr(_local, name, dict())
+        return getattr(_local, name)
+
+
 def get_cached(shape):
-    global _fft_cache
+    cache = _cache('fft')
     try:
-        return _fft_cache[shape]
+        return cache[shape]
     except KeyError:
-        _fft_cache[shape] = FFT(shape)
-        return _fft_cache[shape]
+        cache[shape] = FFT(shape)
+        return cache[shape]
+
+
+def get_cached_cropped(shape, width):
+    cache = _cache('cropped_fft')
+    try:
+        return cache[shape, width]
+    except KeyError:
+        cache[shape, width] = CroppedFFT(shape, width)
+        return cache[shape, width]
+
+
+def rfft2_crop(frame, height, width):
+    '''Compute focus.spectrum.crop(rfft2(frame), height, width).'''
+    if _use_numpy:
+        spectrum = np.fft.fft(np.fft.rfft(frame, axis=1)[:, :width], axis=0)
+        return np.vstack((spectrum[:height], spectrum[-height:]))
+    return get_cached_cropped(frame.shape, width).rfft2(frame, height)
 
 
 def rfft2(frame):
@@ -105,6 +161,19 @@ def test_rfft2(n=10):
             raise RuntimeError('test_rfft2: Inconsistent results')
 
 
+def test_rfft2_crop(n=3, height=40, width=60):
+    data = np.random.randint(0, 256, (n, 512, 512)).astype(np.uint8)
+    for d in data:
+        spectrum = rfft2_crop(d, height, width)
+        np_spectrum = np.fft.rfft2(d)
+        np_spectrum = np.vstack((np_spectrum[:height, :width],
+                                 np_spectrum[-height:, :width]))
+        rel_error = np.max(np.abs(spectrum - np_spectrum)) / \
+            np.max(np.abs(np_spectrum))
+        if rel_error > 1e-5:
+            raise RuntimeError('test_rfft2_crop: Inconsistent results')
+
+
 def test_irfft2(n=10):
     def normalize(data):
         data -= data.min()
@@ -0,0 +1,224 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Systematic LT code for transfers over screen/camera links.
+
+An object is split into K source symbols of 60 bytes. Symbols 0..K-1 are the
+source symbols themselves; every further symbol is the XOR of a pseudo-random
+set of source symbols. Their degrees follow the robust soliton distribution,
+but are at least about 4 ln(K): since the receiver already has most source
+symbols, low-degree repair symbols rarely cover the missing ones.
+Each symbol is sent in a 64-byte fragment that starts with a header holding
+the symbol id and K. The object length is stored in the first four bytes of
+the source block, so the receiver needs no out-of-band information.'''
+
+import struct
+
+import numpy as np
+
+SYMBOL_SIZE = 60
+# symbol id, number of source symbols
+_HEADER = struct.Struct('!HH')
+_LENGTH = struct.Struct('!I')
+MAX_SYMBOLS = 1 << 16
+
+_CDFS = dict()
+
+
+def _degree_cdf(nsource, c=0.1, delta=0.5):
+    '''Cumulative robust soliton distribution for `nsource` source symbols.'''
+    if nsource not in _CDFS:
+        d = np.arange(1, nsource+1, dtype=np.float64)
+        rho = np.empty(nsource)
+        rho[0] = 1. / nsource
+        rho[1:] = 1. / (d[1:] * (d[1:]-1))
+        r = max(1., c * np.log(nsource/delta) * np.sqrt(nsource))
+        pivot = min(nsource, max(1, int(round(nsource / r))))
+        tau = np.zeros(nsource)
+        tau[:pivot-1] = r / (d[:pivot-1] * nsource)
+        tau[pivot-1] = r * np.log(r/delta) / nsource
+        mu = rho + np.maximum(tau, 0)
+        _CDFS[nsource] = np.cumsum(mu) / mu.sum()
+    return _CDFS[nsource]
+
+
+def neighbours(symbol_id, nsource):
+    '''Return the indices of the source symbols that make up a symbol.'''
+    if symbol_id < nsource:
+        return np.array([symbol_id])
+    rand = np.random.RandomState(seed=symbol_id)
+    degree = np.searchsorted(_degree_cdf(nsource), rand.random_sample()) + 1
+    degree = max(degree, int(np.ceil(4*np.log(nsource+1))))
+    return rand.permutation(nsource)[:min(degree, nsource)]
+
+
+class Encoder(object):
+    def __init__(self, data):
+        data = _LENGTH.pack(len(data)) + data
+        self.nsource = -(-len(data) // SYMBOL_SIZE)
+        if self.nsource >= MAX_SYMBOLS:
+            raise ValueError('Object is too large for fountain coding.')
+        source = np.zeros(self.nsource*SYMBOL_SIZE, dtype=np.uint8)
+        source[:len(data)] = np.frombuffer(data, dtype=np.uint8)
+        self.source = source.reshape((self.nsource, SYMBOL_SIZE))
+
+    def symbol(self, symbol_id):
+        return np.bitwise_xor.reduce(
+            self.source[neighbours(symbol_id, self.nsource)], axis=0)
+
+    def fragments(self, nrepair):
+        '''Return the source and `nrepair` repair symbols as fragments.'''
+        nsymbols = min(self.nsource + nrepair, MAX_SYMBOLS)
+        fragments = np.zeros((nsymbols, _HEADER.size+SYMBOL_SIZE),
+                             dtype=np.uint8)
+        fragments[:self.nsource, _HEADER.size:] = self.source
+        for symbol_id in xrange(nsymbols):
+            header = _HEADER.pack(symbol_id, self.nsource)
+            fragments[symbol_id, :_HEADER.size] = bytearray(header)
+            if symbol_id >= self.nsource:
+                fragments[symbol_id, _HEADER.size:] = self.symbol(symbol_id)
+        return fragments
+
+
+class Decoder(object):
+    '''Incremental peeling decoder with Gaussian elimination fallback.'''
+
+    def __init__(self):
+        self.nsource = None
+        self.seen = set()
+        self.nduplicates = 0
+        self.complete = False
+
+    def _init(self, nsource):
+        self.nsource = nsource
+        self.source = np.zeros((nsource, SYMBOL_SIZE), dtype=np.uint8)
+        self.known = np.zeros(nsource, dtype=np.bool)
+        self.nknown = 0
+        # Equations that still have more than one unknown source symbol:
+        # id -> (set of unknown source symbols, data)
+        self.equations = dict()
+        # Source symbol -> ids of equations in which it is unknown
+        self.waiting = dict()
+        self.next_equation_id = 0
+        self.last_elimination = 0
+
+    def add_fragment(self, fragment):
+        '''Add a received fragment. Returns True once decoding is complete.'''
+        symbol_id, nsource = _HEADER.unpack(fragment[:_HEADER.size].tostring())
+        if self.nsource is None:
+            self._init(nsource)
+        if self.complete or nsource != self.nsource or \
+           symbol_id >= MAX_SYMBOLS:
+            return self.complete
+        if symbol_id in self.seen:
+            self.nduplicates += 1
+            return self.complete
+        self.seen.add(symbol_id)
+        self.add_symbol(neighbours(symbol_id, nsource),
+                        fragment[_HEADER.size:].copy())
+        return self.complete
+
+    def add_symbol(self, nbrs, data):
+        known = self.known[nbrs]
+        if known.any():
+            data ^= np.bitwise_xor.reduce(self.source[nbrs[known]], axis=0)
+        unknown = set(nbrs[~known])
+        if len(unknown) == 1:
+            self._resolve(unknown.pop(), data)
+        elif len(unknown) > 1:
+            eq_id = self.next_equation_id
+            self.next_equation_id += 1
+            self.equations[eq_id] = (unknown, data)
+            for idx in unknown:
+                self.waiting.setdefault(idx, set()).add(eq_id)
+
+        if self.nknown == self.nsource:
+            self.complete = True
+        else:
+            # Elimination is expensive, so try it only once there are a few
+            # more equations than unknowns, and retry only after receiving a
+            # number of additional symbols since the last failed attempt.
+            nunknown = self.nsource - self.nknown
+            if len(self.equations) >= nunknown + nunknown/32 and \
+               len(self.seen) >= self.last_elimination + max(1, nunknown/8):
+                self.last_elimination = len(self.seen)
+                self._eliminate()
+
+    def _resolve(self, idx, data):
+        '''Peel: learn a source symbol and substitute it everywhere.'''
+        stack = [(idx, data)]
+        while stack:
+            idx, data = stack.pop()
+            if self.known[idx]:
+                continue
+            self.source[idx] = data
+            self.known[idx] = True
+            self.nknown += 1
+            for eq_id in self.waiting.pop(idx, ()):
+                unknown, eq_data = self.equations[eq_id]
+                unknown.discard(idx)
+                eq_data ^= data
+                if len(unknown) <= 1:
+                    del self.equations[eq_id]
+                if len(unknown) == 1:
+                    other = unknown.pop()
+                    self.waiting[other].discard(eq_id)
+                    stack.append((other, eq_data))
+
+    def _eliminate(self):
+        '''Solve the remaining equations by Gaussian elimination over GF(2).
+
+        The coefficients are bit-packed, so each row operation XORs the
+        coefficients of eight unknowns at once.'''
+        unknown_idxs = np.flatnonzero(~self.known)
+        column = {idx: col for col, idx in enumerate(unknown_idxs)}
+        neqs, nunknown = len(self.equations), len(unknown_idxs)
+        a = np.zeros((neqs, nunknown), dtype=np.bool)
+        b = np.zeros((neqs, SYMBOL_SIZE), dtype=np.uint8)
+        for row, (unknown, data) in enumerate(self.equations.itervalues()):
+            a[row, [column[idx] for idx in unknown]] = True
+            b[row] = data
+        a = np.packbits(a, axis=1)
+
+        for col in xrange(nunknown):
+            byte, bit = col >> 3, 7 - (col & 7)
+            rows = (a[:, byte] >> bit) & 1 == 1
+            candidates = np.flatnonzero(rows[col:])
+            if len(candidates) == 0:
+                return      # Not (yet) solvable
+            pivot = col + candidates[0]
+            if pivot != col:
+                a[[col, pivot]] = a[[pivot, col]]
+                b[[col, pivot]] = b[[pivot, col]]
+                rows[[col, pivot]] = rows[[pivot, col]]
+            rows[col] = False
+            a[rows] ^= a[col]
+            b[rows] ^= b[col]
+
+        self.source[unknown_idxs] = b[:nunknown]
+        self.known[:] = True
+        self.nknown = self.nsource
+        self.equations.clear()
+        self.waiting.clear()
+        self.complete = True
+
+    def data(self):
+        data = self.source.tostring()
+        length, = _LENGTH.unpack(data[:_LENGTH.size])
+        return data[_LENGTH.size:_LENGTH.size+length]
+
+
+def test_encode_decode(size=5000, overhead=1., loss=0.1):
+    rand = np.random.RandomState(seed=1)
+    data = rand.randint(0, 256, size).astype(np.uint8).tostring()
+    encoder = Encoder(data)
+    fragments = encoder.fragments(int(encoder.nsource*overhead))
+    received = fragments[rand.random_sample(len(fragments)) >= loss]
+    decoder = Decoder()
+    for fragment in received[rand.permutation(len(received))]:
+        if decoder.add_fragment(fragment):
+            break
+    if not decoder.complete or decoder.data() != data:
+        raise RuntimeError('test_encode_decode: Decoding failed.')
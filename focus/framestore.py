@@ -0,0 +1,151 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Memory-mapped storage for sequences of uint8 frames.
+
+A frame store file consists of a fixed-size header followed by the raw
+frames, all of the same shape. Since the number of frames is derived from the
+file size, frames can be appended to a store incrementally.'''
+
+import os
+import struct
+
+import click
+import numpy as np
+
+import focus.util
+import focus.video
+
+_MAGIC = 'FOCUSFRM'
+_VERSION = 1
+# magic, version, height, width, channels (0 for grayscale frames)
+_HEADER = struct.Struct('<8sIIII')
+HEADER_SIZE = 32
+
+
+class FrameStore(object):
+    '''Read-only sequence of frames backed by a memory-mapped file.
+
+    Indexing and slicing return views into the file; frames are only read
+    from disk once they are accessed. Also opens `.npy` stacks of frames.'''
+
+    def __init__(self, fname):
+        if fname.endswith('.npy'):
+            frames = np.load(fname, mmap_mode='r')
+            if frames.dtype != np.uint8 or frames.ndim not in (3, 4):
+                raise ValueError('{} is not a stack of uint8 '
+                                 'frames.'.format(fname))
+        else:
+            with open(fname, 'rb') as fin:
+                header = fin.read(HEADER_SIZE)
+            if len(header) != HEADER_SIZE:
+                raise ValueError('{} is not a frame store.'.format(fname))
+            magic, version, height, width, channels = \
+                _HEADER.unpack(header[:_HEADER.size])
+            if magic != _MAGIC:
+                raise ValueError('{} is not a frame store.'.format(fname))
+            if version != _VERSION:
+                raise ValueError('Unsupported frame store version '
+                                 '{}.'.format(version))
+            shape = (height, width) if channels == 0 else \
+                (height, width, channels)
+            nframes = (os.path.getsize(fname) - HEADER_SIZE) / \
+                int(np.prod(shape))
+            if nframes == 0:
+                frames = np.zeros((0, ) + shape, dtype=np.uint8)
+            else:
+                frames = np.memmap(fname, dtype=np.uint8, mode='r',
+                                   offset=HEADER_SIZE,
+                                   shape=(nframes, ) + shape)
+        # Plain ndarray views pickle like ordinary frames.
+        self.frames = np.asarray(frames)
+
+    @property
+    def frame_shape(self):
+        return self.frames.shape[1:]
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, idx):
+        return self.frames[idx]
+
+    def __iter__(self):
+        return iter(self.frames)
+
+
+class FrameStoreWriter(object):
+    '''Appends frames of a fixed shape to a frame store file.'''
+
+    def __init__(self, fname, frame_shape):
+        if len(frame_shape) not in (2, 3):
+            raise ValueError('Unexpected frame shape {}.'.format(frame_shape))
+        self.frame_shape = tuple(frame_shape)
+        self.nframes = 0
+        channels = frame_shape[2] if len(frame_shape) == 3 else 0
+        self.fout = open(fname, 'wb')
+        header = _HEADER.pack(_MAGIC, _VERSION, frame_shape[0], frame_shape[1],
+                              channels)
+        self.fout.write(header.ljust(HEADER_SIZE, '\0'))
+
+    def append(self, frame):
+        if frame.dtype != np.uint8 or frame.shape != self.frame_shape:
+            raise ValueError('Frame has incorrect format or shape.')
+        np.ascontiguousarray(frame).tofile(self.fout)
+        self.nframes += 1
+
+    def close(self):
+        self.fout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def write_frames(frames, fname):
+    '''Write all frames from the iterable `frames` to a new frame store.'''
+    writer = None
+    for frame in frames:
+        if writer is None:
+            writer = FrameStoreWriter(fname, frame.shape)
+        writer.append(frame)
+    if writer is None:
+        raise ValueError('No frames to write.')
+    writer.close()
+    return writer.nframes
+
+
+def test_write_read(nframes=5, shape=(48, 64)):
+    import tempfile
+    frames = np.random.randint(0, 256, (nframes, ) + shape).astype(np.uint8)
+    fd, fname = tempfile.mkstemp(suffix='.frames')
+    os.close(fd)
+    try:
+        write_frames(frames, fname)
+        store = FrameStore(fname)
+        if len(store) != nframes or not np.all(store[1:3] == frames[1:3]) or \
+           not np.all(np.array(list(store)) == frames):
+            raise RuntimeError('test_write_read: Frames read from store do '
+                               'not match written frames.')
+    finally:
+        os.unlink(fname)
+
+
+@click.command('dumpframes')
+@click.argument('filename')
+@click.argument('outfile')
+@click.option('--resolution', type=str, default='1920x1080')
+@click.option('--video-start', type=float, default=0.0)
+@click.option('--video-duration', type=float)
+@click.option('--color', is_flag=True)
+def dump(filename, outfile, resolution, video_start, video_duration, color):
+    '''Decode the video FILENAME into the frame store OUTFILE.'''
+    resolution = focus.util.parse_resolution(resolution)
+    frames = focus.video.video_frame_src(filename, resolution, video_start,
+                                         video_duration, grayscale=not color)
+    nframes = write_frames(frames, outfile)
+    print 'Wrote {} frames to {}.'.format(nframes, outfile)
@@ -28,6 +28,31 @@ def mask_fragments(fragments, channel_idx):
     fragments ^= _MASKS[channel_idx][:fragment_size]
 
 
+def parity_profile(parity, nsubchannels):
+    '''Return the number of RS parity bytes of each subchannel.
+
+    `parity` is a number for all subchannels, a sequence with one number per
+    subchannel (or a string of comma-separated numbers), or a string
+    'INNER:OUTER'. The latter lets parity grow linearly from the innermost
+    to the outermost subchannel, since outer subchannels suffer more from
+    blur.'''
+    if isinstance(parity, basestring):
+        parity = parity.strip('[]() ')
+        if ':' in parity:
+            inner, outer = (float(p) for p in parity.split(':'))
+            return [int(round(p))
+                    for p in np.linspace(inner, outer, nsubchannels)]
+        parity = [int(p) for p in parity.split(',')]
+        if len(parity) == 1:
+            parity = parity[0]
+    if np.isscalar(parity):
+        return [int(parity)] * nsubchannels
+    if len(parity) != nsubchannels:
+        raise ValueError('Parity profile has {} entries, expected {}.'.format(
+            len(parity), nsubchannels))
+    return [int(p) for p in parity]
+
+
 def test_mask_fragments():
     frags = np.random.randint(0, 255, (10, 1024)).astype(np.uint8)
     copy = frags.copy()
@@ -36,3 +61,52 @@ def test_mask_fragments():
     mask_fragments(copy, 0)
     if not np.all(frags == copy):
         raise RuntimeError('test_mask_fragments() failed.')
+
+
+def test_parity_profile():
+    expected = ((16, [16, 16, 16, 16]),
+                ('16', [16, 16, 16, 16]),
+                ('8,10,12,14', [8, 10, 12, 14]),
+                ([8, 10, 12, 14], [8, 10, 12, 14]),
+                ('[8, 10, 12, 14]', [8, 10, 12, 14]),
+                ('8:14', [8, 10, 12, 14]),
+                ('[4:9]', [4, 6, 7, 9]))
+    for parity, profile in expected:
+        if parity_profile(parity, 4) != profile:
+            raise RuntimeError('test_parity_profile: Wrong profile for '
+                               '{!r}.'.format(parity))
+    for parity in ('8,10,12', [8, 10, 12, 14, 16]):
+        try:
+            parity_profile(parity, 4)
+        except ValueError:
+            continue
+        raise RuntimeError('test_parity_profile: Accepted {!r}.'.format(
+            parity))
+
+
+def benchmark(nsubchannels=16, profiles=('16', '12:20', '8:24', '4:28'),
+              nframes=10, shape=(512, 512), blur=2.5, noise=8.):
+    '''Compare the goodput of parity profiles on impaired frames.
+
+    All profiles have the same mean parity, so the codes use the same
+    number of spectral elements.'''
+    import focus.receiver
+    import focus.transmitter
+    import focus.tune
+
+    print '{:>8} {:>10} {:>14}'.format('parity', 'fragments',
+                                       'bytes/frame')
+    for profile in profiles:
+        transmitter = focus.transmitter.Transmitter(nsubchannels, shape=shape,
+                                                    parity=profile)
+        receiver = focus.receiver.Receiver(nsubchannels, shape=shape,
+                                           parity=profile, use_hints=False)
+        np.random.seed(1)
+        frames = focus.tune.synthetic_frames(nsubchannels, shape, nframes,
+                                             blur, noise,
+                                             transmitter=transmitter)
+        nfragments = sum(sum(f is not None for f in result['fragments'])
+                         for result in receiver.decode_many(frames))
+        print '{:>8} {:>9.1f}% {:>14.0f}'.format(
+            profile, 100. * nfragments / (nframes*nsubchannels),
+            64. * nfragments / nframes)
@@ -0,0 +1,214 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Decoding of live raw video, e.g., piped in from a capture process.
+
+Frames are read by a separate thread into a bounded queue. If decoding falls
+behind, frames are dropped rather than delaying the output further.'''
+
+import collections
+import sys
+import threading
+import time
+
+import click
+import numpy as np
+
+import focus.multiprocreceiver
+import focus.util
+import focus.video
+
+
+def raw_frame_src(fin, resolution, pix_fmt='gray'):
+    '''Read raw frames from the file object `fin`.
+
+    `pix_fmt` is 'gray' or 'yuv420p'; of the latter, only the luma plane is
+    used. Yields (capture time, frame) tuples.'''
+    height, width = resolution
+    if pix_fmt == 'gray':
+        bytes_per_frame = height*width
+    elif pix_fmt == 'yuv420p':
+        bytes_per_frame = height*width*3/2
+    else:
+        raise ValueError('Unsupported pixel format {}.'.format(pix_fmt))
+    while True:
+        bytes = fin.read(bytes_per_frame)
+        if len(bytes) != bytes_per_frame:
+            return
+        frame = np.frombuffer(bytes, dtype=np.uint8, count=height*width)
+        yield time.time(), frame.reshape(resolution)
+
+
+class FrameQueue(object):
+    '''Bounded queue between a frame source and the decoder.
+
+    put() never blocks. If the queue is full, `policy` decides which frames
+    are dropped: 'drop-oldest' drops the oldest queued frame, 'drop-newest'
+    the frame that is being put, and 'skip-alternate' every other queued
+    frame, which halves the frame rate until the decoder catches up.'''
+    policies = ('drop-oldest', 'drop-newest', 'skip-alternate')
+
+    def __init__(self, maxsize, policy='drop-oldest'):
+        if policy not in self.policies:
+            raise ValueError('Unknown policy {}.'.format(policy))
+        if maxsize < 1:
+            raise ValueError('Queue must hold at least one frame.')
+        self.maxsize = maxsize
+        self.policy = policy
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.nput = 0
+        self.ndropped = 0
+
+    def put(self, item):
+        '''Add `item`. Returns False if `item` itself was dropped.'''
+        with self.cond:
+            self.nput += 1
+            if len(self.items) >= self.maxsize:
+                if self.policy == 'drop-newest':
+                    self.ndropped += 1
+                    return False
+                elif self.policy == 'drop-oldest':
+                    self.items.popleft()
+                    self.ndropped += 1
+                else:
+                    kept = list(self.items)[1::2]
+                    self.ndropped += len(self.items) - len(kept)
+                    self.items = collections.deque(kept)
+            self.items.append(item)
+            self.cond.notify()
+            return True
+
+    def get(self):
+        '''Remove and return the oldest item, waiting for one if necessary.
+
+        Raises StopIteration once the queue is closed and empty.'''
+        with self.cond:
+            while len(self.items) == 0 and not self.closed:
+                # Waiting with a timeout keeps the thread interruptible.
+                self.cond.wait(1.0)
+            if len(self.items) == 0:
+                raise StopIteration
+            return self.items.popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.get()
+            except StopIteration:
+                return
+
+
+def start_reader(source, queue):
+    '''Put all items from `source` into `queue` from a background thread.'''
+    def read():
+        try:
+            for item in source:
+                queue.put(item)
+        finally:
+            queue.close()
+    thread = threading.Thread(target=read, name='frame-reader')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+class LatencyCallback(object):
+    '''Wraps a DecodeCallback to measure capture-to-output latency.
+
+    Output is flushed after every chunk, so decoded fragments are not held
+    back in the write buffer.'''
+
+    def __init__(self, decode_callback):
+        self.decode_callback = decode_callback
+        self.capture_times = dict()
+        self.latencies = list()
+
+    def frames(self, queue):
+        '''Yield the frames from `queue`, remembering their capture times.'''
+        for frame_idx, (capture_time, frame) in enumerate(queue):
+            self.capture_times[frame_idx] = capture_time
+            yield frame
+
+    def callback(self, data):
+        self.decode_callback.callback(data)
+        self.decode_callback.writer.flush()
+        now = time.time()
+        for d in data:
+            self.latencies.append(now - self.capture_times.pop(d.frame))
+
+    def percentiles(self, q=(50, 90, 99, 100)):
+        if len(self.latencies) == 0:
+            return [np.nan] * len(q)
+        return np.percentile(self.latencies, q)
+
+
+def test_frame_queue():
+    expected = {'drop-oldest': [6, 7, 8, 9],
+                'drop-newest': [0, 1, 2, 3],
+                'skip-alternate': [5, 7, 8, 9]}
+    for policy, items in expected.iteritems():
+        queue = FrameQueue(4, policy)
+        for i in xrange(10):
+            queue.put(i)
+        queue.close()
+        if list(queue) != items or queue.ndropped != 6:
+            raise RuntimeError('test_frame_queue: Policy {} kept unexpected '
+                               'frames.'.format(policy))
+
+
+@click.command('liverx')
+@click.argument('filename', default='-')
+@click.option('--resolution', type=str, default='1920x1080')
+@click.option('--pix-fmt', type=click.Choice(('gray', 'yuv420p')),
+              default='gray')
+@click.option('--nsubchannels', type=int, required=True)
+@click.option('--nprocesses', type=int, default=2)
+@click.option('--nframes-per-process', type=int, default=1)
+@click.option('--nextractors', type=int, default=0)
+@click.option('--queue-size', type=int, default=4)
+@click.option('--policy', type=click.Choice(FrameQueue.policies),
+              default='drop-oldest')
+@click.option('--receiver-args', type=str, default='')
+@click.option('--dedup-window', type=int, default=0,
+              help='Drop fragments repeated on a subchannel within this '
+                   'many distinct fragments.')
+@click.option('--framed', is_flag=True)
+@click.option('--fountain', 'use_fountain', is_flag=True)
+def rx(filename, resolution, pix_fmt, nsubchannels, nprocesses,
+       nframes_per_process, nextractors, queue_size, policy, receiver_args,
+       dedup_window, framed, use_fountain):
+    '''Decode raw frames from FILENAME (a FIFO, or "-" for stdin) live.'''
+    receiver_args = eval('dict({})'.format(receiver_args))
+    resolution = focus.util.parse_resolution(resolution)
+
+    out = sys.stdout
+    sys.stdout = sys.stderr
+    fin = sys.stdin if filename == '-' else open(filename, 'rb')
+    queue = FrameQueue(queue_size, policy)
+    cb = focus.video.DecodeCallback(out, dedup_window, framed, use_fountain)
+    latency = LatencyCallback(cb)
+    recv = focus.multiprocreceiver.MultiProcReceiver(
+        nsubchannels, nprocesses, nframes_per_process,
+        callback=latency.callback, nextractors=nextractors, **receiver_args)
+    start_reader(raw_frame_src(fin, resolution, pix_fmt), queue)
+    recv.decode_many(latency.frames(queue), until=cb.done)
+    cb.close()
+    print
+    cb.final_stats()
+    print 'Dropped {} of {} frames ({})'.format(queue.ndropped, queue.nput,
+                                                policy)
+    print ('Latency: p50={:.1f} ms, p90={:.1f} ms, p99={:.1f} ms, '
+           'max={:.1f} ms').format(*(1000. * latency.percentiles()))
+    recv.close()
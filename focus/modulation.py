@@ -3,64 +3,239 @@
 # This file is part of FOCUS and is licensed under the 3-clause BSD license.
 # The full license can be found in the file COPYING.
 
+'''Table-driven modulation of bytes onto complex symbols.
+
+Each constellation maps groups of `bits_per_symbol` bits to `points`, which
+are scaled to unit mean power. Bits are consumed least significant first.
+Demodulation avoids trigonometry: every constellation computes a few sign and
+magnitude comparisons per symbol, which index a decision table.'''
+
 import numpy as np
 
 
-class QPSK(object):
-    nan_symbol = np.complex(1, 0)
-    bits_to_phases = {0b00: 1/4.*np.pi,  0b01: 3/4.*np.pi,
-                      0b11: -3/4.*np.pi, 0b10: -1/4.*np.pi}
+class Constellation(object):
+    bits_per_symbol = None
+    points = None
+    # Distance of the points to the closest decision boundary
+    min_distance = None
+    # The points' phases repeat after a rotation by 2*pi/symmetry, so their
+    # `symmetry`-th powers share the same phase (see regularity()).
+    symmetry = None
 
     def __init__(self):
-        self.bits_to_sym = {bits: np.complex(np.cos(phase), np.sin(phase))
-                            for bits, phase in self.bits_to_phases.iteritems()}
-
-        self.lss_lookup = list()
-        self.mss_lookup = list()
-        for byte in xrange(256):
-            mod = self._modulate_byte(byte)
-            self.lss_lookup.append(mod)
-            self.mss_lookup.append(mod[::-1])
-
-    def _modulate_byte(self, byte):
-        return (self.bits_to_sym[(byte >> 0) & 0b11],
-                self.bits_to_sym[(byte >> 2) & 0b11],
-                self.bits_to_sym[(byte >> 4) & 0b11],
-                self.bits_to_sym[(byte >> 6) & 0b11])
+        self.nvalues = 1 << self.bits_per_symbol
+        # Inverse of _features() on the constellation points
+        self.decision = np.zeros(self.nvalues, dtype=np.uint8)
+        self.decision[self._features(self.points)] = np.arange(self.nvalues)
+        if np.any(self.points[self.decision[self._features(self.points)]] !=
+                  self.points):
+            raise ValueError('Decision regions are ambiguous.')
+
+        self.symbols_per_byte = None
+        if 8 % self.bits_per_symbol == 0:
+            self.symbols_per_byte = 8 / self.bits_per_symbol
+            shifts = self.bits_per_symbol * np.arange(self.symbols_per_byte)
+            values = (np.arange(256)[:, np.newaxis] >> shifts) & \
+                (self.nvalues - 1)
+            self.lss_table = self.points[values]
+            self.mss_table = self.lss_table[:, ::-1].copy()
+
+    def nsymbols(self, nbytes):
+        '''Number of symbols required to carry `nbytes` bytes.'''
+        return -(-8*nbytes // self.bits_per_symbol)
+
+    def nbytes(self, nsymbols):
+        '''Number of whole bytes carried by `nsymbols` symbols.'''
+        return nsymbols * self.bits_per_symbol / 8
 
     def modulate(self, bytes, lss_first=True):
-        lookup = self.lss_lookup if lss_first else self.mss_lookup
-        symbols = np.zeros(4*len(bytes), dtype=np.complex)
-        for i, byte in enumerate(bytes):
-            symbols[4*i:4*(i+1)] = lookup[byte]
-        return symbols
-
-    def demodulate(self, symbols):
-        assert len(symbols) % 4 == 0, 'Incomplete bytes!'
-        # Replace NaN symbols with symbol representing 0b00 and let
-        # FEC deal with the errors.
-        symbols[np.isnan(symbols)] = np.complex(1, 0)
-        assert np.all(np.abs(symbols) > 0), \
-            'QPSK cannot decode zero-length symbol.'
-
-        phases = np.angle(symbols)
-        # Map symbol phases to bits
-        symbits = np.zeros(symbols.shape, np.uint8)
-        piq = 1/4.*np.pi
-        for bits, phase in self.bits_to_phases.iteritems():
-            symbits[(phase-piq <= phases) & (phases < phase+piq)] = bits
-
-        # Pack bits into bytes
-        return (symbits[3::4] << 6) | \
-               (symbits[2::4] << 4) | \
-               (symbits[1::4] << 2) | \
-               (symbits[0::4] << 0)
+        '''Modulate bytes along the last axis of `bytes`.'''
+        bytes = np.asarray(bytes, dtype=np.uint8)
+        if self.symbols_per_byte is not None:
+            table = self.lss_table if lss_first else self.mss_table
+            symbols = np.take(table, bytes, axis=0)
+            return symbols.reshape(bytes.shape[:-1] + (-1, ))
+        if not lss_first:
+            raise ValueError('Symbols straddle bytes, cannot modulate most '
+                             'significant symbol first.')
+        bits = np.unpackbits(bytes[..., np.newaxis], axis=-1)[..., ::-1]
+        bits = bits.reshape(bytes.shape[:-1] + (-1, ))
+        nsymbols = self.nsymbols(bytes.shape[-1])
+        padding = [(0, 0)] * (bits.ndim-1) + \
+            [(0, nsymbols*self.bits_per_symbol - bits.shape[-1])]
+        bits = np.pad(bits, padding, 'constant')
+        bits = bits.reshape(bits.shape[:-1] + (nsymbols, self.bits_per_symbol))
+        values = bits.dot(1 << np.arange(self.bits_per_symbol))
+        return np.take(self.points, values)
+
+    def demodulate(self, symbols, reliability=False):
+        '''Demodulate symbols into bytes.
+
+        Bytes are packed along the first axis of `symbols`. If `reliability`
+        is True, also returns a per-byte reliability score: the distance of
+        the byte's least reliable symbol to the closest decision boundary,
+        relative to that of an undistorted symbol (0 for NaN symbols).'''
+        nans = np.isnan(symbols)
+        # Erase NaN symbols and let FEC deal with the errors.
+        symbols = np.where(nans, 0, symbols)
+        nvalid = np.maximum(np.sum(~nans, axis=0), 1)
+        symbols = symbols / self._scale(symbols, nvalid)
+        values = self.decision[self._features(symbols)]
+        bytes = self._pack(values)
+        if not reliability:
+            return bytes
+
+        distance = self._distance(symbols) / self.min_distance
+        distance[nans] = 0
+        return bytes, self._byte_min(distance)
+
+    def regularity(self, symbols):
+        '''Score how well symbols along the last axis fit the constellation.
+
+        The score is close to 1 for modulated symbols, regardless of their
+        common phase, and close to 0 for noise.'''
+        powers = np.nan_to_num(symbols) ** self.symmetry
+        return np.abs(np.mean(powers, axis=-1)) / \
+            np.maximum(np.mean(np.abs(powers), axis=-1), 1e-12)
+
+    def _scale(self, symbols, nvalid):
+        '''Estimate the amplitude of each column of `symbols`, which has
+        `nvalid` valid (non-zero) symbols.'''
+        power = np.sum(np.abs(symbols)**2, axis=0) / nvalid
+        return np.maximum(np.sqrt(power), 1e-12)
+
+    def _pack(self, values):
+        if self.symbols_per_byte is not None:
+            k = self.symbols_per_byte
+            assert len(values) % k == 0, 'Incomplete bytes!'
+            bytes = np.zeros((len(values)/k, ) + values.shape[1:], np.uint8)
+            for i in xrange(k):
+                bytes |= values[i::k] << (i*self.bits_per_symbol)
+            return bytes
+        bits = (values[:, np.newaxis] >>
+                np.arange(self.bits_per_symbol).reshape(
+                    (-1, ) + (1, )*(values.ndim-1))) & 1
+        bits = bits.reshape((-1, ) + values.shape[1:])
+        nbytes = self.nbytes(len(values))
+        bits = bits[:8*nbytes].reshape((nbytes, 8) + values.shape[1:])
+        weights = (1 << np.arange(8)).reshape((8, ) + (1, )*(values.ndim-1))
+        return np.sum(bits * weights, axis=1).astype(np.uint8)
+
+    def _byte_min(self, distance):
+        '''Minimum of per-symbol `distance` over the symbols of each byte.'''
+        if self.symbols_per_byte is not None:
+            k = self.symbols_per_byte
+            return np.min(distance.reshape((-1, k) + distance.shape[1:]),
+                          axis=1)
+        bits = np.repeat(distance, self.bits_per_symbol, axis=0)
+        nbytes = self.nbytes(len(distance))
+        bits = bits[:8*nbytes].reshape((nbytes, 8) + distance.shape[1:])
+        return np.min(bits, axis=1)
+
+
+class QPSK(Constellation):
+    bits_per_symbol = 2
+    # Bit 0 is the sign of the real part, bit 1 that of the imaginary part
+    points = np.exp(1j*np.pi*np.array([1/4., 3/4., -1/4., -3/4.]))
+    min_distance = np.sqrt(.5)
+    symmetry = 4
+
+    def _features(self, symbols):
+        return (symbols.real < 0).astype(np.uint8) | \
+            ((symbols.imag < 0).astype(np.uint8) << 1)
+
+    def _distance(self, symbols):
+        return np.minimum(np.abs(symbols.real), np.abs(symbols.imag))
+
+    def _scale(self, symbols, nvalid):
+        # The decisions do not depend on the amplitude, so the mean
+        # magnitude (which is cheaper than the RMS) is good enough.
+        return np.maximum(np.sum(np.abs(symbols), axis=0) / nvalid, 1e-12)
+
+
+class PSK8(Constellation):
+    '''8-PSK. Three bytes are spread over eight symbols.'''
+    bits_per_symbol = 3
+    # Gray-coded: point i lies in octant k, where i is the Gray code of k
+    points = np.exp(1j*np.pi*(2*np.argsort([0, 1, 3, 2, 6, 7, 5, 4])+1)/8.)
+    min_distance = np.sin(np.pi/8)
+    symmetry = 8
+
+    def _features(self, symbols):
+        re, im = symbols.real, symbols.imag
+        return (re < 0).astype(np.uint8) | \
+            ((im < 0).astype(np.uint8) << 1) | \
+            ((np.abs(im) > np.abs(re)).astype(np.uint8) << 2)
+
+    def _distance(self, symbols):
+        re, im = np.abs(symbols.real), np.abs(symbols.imag)
+        return np.minimum(np.minimum(re, im), np.abs(re-im) / np.sqrt(2))
+
+
+class QAM16(Constellation):
+    '''Gray-coded 16-QAM.
+
+    Unlike PSK, decisions depend on the amplitude, so each subchannel (i.e.,
+    each column of the demodulated symbols) is normalized to unit RMS.'''
+    bits_per_symbol = 4
+    # Per axis, bit 0 is the sign and bit 1 selects the outer level.
+    _levels = np.array([1., -1., 3., -3.]) / np.sqrt(10)
+    points = _levels[np.arange(16) & 3] + 1j*_levels[np.arange(16) >> 2]
+    min_distance = 1 / np.sqrt(10)
+    symmetry = 4
+    _threshold = 2 / np.sqrt(10)
+
+    def _features(self, symbols):
+        re, im = symbols.real, symbols.imag
+        return (re < 0).astype(np.uint8) | \
+            ((np.abs(re) > self._threshold).astype(np.uint8) << 1) | \
+            ((im < 0).astype(np.uint8) << 2) | \
+            ((np.abs(im) > self._threshold).astype(np.uint8) << 3)
+
+    def _distance(self, symbols):
+        re, im = np.abs(symbols.real), np.abs(symbols.imag)
+        return np.minimum(np.minimum(re, np.abs(re - self._threshold)),
+                          np.minimum(im, np.abs(im - self._threshold)))
+
+
+CONSTELLATIONS = {'qpsk': QPSK, '8psk': PSK8, '16qam': QAM16}
+
+
+def get(name):
+    '''Return an instance of the constellation called `name`.'''
+    try:
+        return CONSTELLATIONS[name.lower()]()
+    except KeyError:
+        raise ValueError('Unknown modulation {}. Choose one of {}.'.format(
+            name, ', '.join(sorted(CONSTELLATIONS))))
 
 
 def test_mod_demod(nsymbols=65536):
-    data = np.random.randint(0, 255, nsymbols).astype(np.uint8)
+    for name in sorted(CONSTELLATIONS):
+        # Three subchannels of bytes, packed along the first axis
+        data = np.random.randint(0, 256, (3, nsymbols/3)).astype(np.uint8)
+        constellation = get(name)
+        symbols = constellation.modulate(data)
+        if symbols.shape != (3, constellation.nsymbols(nsymbols/3)):
+            raise RuntimeError('{} modulated to unexpected number of '
+                               'symbols.'.format(name))
+        demod_data = constellation.demodulate(symbols.T).T
+        if not np.all(data == demod_data):
+            raise RuntimeError('Demodulated {} data does not match input '
+                               'data.'.format(name))
+
+
+def test_demod_reliability(nbytes=1024):
+    data = np.random.randint(0, 255, nbytes).astype(np.uint8)
     qpsk = QPSK()
     symbols = qpsk.modulate(data)
-    demod_data = qpsk.demodulate(symbols)
-    if not np.all(data == demod_data):
-        raise RuntimeError('Demodulated data does not match input data.')
+    # Rotate the symbols of two bytes towards a decision boundary, and
+    # erase a symbol of a third byte.
+    symbols[4*10+2] *= np.exp(0.7j)
+    symbols[4*20+1] *= np.exp(-0.6j)
+    symbols[4*30] = np.nan
+    demod_data, reliability = qpsk.demodulate(symbols, reliability=True)
+    demod_data[30] = data[30]
+    if not np.all(data == demod_data) or \
+       set(np.argsort(reliability)[:3]) != set((10, 20, 30)):
+        raise RuntimeError('Least reliable bytes are not the distorted ones.')
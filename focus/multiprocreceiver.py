@@ -3,93 +3,272 @@
 # This file is part of FOCUS and is licensed under the 3-clause BSD license.
 # The full license can be found in the file COPYING.
 
+import collections
 import cPickle as pickle
+import itertools
+import json
 import select
 import subprocess
 import sys
 import time
 
-from focus.util import is_android, load_frames
+from focus.util import is_android, load_frames, sizeof_fmt, take_n
 
 
-def take_n(iterable, n):
-    elems = list()
-    for element in iterable:
-        elems.append(element)
-        if len(elems) == n:
-            yield elems
-            elems = list()
-    if len(elems) > 0:
-        yield elems
+def cli_options(kwargs):
+    '''Return the command line options of the receiver command (see
+    focus.receiver.main()) for the Receiver arguments `kwargs`.'''
+    options = list()
+    for key, value in sorted(kwargs.iteritems()):
+        option = key.replace('_', '-')
+        if value is None:
+            continue
+        elif isinstance(value, bool):
+            # Boolean options are flags, e.g., --color/--no-color
+            options.append(('--' if value else '--no-') + option)
+        elif isinstance(value, (tuple, list)) and len(value) == 2:
+            # Shapes and tiles are (rows, columns), but given as COLSxROWS
+            options += ['--' + option, '{}x{}'.format(value[1], value[0])]
+        else:
+            options += ['--' + option, str(value)]
+    return options
+
+
+class Profile(object):
+    '''Timings of the parent and the worker processes.
+
+    Worker timings are reported by the workers themselves (see the
+    --profile option of the receiver command).'''
+    parent_phases = ('serialize', 'write', 'select', 'receive', 'callback')
+
+    def __init__(self, nprocesses, trace=False):
+        self.start = self.stop = time.time()
+        self.parent = collections.defaultdict(float)
+        self.workers = [collections.defaultdict(float)
+                        for _ in xrange(nprocesses)]
+        self.events = list() if trace else None
+
+    def add(self, name, start, stop, tid=0):
+        '''Record a phase of the parent (tid 0) or of worker tid-1.'''
+        if tid == 0:
+            self.parent[name] += stop - start
+        else:
+            self.workers[tid-1][name] += stop - start
+        self.stop = max(self.stop, stop)
+        if self.events is not None:
+            self.events.append({'name': name, 'ph': 'X', 'pid': 0,
+                                'tid': tid,
+                                'ts': (start - self.start) * 1e6,
+                                'dur': (stop - start) * 1e6})
+
+    def add_chunk(self, worker_idx, timing, nframes, nbytes_sent):
+        stats = self.workers[worker_idx]
+        stats['chunks'] += 1
+        stats['frames'] += nframes
+        stats['bytes_sent'] += nbytes_sent
+        stats['bytes_received'] += timing['nbytes']
+        for name in ('receive', 'decode', 'send'):
+            self.add(name, timing[name][0], timing[name][1], worker_idx+1)
+
+    def report(self):
+        wall = max(self.stop - self.start, 1e-9)
+        print 'Profile over {:.2f} s:'.format(wall)
+        fmt = '{:>6} {:>6} {:>7} {:>6} {:>8} {:>9} {:>6} {:>10} {:>10}'
+        print fmt.format('worker', 'chunks', 'frames', 'busy', 'ms/frame',
+                         'receiving', 'idle', 'sent', 'received')
+        for i, stats in enumerate(self.workers):
+            idle = wall - stats['receive'] - stats['decode'] - stats['send']
+            print fmt.format(
+                i, int(stats['chunks']), int(stats['frames']),
+                '{:.0f}%'.format(100. * stats['decode'] / wall),
+                '{:.1f}'.format(1000. * stats['decode'] /
+                                max(stats['frames'], 1)),
+                '{:.0f}%'.format(100. * stats['receive'] / wall),
+                '{:.0f}%'.format(100. * max(idle, 0) / wall),
+                sizeof_fmt(stats['bytes_sent']),
+                sizeof_fmt(stats['bytes_received']))
+        print 'Parent: ' + ', '.join(
+            '{} {:.2f} s ({:.0f}%)'.format(name, self.parent[name],
+                                           100. * self.parent[name] / wall)
+            for name in self.parent_phases)
+
+    def write_trace(self, fname):
+        '''Write the timeline in Chrome's trace event format.'''
+        names = ['parent'] + ['worker {}'.format(i)
+                              for i in xrange(len(self.workers))]
+        meta = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid,
+                 'args': {'name': name}} for tid, name in enumerate(names)]
+        with open(fname, 'w') as fout:
+            json.dump({'traceEvents': meta + self.events}, fout)
 
 
 class MultiProcReceiver(object):
+    '''Decodes frames on `nprocesses` worker processes.
+
+    With `nextractors` > 0, frames are sent to that many extraction
+    workers, and only the extracted codes, which are much smaller than
+    camera frames, are sent on to the `nprocesses` decoding workers.'''
+
     def __init__(self, nsubchannels, nprocesses, nframes_per_process,
-                 callback=None, **kwargs):
+                 callback=None, profile=False, trace=None, nextractors=0,
+                 **kwargs):
         path = '/data/data/se.sics.vizpy/files/' if is_android() else ''
         cmd = [path+'python', '-u', '-m', 'focus.cli', 'receiver',
-               '--nsubchannels', str(nsubchannels)]
-        for key, value in kwargs.iteritems():
-            if value is not None:
-                cmd.append('--' + key.replace('_', '-'))
-                cmd.append(str(value))
-        self.processes = tuple(subprocess.Popen(cmd, stdin=subprocess.PIPE,
-                                                stdout=subprocess.PIPE,
-                                                close_fds=True)
-                               for _ in xrange(nprocesses))
+               '--nsubchannels', str(nsubchannels)] + cli_options(kwargs)
+        # Writing a trace implies profiling
+        self.trace = trace
+        if profile or trace:
+            cmd.append('--profile')
+            self.profile = Profile(nextractors + nprocesses,
+                                   trace=bool(trace))
+        else:
+            self.profile = None
+
+        self.cmd = cmd
+        self.extractors = tuple(self.start_process('extract')
+                                for _ in xrange(nextractors))
+        self.decoders = tuple(self.start_process('decode' if nextractors > 0
+                                                 else 'all')
+                              for _ in xrange(nprocesses))
+        self.processes = self.extractors + self.decoders
+        self.proc_idx = {p: i for i, p in enumerate(self.processes)}
         self.stdout_to_proc = {p.stdout.fileno(): p for p in self.processes}
         self.callback = callback
         self.nframes_per_process = nframes_per_process
 
-    def decode_many(self, frames):
+    def start_process(self, stage):
+        return subprocess.Popen(self.cmd + ['--stage', stage],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, close_fds=True)
+
+    def decode_many(self, frames, until=None):
+        '''Decode all frames, or stop early once `until()` returns True.'''
         frames = take_n(frames, self.nframes_per_process)
-        # Send a first chunk to all processes
-        # XXX fails if there are more processes than chunk
-        pending = 0
+        # Index of the first frame in the chunk that each process works on
+        self.next_frame_idx = 0
+        self.chunk_start = dict()
+        self.nbytes_sent = dict()
         self.start_time = time.time()
-        for i, proc in enumerate(self.processes):
-            pending += 1
-            send_to_process(next(frames), proc)
-
-        print 'All processes started.'
-
-        rlist = tuple(self.stdout_to_proc.keys())
-        empty = tuple()
-        try:
-            while True:
-                # Wait for next processes to become ready
-                ready, _, _ = select.select(rlist, empty, empty)
-                for stdout in ready:
-                    proc = self.stdout_to_proc[stdout]
-                    self.try_callback(recv_from_process(proc))
-                    send_to_process(next(frames), proc)
-        except StopIteration:
-            pending -= 1
-
-        while pending > 0:
-            ready, _, _ = select.select(rlist, empty, empty)
+        if self.profile is not None:
+            self.profile.start = self.start_time
+        # Processes that receive frames, and those waiting for them
+        front = self.extractors if self.extractors else self.decoders
+        waiting = collections.deque(front)
+        # Extracted chunks (with the index of their first frame) waiting for
+        # a decoder, and the decoders waiting for them
+        extracted = collections.deque()
+        idle = collections.deque(self.decoders if self.extractors else ())
+        busy = set()
+        # No frames are left, or until() returned True. Chunks that are in
+        # flight are still decoded in the former case, but not in the latter.
+        exhausted = stopped = False
+        started = False
+
+        while True:
+            while len(extracted) > 0 and len(idle) > 0:
+                proc = idle.popleft()
+                start, chunk = extracted.popleft()
+                self.send_chunk(chunk, proc, start)
+                busy.add(proc)
+            # Hold back the extractors while the decoders fall behind
+            while len(waiting) > 0 and not (exhausted or stopped) and \
+                    len(extracted) < max(len(self.decoders), 1):
+                chunk = next(frames, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                proc = waiting.popleft()
+                self.send_chunk(chunk, proc, self.next_frame_idx)
+                self.next_frame_idx += len(chunk)
+                busy.add(proc)
+            if not started:
+                print 'All processes started.'
+                started = True
+            if len(busy) == 0:
+                break
+
+            # Wait for next processes to become ready
+            ready, _, _ = self.select(tuple(p.stdout.fileno() for p in busy))
             for stdout in ready:
                 proc = self.stdout_to_proc[stdout]
-                self.try_callback(recv_from_process(proc))
-                pending -= 1
+                busy.remove(proc)
+                if proc in self.extractors:
+                    chunk = self.recv_chunk(proc)
+                    if not stopped:
+                        extracted.append((self.chunk_start[proc], chunk))
+                else:
+                    self.try_callback(self.recv_chunk(proc))
+                    if self.extractors:
+                        idle.append(proc)
+                    if until is not None and until():
+                        stopped = True
+                        extracted.clear()
+                if proc in front:
+                    waiting.append(proc)
+
+    def select(self, rlist):
+        start = time.time()
+        ready = select.select(rlist, (), ())
+        if self.profile is not None:
+            self.profile.add('select', start, time.time())
+        return ready
+
+    def send_chunk(self, chunk, proc, frame_idx):
+        self.chunk_start[proc] = frame_idx
+        start = time.time()
+        data = pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL)
+        serialized = time.time()
+        write_to_process(data, proc)
+        if self.profile is not None:
+            self.profile.add('serialize', start, serialized)
+            self.profile.add('write', serialized, time.time())
+            self.nbytes_sent[proc] = len(data)
+
+    def recv_chunk(self, proc):
+        start = time.time()
+        results = recv_from_process(proc)
+        if self.profile is not None:
+            self.profile.add('receive', start, time.time())
+            timing = pickle.load(proc.stdout)
+            self.profile.add_chunk(self.proc_idx[proc], timing, len(results),
+                                   self.nbytes_sent[proc])
+        if proc in self.extractors:
+            return results
+        # Chunks complete out of order, so tag results with their frame index
+        for i, result in enumerate(results):
+            result.frame = self.chunk_start[proc] + i
+        return results
 
     def try_callback(self, data):
         if self.callback is None:
             return
+        start = time.time()
         self.callback(data)
+        if self.profile is not None:
+            self.profile.add('callback', start, time.time())
 
     def close(self):
         for proc in self.processes:
             proc.stdout.close()
             proc.stdin.close()
             proc.wait()
+        if self.profile is not None:
+            self.profile.report()
+            if self.trace:
+                self.profile.write_trace(self.trace)
+                print 'Wrote trace to {}'.format(self.trace)
 
 
-def send_to_process(chunk, proc):
-    pickle.dump(chunk, proc.stdin, protocol=pickle.HIGHEST_PROTOCOL)
+def write_to_process(data, proc):
+    proc.stdin.write(data)
     proc.stdin.flush()
 
 
+def send_to_process(chunk, proc):
+    write_to_process(pickle.dumps(chunk, protocol=pickle.HIGHEST_PROTOCOL),
+                     proc)
+
+
 def recv_from_process(proc):
     try:
         return pickle.load(proc.stdout)
@@ -98,23 +277,110 @@ def recv_from_process(proc):
         raise
 
 
-def benchmark(frames='frames.pickle', nprocesses=4, nframes_per_process=20,
-              repeat=1):
+def benchmark(frames='frames.pickle', nsubchannels=16, nprocesses=4,
+              nframes_per_process=20, repeat=1, profile=False, trace='',
+              nextractors=0):
     import time
-    recv = MultiProcReceiver(nprocesses, nframes_per_process)
+    recv = MultiProcReceiver(nsubchannels, nprocesses, nframes_per_process,
+                             profile=profile, trace=trace,
+                             nextractors=nextractors)
 
     if isinstance(frames, basestring):
         frames = load_frames(frames)
+    nframes = len(frames) * repeat
 
-    if repeat != 1:
-        frames = frames * repeat
+    # Works for lists of frames as well as for (memory-mapped) frame stores,
+    # without copying the frames.
+    frames = itertools.chain.from_iterable(itertools.repeat(frames, repeat))
 
     start = time.time()
     recv.decode_many(frames)
     stop = time.time()
 
-    print 'Processed {} frames'.format(len(frames))
+    print 'Processed {} frames'.format(nframes)
     print 'Took {:.2f} ms'.format((stop-start) * 1000.)
-    print 'Frame rate: {:.2f} fps'.format(len(frames) / (stop-start))
+    print 'Frame rate: {:.2f} fps'.format(nframes / (stop-start))
+
+    recv.close()
+
+
+# Stands in for the receiver command: extraction returns the frames,
+# decoding returns a result per frame with the frame as its data.
+_STUB_WORKER = '''
+import cPickle as pickle
+import random
+import sys
+import time
+
+import numpy as np
+
+import focus.receiver
+
+while True:
+    try:
+        chunk = pickle.load(sys.stdin)
+    except EOFError:
+        break
+    time.sleep(random.random() * 0.01)
+    if sys.argv[1] != 'extract':
+        chunk = [focus.receiver.DecodeResult(
+            np.array([[frame]], dtype=np.uint8), np.zeros(1, dtype=np.int))
+            for frame in chunk]
+    pickle.dump(chunk, sys.stdout, protocol=pickle.HIGHEST_PROTOCOL)
+    sys.stdout.flush()
+'''
+
+
+class _StubReceiver(MultiProcReceiver):
+    def start_process(self, stage):
+        return subprocess.Popen([sys.executable, '-c', _STUB_WORKER, stage],
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE, close_fds=True)
+
+
+def test_scheduler():
+    for nframes, nextractors in ((40, 0), (40, 2), (40, 4), (3, 2), (0, 2)):
+        results = list()
+        recv = _StubReceiver(1, 2, 2, callback=results.extend,
+                             nextractors=nextractors)
+        recv.decode_many(iter(range(nframes)))
+        recv.close()
+        if sorted(r.frame for r in results) != range(nframes) or \
+           any(r.data[0, 0] != r.frame for r in results):
+            raise RuntimeError('test_scheduler: Decoded frames {} of {} with '
+                               '{} extractors.'.format(
+                                   sorted(r.frame for r in results), nframes,
+                                   nextractors))
+    # Stop early
+    results = list()
+    recv = _StubReceiver(1, 2, 2, callback=results.extend, nextractors=2)
+    recv.decode_many(iter(range(40)), until=lambda: len(results) > 0)
+    recv.close()
+    if not 0 < len(results) < 40:
+        raise RuntimeError('test_scheduler: Did not stop early.')
+
 
+def test_cli_options(tiles=(2, 3), nsubchannels=4, shape=(128, 128)):
+    import numpy as np
+    import focus.tiling
+    options = cli_options({'tiles': tiles, 'shape': (96, 128),
+                           'detect': False, 'modulation': 'qpsk',
+                           'crosstalk': None})
+    if options != ['--no-detect', '--modulation', 'qpsk', '--shape',
+                   '128x96', '--tiles', '3x2']:
+        raise RuntimeError('test_cli_options: Unexpected options {}.'.format(
+            options))
+    # The workers must decode a tiled frame with these arguments
+    transmitter = focus.tiling.TiledTransmitter(tiles, nsubchannels,
+                                                shape=shape)
+    data = np.random.randint(0, 256, (transmitter.nsubchannels, 64))
+    data = data.astype(np.uint8)
+    frame = transmitter.encode(data.copy())
+    results = list()
+    recv = MultiProcReceiver(nsubchannels, 1, 1, callback=results.extend,
+                             tiles=tiles, shape=shape)
+    recv.decode_many(iter([frame]))
     recv.close()
+    if len(results) != 1 or not np.all(results[0].valid) or \
+       not np.all(results[0].data == data):
+        raise RuntimeError('test_cli_options: Tiled frame was not decoded.')
@@ -0,0 +1,107 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Selective mapping (SLM) to reduce the peak-to-average ratio of codes.
+
+The transmitter rotates the symbols by each of a number of pseudo-random
+masks of quarter turns, which keep the symbols on the constellation, and
+sends the candidate code with the smallest intensity range. Since all
+candidates have the same power, this leaves more gray levels for the bulk of
+the pixels. The index of the mask is sent on reserved spectral elements: each
+bit is repeated REPETITIONS times as a +1/-1 symbol.'''
+
+import numpy as np
+
+REPETITIONS = 8
+
+
+def nbits(ncandidates):
+    return max(1, int(np.ceil(np.log2(ncandidates))))
+
+
+def nsignal(ncandidates):
+    '''Number of reserved elements to signal one of `ncandidates` masks.'''
+    return 0 if ncandidates <= 1 else nbits(ncandidates) * REPETITIONS
+
+
+def masks(ncandidates, shape):
+    '''Return the candidate masks for symbols of the given shape.
+
+    The first mask leaves the symbols unchanged.'''
+    rand = np.random.RandomState(seed=23)
+    quarter_turns = rand.randint(0, 4, (ncandidates, ) + tuple(shape))
+    quarter_turns[0] = 0
+    return 1j ** quarter_turns
+
+
+def encode_index(idx, ncandidates):
+    bits = (idx >> np.arange(nbits(ncandidates))) & 1
+    # Interleave the repetitions of the bits
+    return np.tile(1. - 2.*bits, REPETITIONS)
+
+
+def decode_index(symbols, ncandidates):
+    soft = np.sum(symbols.real.reshape((REPETITIONS, -1)), axis=0)
+    idx = np.sum((soft < 0) << np.arange(len(soft)))
+    return min(idx, ncandidates - 1)
+
+
+def intensity_range(codes):
+    '''Range of the codes' intensities relative to their standard deviation.'''
+    codes = codes.reshape((len(codes), -1))
+    return (codes.max(axis=1) - codes.min(axis=1)) / codes.std(axis=1)
+
+
+def select(spectra):
+    '''Compute the codes of all candidate spectra with one transform.
+
+    Returns the index and (unquantized) code of the best candidate, and the
+    intensity ranges of all candidates.'''
+    codes = np.fft.irfft2(spectra, s=spectra.shape[-2:])
+    ranges = intensity_range(codes)
+    best = np.argmin(ranges)
+    return best, codes[best], ranges
+
+
+def test_encode_decode_index(ncandidates=16):
+    for idx in xrange(ncandidates):
+        symbols = encode_index(idx, ncandidates) * np.exp(0.3j)
+        # Flip one repetition of every bit
+        symbols[:nbits(ncandidates)] *= -1
+        if decode_index(symbols, ncandidates) != idx:
+            raise RuntimeError('test_encode_decode_index: Decoded wrong '
+                               'index.')
+
+
+def benchmark(nsubchannels=(16, 32, 48), ncandidates=(1, 4, 16), nframes=10,
+              shape=(512, 512), blur=1.0, noise=4.):
+    '''Compare intensity ranges and fragment rates with and without SLM.'''
+    import focus.receiver
+    import focus.transmitter
+    import focus.tune
+
+    print '{:>11} {:>10} {:>7} {:>10}'.format('subchannels', 'candidates',
+                                              'range', 'fragments')
+    for n in nsubchannels:
+        for ncand in ncandidates:
+            transmitter = focus.transmitter.Transmitter(n, shape=shape,
+                                                        slm=ncand)
+            receiver = focus.receiver.Receiver(n, shape=shape, slm=ncand,
+                                               use_hints=False)
+            rand = np.random.RandomState(seed=1)
+            ranges = list()
+            nfragments = 0
+            for _ in xrange(nframes):
+                data = rand.randint(0, 256, n*64).astype(np.uint8)
+                debug_info = dict()
+                frame = transmitter.encode(data, debug_info=debug_info)
+                ranges.append(debug_info['intensity_range'])
+                frame = np.pad(frame, frame.shape[0]/8, 'constant',
+                               constant_values=255)
+                frame = focus.tune.impair(frame, blur, noise)
+                fragments = receiver.decode(frame)['fragments']
+                nfragments += sum(f is not None for f in fragments)
+            print '{:>11} {:>10} {:>7.2f} {:>9.1f}%'.format(
+                n, ncand, np.mean(ranges), 100. * nfragments / (nframes*n))
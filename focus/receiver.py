@@ -3,10 +3,14 @@
 # This file is part of FOCUS and is licensed under the 3-clause BSD license.
 # The full license can be found in the file COPYING.
 
+import collections
 import cPickle as pickle
+import select
 import sys
+import time
 
 import click
+import cv2
 import imageframer
 import numpy as np
 import rscode
@@ -23,85 +27,760 @@ def _grayscale(frame):
         raise ValueError('Unexpected data format {}.'.format(frame.shape))
 
 
+def supports_erasures(rs):
+    '''Return whether the RS code `rs` decodes with known erasure positions,
+    i.e., whether its decode() takes an `erasures` argument.
+
+    The RS code of the rscode package does not.'''
+    codeword = rs.encode(np.zeros(64, dtype=np.uint8))
+    try:
+        rs.decode(codeword, erasures=[])
+    except TypeError:
+        return False
+    return True
+
+
+def _shrink(frame, corners, shape):
+    '''Crop `frame` to the code at `corners`, and halve its resolution with
+    a low-pass filter while the code is at least twice as large as `shape`.
+
+    Returns the frame, the corners within it, and whether the frame was
+    changed.'''
+    corners = np.asarray(corners, dtype=np.float32)
+    points = corners.reshape((-1, 2))
+    x, y = points[:, 0], points[:, 1]
+    # Shoelace formula
+    area = 0.5 * abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+    nlevels = 0
+    while area >= 4 * shape[0]*shape[1]:
+        area /= 4
+        nlevels += 1
+    if nlevels == 0:
+        return frame, corners, False
+    pad = 2 << nlevels
+    x0 = max(int(x.min()) - pad, 0)
+    y0 = max(int(y.min()) - pad, 0)
+    frame = frame[y0:int(np.ceil(y.max())) + pad,
+                  x0:int(np.ceil(x.max())) + pad]
+    corners = corners - np.array([x0, y0], dtype=np.float32)
+    for _ in xrange(nlevels):
+        frame = cv2.pyrDown(frame)
+        corners /= 2
+    return frame, corners, True
+
+
+class DecodeResult(object):
+    '''The decoded fragments of one frame.
+
+    `data` holds a row of fragment bytes for each subchannel, of which those
+    marked in `valid` were decoded. `nerrors` holds the number of corrected
+    bytes per subchannel (-1 where decoding failed). Debug information and
+    any other fields are kept in the dict `info`.
+
+    Results can also be read and updated like a dict. result['fragments']
+    lists the fragments, with None for the failed subchannels.'''
+    __slots__ = ('data', 'valid', 'nerrors', 'frame', 'subchannels',
+                 'nsubchannels', 'info')
+    _fields = ('frame', 'subchannels', 'nsubchannels')
+
+    def __init__(self, data, nerrors):
+        self.data = data
+        self.nerrors = nerrors
+        self.valid = nerrors >= 0
+        self.frame = self.subchannels = self.nsubchannels = None
+        self.info = None
+
+    @property
+    def fragments(self):
+        return [f if valid else None for f, valid in zip(self.data,
+                                                         self.valid)]
+
+    def __getitem__(self, key):
+        if self.info is not None and key in self.info:
+            return self.info[key]
+        if key == 'fragments':
+            return self.fragments
+        if key in self._fields and getattr(self, key) is not None:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._fields:
+            setattr(self, key, value)
+        else:
+            if self.info is None:
+                self.info = dict()
+            self.info[key] = value
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        keys = ['fragments'] + [key for key in self._fields
+                                if getattr(self, key) is not None]
+        return keys + self.info.keys() if self.info is not None else keys
+
+    def update(self, items):
+        for key, value in items.iteritems():
+            self[key] = value
+
+    def __getstate__(self):
+        # Only send the decoded fragments and a packed validity mask
+        return (self.data[self.valid], np.packbits(self.valid),
+                len(self.valid), self.nerrors.astype(np.int8), self.frame,
+                self.subchannels, self.nsubchannels, self.info)
+
+    def __setstate__(self, state):
+        decoded, packed, nsubchannels, self.nerrors, self.frame, \
+            self.subchannels, self.nsubchannels, self.info = state
+        self.valid = np.unpackbits(packed)[:nsubchannels].astype(np.bool)
+        self.data = np.zeros((nsubchannels, decoded.shape[1]),
+                             dtype=np.uint8)
+        self.data[self.valid] = decoded
+
+
 class Receiver(object):
-    def __init__(self, nsubchannels, nelements_per_subchannel=(64+16)*4,
+    def __init__(self, nsubchannels, nelements_per_subchannel=None,
                  parity=16, shape=(512, 512), border=0.15, cyclic_prefix=8,
-                 use_hints=True, calibration_profile=None):
-        self.rs = rscode.RSCode(parity)
-        self.qpsk = focus.modulation.QPSK()
-        self.idxs = focus.spectrum.subchannel_idxs(nsubchannels,
-                                                   nelements_per_subchannel,
-                                                   shape)
+                 use_hints=True, calibration_profile=None, max_erasures=8,
+                 erasure_threshold=0.5, combine=0, combine_threshold=0.3,
+                 npilots=0, modulation='qpsk', slm=1, detect=False,
+                 detect_threshold=0.5, detect_run=2, reduce_extraction=True):
+        # Parity may differ between subchannels (see
+        # focus.link.parity_profile()), and so may their numbers of elements.
+        self.parity = focus.link.parity_profile(parity, nsubchannels)
+        codes = {p: rscode.RSCode(p) for p in set(self.parity)}
+        self.rs = [codes[p] for p in self.parity]
+        # When a fragment fails to decode, retry with up to `max_erasures`
+        # bytes marked as erasures, if their reliability is below
+        # `erasure_threshold`. With more erasures than half the parity
+        # length, RS decoding frequently returns wrong fragments. Without
+        # erasure support in the RS code, failed fragments are not retried.
+        if not supports_erasures(self.rs[0]):
+            max_erasures = 0
+        self.max_erasures = max_erasures
+        self.erasure_threshold = erasure_threshold
+        self.modulation = focus.modulation.get(modulation)
+        if nelements_per_subchannel is None:
+            nelements_per_subchannel = [self.modulation.nsymbols(64+p)
+                                        for p in self.parity]
+        elif np.isscalar(nelements_per_subchannel):
+            nelements_per_subchannel = \
+                [nelements_per_subchannel] * nsubchannels
+        # Length of the coded fragment of each subchannel
+        self.coded_sizes = [self.modulation.nbytes(n)
+                            for n in nelements_per_subchannel]
+        fragment_sizes = set(c - p for c, p in zip(self.coded_sizes,
+                                                   self.parity))
+        if len(fragment_sizes) != 1:
+            raise ValueError('Subchannels must carry fragments of the same '
+                             'size.')
+        self.fragment_size = fragment_sizes.pop()
+        if len(set(nelements_per_subchannel)) > 1 and \
+           (npilots > 0 or slm > 1 or detect):
+            raise ValueError('Pilots, selective mapping and detecting the '
+                             'number of subchannels require the same parity '
+                             'on all subchannels.')
+        self.idxs, pilot_idx, signal_idx = focus.spectrum.layout(
+            nsubchannels, nelements_per_subchannel, shape, npilots,
+            focus.papr.nsignal(slm))
+        self.shape = shape
         self.shape_with_cp = tuple(np.array(shape) + 2*cyclic_prefix)
 
         self.framer = imageframer.Framer(self.shape_with_cp, border,
                                          calibration_profile=calibration_profile)
         self.cyclic_prefix = cyclic_prefix
         # Crop indices
-        self.spectrum_bbox = focus.spectrum.get_bbox(self.idxs)
+        self.spectrum_bbox = focus.spectrum.get_bbox(
+            np.vstack((self.idxs, pilot_idx[np.newaxis],
+                       signal_idx[np.newaxis])))
+        # Extract codes at the smallest resolution that holds the spectrum
+        # in use. The cropped spectrum, and so all indices into it, is the
+        # same as at full resolution.
+        if reduce_extraction:
+            self.extract_shape, self.extract_cp = \
+                focus.spectrum.reduced_shape(shape, cyclic_prefix,
+                                             self.spectrum_bbox)
+        else:
+            self.extract_shape, self.extract_cp = shape, cyclic_prefix
+        self.extract_shape_with_cp = tuple(np.array(self.extract_shape) +
+                                           2*self.extract_cp)
         cropped_idxs = tuple(focus.spectrum.crop(i, *self.spectrum_bbox)
                              for i in self.idxs)
         self.idxs = np.array(cropped_idxs)
+        if npilots > 0:
+            pilot_idx = focus.spectrum.crop(pilot_idx, *self.spectrum_bbox)
+            self.equalizer = focus.equalization.PilotEqualizer(
+                pilot_idx, self.idxs, self.spectrum_bbox)
+        else:
+            self.equalizer = None
+        # Selective mapping (see focus.papr)
+        self.slm = slm
+        if slm > 1:
+            signal_idx = focus.spectrum.crop(signal_idx, *self.spectrum_bbox)
+            self.slm_masks = focus.papr.masks(
+                slm, (nsubchannels, nelements_per_subchannel[0]))
+            self.signal_flat_idx = np.flatnonzero(signal_idx)
+            v, u = focus.equalization.frequencies(*self.spectrum_bbox)
+            self.signal_v, self.signal_u = v[signal_idx], u[signal_idx]
+
+        # Subchannel selection -> bbox and flat indices (see selection())
+        self.selections = dict()
+
+        # Detect how many of the `nsubchannels` subchannels are in use (see
+        # detect_nsubchannels()). This relies on subchannel i occupying the
+        # same elements for any number of subchannels, which pilots and
+        # signalling elements would break.
+        if detect and (npilots > 0 or slm > 1):
+            raise ValueError('Cannot detect the number of subchannels with '
+                             'pilots or selective mapping.')
+        self.detect = detect
+        self.detect_threshold = detect_threshold
+        self.detect_run = detect_run
+        self.nsubchannels_detected = None
 
         if use_hints:
             self.hints = list()
         else:
             self.hints = None
 
-    def decode(self, frame, debug=False, copy_frame=True):
-        # Locate
-        try:
-            corners = self.framer.locate(frame, hints=self.hints)
-        except ValueError as ve:
-#            sys.stderr.write('WARNING: {}\n'.format(ve))
-            result = {'fragments': []}
-            if debug:
-                result['status'] = 'notfound'
-                result['locator-message'] = str(ve)
-            return result
-        if copy_frame:
+        # Symbols and fragments of the last `combine` frames, for retrying
+        # failed subchannels (see combine()).
+        if combine > 0:
+            self.history = collections.deque(maxlen=combine)
+        else:
+            self.history = None
+        self.combine_threshold = combine_threshold
+
+    def extract(self, frame, copy_frame=True, grayscale=True):
+        '''Locate the code in `frame` and return it without cyclic prefix.
+
+        Returns a (code, corners) tuple. Raises ValueError if the code
+        cannot be located. With `grayscale` False, all color planes of the
+        code are extracted (see focus.color).
+
+        The code is extracted at the reduced resolution `extract_shape` if
+        the spectrum in use allows. Codes that are much larger in the frame
+        are first scaled down with a low-pass filter, to avoid aliasing.
+
+        The frame is modified in place unless `copy_frame` is True. Read-only
+        frames, e.g., from np.frombuffer() or a frame store, are always
+        copied.'''
+        corners = self.framer.locate(frame, hints=self.hints)
+        if grayscale:
+            frame = _grayscale(frame)
+        extract_corners, hints = corners, self.hints
+        if self.extract_shape != self.shape:
+            frame, extract_corners, shrunk = _shrink(
+                frame, corners, self.extract_shape_with_cp)
+            if shrunk:
+                # The hints refer to the original frame
+                hints = None
+                copy_frame = False
+        if copy_frame or not frame.flags.writeable:
             frame = frame.copy()
-        code = self.framer.extract(_grayscale(frame), self.shape_with_cp,
-                                   corners, hints=self.hints)
-        code = focus.phy.strip_cyclic_prefix(code, self.cyclic_prefix)
-
-        # Compute, crop and unload spectrum
-        spectrum = focus.phy.rx(code)
-        # -> complex64 makes angle() faster.
-        spectrum = spectrum.astype(np.complex64)
-        spectrum = focus.spectrum.crop(spectrum, *self.spectrum_bbox)
-        # Unload symbols from the spectrum
-        symbols = focus.spectrum.unload(spectrum, self.idxs)
+        code = self.framer.extract(frame, self.extract_shape_with_cp,
+                                   extract_corners, hints=hints)
+        code = focus.phy.strip_cyclic_prefix(code, self.extract_cp)
+        return code, corners
+
+    def selection(self, subchannels=None):
+        '''Return the indices, bbox and flat spectrum indices of a selection.
+
+        The flat indices address the elements of the selected subchannels in
+        the spectrum cropped to the bbox, in the order in which
+        focus.spectrum.unload() returns them. Subchannels with fewer
+        elements than others are padded; the last returned value marks the
+        padding (None if there is none).'''
+        key = None if subchannels is None else tuple(subchannels)
+        if key not in self.selections:
+            if key is None:
+                channel_idxs = range(len(self.idxs))
+            else:
+                channel_idxs = list(key)
+                if len(channel_idxs) == 0 or \
+                   min(channel_idxs) < 0 or max(channel_idxs) >= len(self.idxs):
+                    raise ValueError('Invalid subchannel selection '
+                                     '{}.'.format(key))
+            v, u = focus.equalization.frequencies(*self.spectrum_bbox)
+            v = [v[self.idxs[i]] for i in channel_idxs]
+            u = [u[self.idxs[i]] for i in channel_idxs]
+            nelements = max(len(x) for x in v)
+            padding = np.array([np.arange(nelements) >= len(x) for x in v])
+            v = np.array([np.resize(x, nelements) for x in v])
+            u = np.array([np.resize(x, nelements) for x in u])
+            if self.equalizer is not None or self.slm > 1:
+                # Pilots and signalling elements are spread over the whole
+                # halfring
+                bbox = self.spectrum_bbox
+            else:
+                bbox = (max(v.max()+1, -v.min()), u.max()+1)
+            rows = np.where(v < 0, v + 2*bbox[0], v)
+            self.selections[key] = (channel_idxs, bbox, rows*bbox[1] + u,
+                                    padding if padding.any() else None)
+        return self.selections[key]
+
+    def decode_code(self, code, debug=False, subchannels=None):
+        '''Decode an extracted code (as returned by extract()).
+
+        If `subchannels` is given, only these subchannels are decoded and
+        only the part of the spectrum that holds them is computed. The
+        fragments are returned in the order of `subchannels`. Only
+        decoding all subchannels combines captures (see combine()).'''
+        return self.decode_codes([code], debug, subchannels)[0]
+
+    def decode_codes(self, codes, debug=False, subchannels=None):
+        '''Decode a list of extracted codes in one batch.
+
+        Gathers the symbols of all codes into one array, so that
+        demodulation and RS decoding each run once for the whole batch.'''
+        detect = self.detect and subchannels is None
+        channel_idxs = None
+        if detect and self.nsubchannels_detected is not None:
+            # Only look a few subchannels beyond the detected ones
+            channel_idxs, symbols = self.gather(codes, range(min(
+                self.nsubchannels_detected + self.detect_run,
+                len(self.idxs))))
+            counts = self.detect_nsubchannels(symbols)
+            if self.nsubchannels_detected is None:
+                # More subchannels are in use than were examined
+                channel_idxs = None
+        if channel_idxs is None:
+            channel_idxs, symbols = self.gather(codes, subchannels)
+            if detect:
+                counts = self.detect_nsubchannels(symbols)
+        nchannels = len(channel_idxs)
+        if not detect:
+            counts = [nchannels] * len(codes)
+        # Only RS decode the subchannels in use
+        rows = np.concatenate([i*nchannels + np.arange(count)
+                               for i, count in enumerate(counts)])
+        data, nerrors, coded_fragments, reliability = self.decode_symbols(
+            symbols.reshape((-1, symbols.shape[-1]))[rows],
+            [channel_idxs[j] for j in rows % nchannels])
+
+        results = list()
+        offsets = np.cumsum([0] + counts)
+        for i in xrange(len(codes)):
+            code_slice = slice(offsets[i], offsets[i+1])
+            result = DecodeResult(data[code_slice], nerrors[code_slice])
+            # Combine in order, as if the codes were decoded one by one
+            combined = list()
+            if self.history is not None and subchannels is None and \
+               not detect:
+                combined = self.combine(symbols[i], result)
+                self.history.append((symbols[i], result.data, result.valid))
+
+            if subchannels is not None:
+                result.subchannels = channel_idxs
+            if detect:
+                result.nsubchannels = counts[i]
+            if debug:
+                result.update({'coded_fragments': coded_fragments[code_slice],
+                               'reliability': reliability[code_slice],
+                               'symbols': symbols[i],
+                               'combined': combined})
+            results.append(result)
+        return results
+
+    def gather(self, codes, subchannels=None):
+        '''Return the indices and symbols of the selected subchannels.'''
+        channel_idxs, bbox, flat_idxs, padding = self.selection(subchannels)
+        # Compute the cropped spectra; complex64 makes demodulation faster.
+        # (A single batched FFT is slower than one FFT per code.)
+        spectra = np.empty((len(codes), 2*bbox[0], bbox[1]),
+                           dtype=np.complex64)
+        for spectrum, code in zip(spectra, codes):
+            spectrum[:] = focus.fft.rfft2_crop(code, *bbox)
+            if code.shape != self.shape:
+                # Reduced codes have fewer pixels (see extract())
+                spectrum *= float(self.shape[0] * self.shape[1]) / code.size
+        # Gather the symbols of all codes and subchannels at once
+        symbols = np.take(spectra.reshape((len(codes), -1)), flat_idxs,
+                          axis=1)
+        if padding is not None:
+            # Demodulation ignores NaN symbols
+            symbols[:, padding] = np.nan
+        if self.equalizer is not None or self.slm > 1:
+            for i, spectrum in enumerate(spectra):
+                symbols[i] = self.correct(spectrum, symbols[i], channel_idxs)
+        return channel_idxs, symbols
+
+    def detect_nsubchannels(self, symbols):
+        '''Count the subchannels in use in each code.
+
+        Subchannels are filled from the center of the halfring outwards, so
+        the subchannels in use are those before the first run of
+        `detect_run` subchannels whose symbols look like noise. `symbols`
+        holds the symbols of the first subchannels of each code. Remembers
+        the largest count for the following codes, or forgets it if the
+        codes seem to use more subchannels than were examined.'''
+        noise = self.modulation.regularity(symbols) < self.detect_threshold
+        counts = list()
+        for code_noise in noise:
+            count = len(code_noise)
+            for i in xrange(len(code_noise)):
+                if np.all(code_noise[i:i+self.detect_run]):
+                    count = i
+                    break
+            counts.append(count)
+        nexamined = noise.shape[1]
+        if max(counts) == nexamined and nexamined < len(self.idxs):
+            self.nsubchannels_detected = None
+        elif max(counts) > 0:
+            self.nsubchannels_detected = max(counts)
+        return counts
 
+    def correct(self, spectrum, symbols, channel_idxs):
+        '''Equalize `symbols` and remove the selective mapping mask.'''
+        params = None
+        if self.equalizer is not None:
+            params = self.equalizer.estimate(spectrum)
+            symbols = self.equalizer.equalize(spectrum, symbols, channel_idxs,
+                                              params)
+        if self.slm > 1:
+            signal = np.take(spectrum, self.signal_flat_idx)
+            if params is not None:
+                signal = self.equalizer.correct(signal, self.signal_v,
+                                                self.signal_u, params)
+            slm_index = focus.papr.decode_index(signal, self.slm)
+            symbols = symbols * \
+                np.conj(self.slm_masks[slm_index][channel_idxs])
+        return symbols
+
+    def decode_symbols(self, symbols, channel_idxs=None):
+        '''Demodulate and RS-decode the symbols of the given subchannels.
+
+        `symbols` holds one row of symbols per subchannel in
+        `channel_idxs` (default: all subchannels). Returns the fragments,
+        the number of corrected bytes per fragment (-1 where decoding
+        failed), the coded fragments and their reliability.'''
+        if channel_idxs is None:
+            channel_idxs = xrange(len(symbols))
         # Modulate all symbols with one call to demodulate()
-        coded_fragments = self.qpsk.demodulate(np.array(symbols).T).T
+        coded_fragments, reliability = \
+            self.modulation.demodulate(symbols.T, reliability=True)
         # Make array contiguous, so we can pass it to rs.decode()
-        coded_fragments = np.ascontiguousarray(coded_fragments)
+        coded_fragments = np.ascontiguousarray(coded_fragments.T)
+        reliability = reliability.T
 
         # Recover and unmask all fragments
-        fragments = list()
-        for channel_idx, coded_frag in enumerate(coded_fragments):
-            nerrors, fragment = self.rs.decode(coded_frag)
-            if nerrors < 0:
-                # Recovery failed
-                fragment = None
-            else:
+        fragments = np.zeros((len(coded_fragments), self.fragment_size),
+                             dtype=np.uint8)
+        nerrors = np.empty(len(coded_fragments), dtype=np.int)
+        for i, (channel_idx, coded_frag, rel) in enumerate(
+                zip(channel_idxs, coded_fragments, reliability)):
+            rs = self.rs[channel_idx]
+            # Drop the padding of subchannels with fewer elements
+            coded_frag = coded_frag[:self.coded_sizes[channel_idx]]
+            nerrors[i], fragment = rs.decode(coded_frag)
+            if nerrors[i] < 0:
+                nerrors[i], fragment = self.decode_erasures(coded_frag, rel,
+                                                            rs)
+            if nerrors[i] >= 0:
                 focus.link.mask_fragments(fragment, channel_idx)
-            fragments.append(fragment)
+                fragments[i] = fragment
+        return fragments, nerrors, coded_fragments, reliability
+
+    def combine(self, symbols, result):
+        '''Retry failed subchannels by combining them with recent frames.
+
+        The camera often captures the same code in consecutive frames. A
+        previous frame shows the same code if all subchannels decoded in
+        both frames carry the same fragments; without such subchannels,
+        the symbols of a subchannel must be correlated. The phase-aligned
+        symbols of all matching captures are averaged and decoded again.
+        Updates `result` (a DecodeResult) in-place and returns the indices
+        of the recovered subchannels.'''
+        failed = np.flatnonzero(~result.valid)
+        if len(failed) == 0 or len(self.history) == 0:
+            return list()
+
+        def normalize(s):
+            s = np.nan_to_num(s)
+            power = np.sqrt(np.sum(np.abs(s)**2, axis=1, keepdims=True))
+            return s / np.maximum(power, 1e-12)
+
+        acc = normalize(symbols[failed])
+        ncaptures = np.ones(len(failed), dtype=np.int)
+        for prev_symbols, prev_data, prev_valid in self.history:
+            both = result.valid & prev_valid
+            prev = normalize(prev_symbols[failed])
+            # Phase of the correlation between the captures
+            corr = np.sum(acc * np.conj(prev), axis=1)
+            if np.any(both):
+                if np.any(result.data[both] != prev_data[both]):
+                    continue
+                match = np.ones(len(failed), dtype=np.bool)
+            else:
+                match = np.abs(corr) / ncaptures > self.combine_threshold
+            rotation = corr / np.maximum(np.abs(corr), 1e-12)
+            acc[match] += prev[match] * rotation[match, np.newaxis]
+            ncaptures[match] += 1
+
+        retry = np.flatnonzero(ncaptures > 1)
+        if len(retry) == 0:
+            return list()
+        channel_idxs = failed[retry]
+        recovered, nerrors, _, _ = self.decode_symbols(acc[retry],
+                                                       channel_idxs)
+        ok = nerrors >= 0
+        combined = channel_idxs[ok]
+        result.data[combined] = recovered[ok]
+        result.nerrors[combined] = nerrors[ok]
+        result.valid[combined] = True
+        return combined.tolist()
+
+    def decode_erasures(self, coded_frag, reliability, rs):
+        '''Retry RS decoding with the least reliable bytes as erasures.
+
+        RS decoding can correct twice as many erasures as errors at unknown
+        positions. Tries increasing numbers of erasures, in steps of a
+        quarter of the parity length.'''
+        max_erasures = min(self.max_erasures, rs.parity_len/2)
+        if max_erasures == 0:
+            return -1, None
+        reliability = reliability[:len(coded_frag)]
+        unreliable = np.argsort(reliability)[:max_erasures]
+        unreliable = unreliable[reliability[unreliable] <
+                                self.erasure_threshold]
+        step = max(1, rs.parity_len / 4)
+        for nerasures in xrange(step, len(unreliable)+step, step):
+            erasures = sorted(unreliable[:nerasures].tolist())
+            nerrors, fragment = rs.decode(coded_frag, erasures=erasures)
+            if nerrors >= 0:
+                return nerrors, fragment
+        return -1, None
+
+    def decode(self, frame, debug=False, copy_frame=True, subchannels=None):
+        return self.decode_many([frame], debug, copy_frame, subchannels)[0]
+
+    def decode_many(self, frames, debug=False, copy_frame=True,
+                    subchannels=None, batch_size=64):
+        '''Decode a batch of frames.
+
+        The result for each frame is identical to that of decode(), but
+        the codes of up to `batch_size` frames are decoded together (see
+        decode_codes()). Only one such batch is held in memory.'''
+        results = list()
+        for batch in focus.util.take_n(frames, batch_size):
+            results.extend(self.decode_extracted(
+                self.extract_many(batch, copy_frame), debug, subchannels))
+        return tuple(results)
+
+    def extract_many(self, frames, copy_frame=True):
+        '''Extract the codes of a batch of frames.
+
+        Returns a (code, corners) tuple for each frame, or a (None, message)
+        tuple if the code was not found.'''
+        extracted = list()
+        for frame in frames:
+            try:
+                extracted.append(self.extract(frame, copy_frame=copy_frame))
+            except ValueError as ve:
+                extracted.append((None, str(ve)))
+        return extracted
+
+    def decode_extracted(self, extracted, debug=False, subchannels=None):
+        '''Decode the output of extract_many().'''
+        results = list()
+        codes = list()
+        found = list()
+        for code, corners in extracted:
+            if code is None:
+                result = DecodeResult(
+                    np.zeros((0, self.fragment_size), dtype=np.uint8),
+                    np.zeros(0, dtype=np.int))
+                if debug:
+                    result['status'] = 'notfound'
+                    result['locator-message'] = corners
+                results.append(result)
+                continue
+            codes.append(code)
+            found.append((len(results), corners))
+            results.append(None)
+
+        if len(codes) > 0:
+            decoded = self.decode_codes(codes, debug, subchannels)
+            for (i, corners), result in zip(found, decoded):
+                if debug:
+                    result.update({'corners': corners,
+                                   'status': 'found'})
+                results[i] = result
+        return tuple(results)
+
+
+def test_decode_result():
+    data = np.random.randint(0, 255, (5, 64)).astype(np.uint8)
+    result = DecodeResult(data, np.array([0, -1, 3, -1, 1]))
+    result['frame'] = 7
+    result['status'] = 'found'
+    copy = pickle.loads(pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL))
+    for r in (result, copy):
+        fragments = r['fragments']
+        if r.frame != 7 or r.get('status') != 'found' or \
+           [f is None for f in fragments] != [False, True, False, True, False] \
+           or not np.all(np.array(fragments[::2]) == data[::2]):
+            raise RuntimeError('test_decode_result: Unexpected result.')
+
+
+def test_decode_subchannels(nsubchannels=16, shape=(512, 512)):
+    data = np.random.randint(0, 255, 64*nsubchannels).astype(np.uint8)
+    transmitter = focus.transmitter.Transmitter(nsubchannels, shape=shape)
+    frame = transmitter.encode(data.copy())
+    data = data.reshape((nsubchannels, -1))
+
+    receiver = Receiver(nsubchannels, shape=shape, use_hints=False)
+    for subchannels in ([0], [nsubchannels-1, 3], range(nsubchannels)):
+        fragments = receiver.decode(frame, subchannels=subchannels)
+        if not np.all(np.array(fragments['fragments']) == data[subchannels]):
+            raise RuntimeError('test_decode_subchannels: Fragments of '
+                               'subchannels {} do not match.'.format(
+                                   subchannels))
 
-        result = {'fragments': fragments}
-        if debug:
-            result.update({'coded_fragments': coded_fragments,
-                           'symbols': symbols,
-                           'corners': corners,
-                           'status': 'found'})
-        return result
 
-    def decode_many(self, frames, debug=False):
-        return tuple(self.decode(frame, debug=debug) for frame in frames)
+class _PlainRSCode(object):
+    '''An RS code with the interface of the rscode package, which decodes
+    without erasure positions.'''
 
+    def __init__(self, parity):
+        self.rs = rscode.RSCode(parity)
+        self.parity_len = self.rs.parity_len
+
+    def encode(self, data):
+        return self.rs.encode(data)
+
+    def decode(self, data):
+        return self.rs.decode(data)
+
+
+def test_decode_erasures(parity=16):
+    data = np.random.randint(0, 256, 64).astype(np.uint8)
+    # The installed RS code, and one without erasure support
+    for codec in (rscode.RSCode, _PlainRSCode):
+        rs = codec(parity)
+        receiver = Receiver(1, parity=parity, use_hints=False)
+        if codec is _PlainRSCode:
+            # As the constructor does for such codes
+            receiver.rs = [rs]
+            receiver.max_erasures = 0
+        # More errors than RS decoding corrects without erasures
+        coded = rs.encode(data)
+        errors = np.arange(0, 2*(parity//2 + 2), 2)
+        coded[errors] ^= 0xff
+        reliability = np.ones(len(coded))
+        reliability[errors] = 0.
+        nerrors, fragment = receiver.decode_erasures(coded, reliability, rs)
+        if supports_erasures(rs) and (nerrors < 0 or
+                                      not np.all(fragment == data)):
+            raise RuntimeError('test_decode_erasures: Erasures were not '
+                               'corrected.')
+        if not supports_erasures(rs) and nerrors >= 0:
+            raise RuntimeError('test_decode_erasures: Decoded without '
+                               'erasures.')
+
+
+def test_combine(nsubchannels=16, shape=(256, 256), noise=30.):
+    import focus.tune
+    data = np.random.randint(0, 255, 64*nsubchannels).astype(np.uint8)
+    transmitter = focus.transmitter.Transmitter(nsubchannels, shape=shape)
+    frame = np.pad(transmitter.encode(data.copy()), 32, 'constant',
+                   constant_values=255)
+    data = data.reshape((nsubchannels, -1))
+    # Two noisy captures of the same code
+    frames = [focus.tune.impair(frame, 1., noise) for _ in xrange(2)]
+
+    single = Receiver(nsubchannels, shape=shape).decode(frames[1])
+    receiver = Receiver(nsubchannels, shape=shape, combine=1)
+    result = receiver.decode_many(frames, debug=True)[1]
+    recovered = [i for i in result['combined'] if not single.valid[i]]
+    if len(recovered) == 0 or not np.all(result.valid[recovered]) or \
+       not np.all(result.data[result.valid] == data[result.valid]):
+        raise RuntimeError('test_combine: No failed subchannel was '
+                           'recovered.')
+
+
+def test_decode_batches(nsubchannels=8, shape=(256, 256), nframes=70):
+    import focus.tune
+    frames = focus.tune.synthetic_frames(nsubchannels, shape, nframes,
+                                         blur=1., noise=25.)
+    # A frame without a code
+    frames[5] = np.zeros_like(frames[5])
+    single = Receiver(nsubchannels, shape=shape)
+    expected = [single.decode(frame) for frame in frames]
+    # Two full batches and a partial one, and one batch with a partial one
+    for batch_size in (32, 64):
+        results = Receiver(nsubchannels, shape=shape).decode_many(
+            iter(frames), batch_size=batch_size)
+        if len(results) != nframes or \
+           any(not np.array_equal(r.nerrors, e.nerrors) or
+               not np.array_equal(r.data, e.data)
+               for r, e in zip(results, expected)):
+            raise RuntimeError('test_decode_batches: Results differ from '
+                               'decoding frame by frame (batch size '
+                               '{}).'.format(batch_size))
+    if all(np.all(e.valid) for e in expected):
+        raise RuntimeError('test_decode_batches: Frames too clean.')
+
+
+def test_read_only_frame(nsubchannels=4, shape=(256, 256)):
+    data = np.random.randint(0, 255, 64*nsubchannels).astype(np.uint8)
+    transmitter = focus.transmitter.Transmitter(nsubchannels, shape=shape)
+    frame = np.pad(transmitter.encode(data.copy()), 32, 'constant',
+                   constant_values=255)
+    frame = np.frombuffer(frame.tostring(), dtype=np.uint8).reshape(
+        frame.shape)
+    receiver = Receiver(nsubchannels, shape=shape,
+                        reduce_extraction=False)
+    extract = receiver.framer.extract
 
-def benchmark(frames='frames.pickle'):
+    def normalize_and_extract(frame, *args, **kwargs):
+        # Like a locator that normalizes the frame in place
+        frame[...] = frame
+        return extract(frame, *args, **kwargs)
+    receiver.framer.extract = normalize_and_extract
+    result = receiver.decode(frame, copy_frame=False)
+    if not np.all(result.valid) or \
+       not np.all(result.data == data.reshape((nsubchannels, -1))):
+        raise RuntimeError('test_read_only_frame: Fragments do not match.')
+
+
+def test_detect_nsubchannels(nsubchannels=6, shape=(512, 512)):
+    receiver = Receiver(4*nsubchannels, shape=shape, use_hints=False,
+                        detect=True)
+    for n in (nsubchannels, 2*nsubchannels, nsubchannels):
+        data = np.random.randint(0, 255, 64*n).astype(np.uint8)
+        transmitter = focus.transmitter.Transmitter(n, shape=shape)
+        frame = transmitter.encode(data.copy())
+        # Twice, to decode once with the remembered number of subchannels
+        for _ in xrange(2):
+            fragments = receiver.decode(frame)['fragments']
+            if len(fragments) != n or \
+               not np.all(np.array(fragments) == data.reshape((n, -1))):
+                raise RuntimeError('test_detect_nsubchannels: Did not decode '
+                                   '{} subchannels.'.format(n))
+
+
+def test_reduced_extraction(nsubchannels=8, shape=(512, 512)):
+    import focus.tune
+    frames = focus.tune.synthetic_frames(nsubchannels, shape, 2, scale=1.5)
+    recv = Receiver(nsubchannels, shape=shape)
+    full = Receiver(nsubchannels, shape=shape, reduce_extraction=False)
+    code, _ = recv.extract(frames[0])
+    if code.shape[0] >= shape[0] or code.shape != recv.extract_shape:
+        raise RuntimeError('test_reduced_extraction: Code was not reduced.')
+    for expected, result in zip(full.decode_many(frames),
+                                recv.decode_many(frames)):
+        if not np.all(result.valid) or \
+           not np.all(result.data == expected.data):
+            raise RuntimeError('test_reduced_extraction: Fragments do not '
+                               'match.')
+
+
+def benchmark(frames='frames.pickle', batch_size=64):
     import cProfile as profile
     import pstats
     if isinstance(frames, basestring):
@@ -109,30 +788,104 @@ def benchmark(frames='frames.pickle'):
     pr = profile.Profile()
     recv = Receiver(16)
     pr.enable()
-    recv.decode_many(frames)
+    recv.decode_many(frames, batch_size=batch_size)
     pr.disable()
     stats = pstats.Stats(pr).sort_stats(2)
     stats.print_stats()
 
 
+def benchmark_extraction(nsubchannels=(4, 16, 32), shape=(512, 512),
+                         nframes=20, blur=1.5, noise=6., scale=1.5):
+    '''Compare extraction at full and at reduced resolution.'''
+    import focus.tune
+
+    print '{:>12} {:>9} {:>18} {:>18}'.format('nsubchannels', 'extract',
+                                               'full ms/fragments',
+                                               'reduced ms/fragments')
+    for n in nsubchannels:
+        np.random.seed(1)
+        frames = focus.tune.synthetic_frames(n, shape, nframes, blur, noise,
+                                             scale)
+        row = list()
+        for reduce_extraction in (False, True):
+            recv = Receiver(n, shape=shape, reduce_extraction=reduce_extraction)
+            recv.decode_many(frames[:1])
+            start = time.time()
+            results = recv.decode_many(frames)
+            duration = time.time() - start
+            row.append('{:.1f}/{:.1f}%'.format(
+                1000. * duration / nframes,
+                100. * sum(r.valid.sum() for r in results) / (nframes*n)))
+        print '{:>12} {:>9} {:>18} {:>18}'.format(
+            n, '{}x{}'.format(*recv.extract_shape_with_cp[::-1]), *row)
+
+
 @click.command('receiver')
 @click.option('--nsubchannels', type=int, default=16)
 @click.option('--calibration-profile', type=str, default=None)
 @click.option('--shape', type=str, default='512x512')
 @click.option('--cyclic-prefix', type=int, default=8)
+@click.option('--max-erasures', type=int, default=8)
+@click.option('--parity', type=str, default='16')
+@click.option('--combine', type=int, default=0)
+@click.option('--npilots', type=int, default=0)
+@click.option('--modulation', type=str, default='qpsk')
+@click.option('--slm', type=int, default=1)
+@click.option('--detect/--no-detect', default=False)
+@click.option('--tiles', type=str, default='1x1')
+@click.option('--color/--no-color', default=False)
+@click.option('--crosstalk', type=str, default=None)
+@click.option('--reduce-extraction/--no-reduce-extraction', default=True)
 @click.option('--verbosity', type=int, default=0)
-def main(nsubchannels, calibration_profile, shape, cyclic_prefix, verbosity):
+@click.option('--profile', is_flag=True)
+@click.option('--stage', type=click.Choice(('all', 'extract', 'decode')),
+              default='all')
+def main(nsubchannels, calibration_profile, shape, cyclic_prefix, max_erasures,
+         parity, combine, npilots, modulation, slm, detect, tiles, color,
+         crosstalk, reduce_extraction, verbosity, profile, stage):
+    '''Decode pickled chunks of frames from stdin.
+
+    With --stage extract, only extract the codes (see extract_many()); with
+    --stage decode, decode chunks of extracted codes.'''
     shape = focus.util.parse_resolution(shape)
-    recv = Receiver(nsubchannels, calibration_profile=calibration_profile,
-                    shape=shape, cyclic_prefix=cyclic_prefix)
+    kwargs = dict()
+    if color:
+        kwargs['crosstalk'] = crosstalk
+    recv = focus.tiling.get_receiver(
+        nsubchannels, tiles, color, calibration_profile=calibration_profile,
+        shape=shape, cyclic_prefix=cyclic_prefix, max_erasures=max_erasures,
+        parity=parity, combine=combine, npilots=npilots,
+        modulation=modulation, slm=slm, detect=detect,
+        reduce_extraction=reduce_extraction, **kwargs)
     while True:
+        # Time receiving a chunk, not waiting for the parent to send one.
+        # The parent sends a chunk only after receiving the previous results
+        # (see focus.multiprocreceiver), so none is left in stdin's buffer.
+        select.select([sys.stdin], [], [])
+        receive_start = time.time()
         try:
             frames = pickle.load(sys.stdin)
         except EOFError:
             break
-        fragments = recv.decode_many(frames, debug=verbosity > 0)
-        pickle.dump(fragments, sys.stdout, protocol=pickle.HIGHEST_PROTOCOL)
+        decode_start = time.time()
+        if stage == 'extract':
+            results = recv.extract_many(frames)
+        elif stage == 'decode':
+            results = recv.decode_extracted(frames, debug=verbosity > 0)
+        else:
+            results = recv.decode_many(frames, debug=verbosity > 0)
+        decode_stop = time.time()
+        data = pickle.dumps(results, protocol=pickle.HIGHEST_PROTOCOL)
+        sys.stdout.write(data)
         sys.stdout.flush()
+        if profile:
+            # Timings of this chunk follow the results
+            timing = {'receive': (receive_start, decode_start),
+                      'decode': (decode_start, decode_stop),
+                      'send': (decode_stop, time.time()),
+                      'nbytes': len(data)}
+            pickle.dump(timing, sys.stdout, protocol=pickle.HIGHEST_PROTOCOL)
+            sys.stdout.flush()
 
 
 if __name__ == '__main__':
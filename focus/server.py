@@ -0,0 +1,336 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Decode server that keeps warm receivers behind a Unix domain socket.
+
+Every message is a 4-byte big-endian length followed by the payload. A
+request consists of two messages: a JSON header such as
+
+    {"nsubchannels": 16, "shape": [512, 512], "cyclic_prefix": 8,
+     "format": "raw", "resolution": [720, 1280]}
+
+and the frame, either PNG data ("format": "png") or the gray pixels of a
+frame of the given resolution ("format": "raw"). The response is a JSON
+header {"status": ..., "decoded": [...], "fragment_size": ...}, which lists
+the indices of the decoded subchannels, followed by a message with their
+fragments. Connections may send any number of requests.'''
+
+import collections
+import io
+import json
+import os
+import socket
+import SocketServer
+import struct
+import tempfile
+import threading
+import time
+
+import click
+import numpy as np
+import PIL.Image
+
+import focus
+
+MAX_MESSAGE = 64 << 20
+# Receiver configuration of a request, with default values
+CONFIG = (('nsubchannels', 16), ('shape', (512, 512)), ('cyclic_prefix', 8))
+
+
+def send_message(sock, payload):
+    sock.sendall(struct.pack('>I', len(payload)) + payload)
+
+
+def recv_exactly(sock, nbytes):
+    chunks = list()
+    while nbytes > 0:
+        chunk = sock.recv(min(nbytes, 1 << 20))
+        if len(chunk) == 0:
+            raise EOFError('Connection closed.')
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return ''.join(chunks)
+
+
+def recv_message(sock):
+    length, = struct.unpack('>I', recv_exactly(sock, 4))
+    if length > MAX_MESSAGE:
+        raise ValueError('Message of {} bytes is too large.'.format(length))
+    return recv_exactly(sock, length)
+
+
+def parse_config(header):
+    '''Return the receiver configuration of a request as a hashable key.'''
+    config = list()
+    for name, default in CONFIG:
+        value = header.get(name, default)
+        config.append(tuple(value) if isinstance(value, list) else value)
+    return tuple(config)
+
+
+def parse_frame(header, data):
+    frame_format = header.get('format', 'png')
+    if frame_format == 'png':
+        return np.array(PIL.Image.open(io.BytesIO(data)))
+    elif frame_format == 'raw':
+        height, width = header['resolution']
+        if len(data) != height*width:
+            raise ValueError('Raw frame has {} bytes, expected {}.'.format(
+                len(data), height*width))
+        return np.frombuffer(data, dtype=np.uint8).reshape((height, width))
+    raise ValueError('Unknown frame format {}.'.format(frame_format))
+
+
+class Request(object):
+    def __init__(self, frame):
+        self.frame = frame
+        self.result = None
+        self.done = threading.Event()
+
+
+class DecodeQueue(object):
+    '''Decodes the frames for one receiver configuration.
+
+    A single thread owns the receiver. It decodes all requests that arrived
+    while it was busy, up to `max_batch`, with one call to decode_many().'''
+
+    def __init__(self, config, max_batch=16):
+        nsubchannels, shape, cyclic_prefix = config
+        # Frames of different requests are unrelated, so hints from one frame
+        # would not help to locate the code in the next.
+        self.receiver = focus.receiver.Receiver(
+            nsubchannels, shape=shape, cyclic_prefix=cyclic_prefix,
+            use_hints=False)
+        self.max_batch = max_batch
+        self.pending = collections.deque()
+        self.cond = threading.Condition()
+        self.nbatches = 0
+        self.nframes = 0
+        thread = threading.Thread(target=self.run, name='decoder')
+        thread.daemon = True
+        thread.start()
+
+    def submit(self, frame):
+        '''Decode `frame`, waiting for the result.'''
+        request = Request(frame)
+        with self.cond:
+            self.pending.append(request)
+            self.cond.notify()
+        request.done.wait()
+        if isinstance(request.result, Exception):
+            raise request.result
+        return request.result
+
+    def run(self):
+        # Plan the FFTs now, not on the first request. The plans are cached
+        # per thread.
+        self.receiver.decode_codes([np.zeros(self.receiver.extract_shape)])
+        while True:
+            with self.cond:
+                while len(self.pending) == 0:
+                    self.cond.wait()
+                batch = [self.pending.popleft()
+                         for _ in xrange(min(len(self.pending),
+                                             self.max_batch))]
+            try:
+                results = self.receiver.decode_many(
+                    [request.frame for request in batch], copy_frame=False)
+            except Exception as e:
+                results = [e] * len(batch)
+            self.nbatches += 1
+            self.nframes += len(batch)
+            for request, result in zip(batch, results):
+                request.result = result
+                request.done.set()
+
+
+class ReceiverPool(object):
+    '''Creates one DecodeQueue per receiver configuration, on demand.'''
+
+    def __init__(self, max_batch=16):
+        self.max_batch = max_batch
+        self.queues = dict()
+        self.lock = threading.Lock()
+
+    def get(self, config):
+        with self.lock:
+            if config not in self.queues:
+                self.queues[config] = DecodeQueue(config, self.max_batch)
+            return self.queues[config]
+
+
+class Handler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                header = json.loads(recv_message(self.request))
+                data = recv_message(self.request)
+            except EOFError:
+                return
+            try:
+                queue = self.server.pool.get(parse_config(header))
+                result = queue.submit(parse_frame(header, data))
+            except Exception as e:
+                send_message(self.request, json.dumps(
+                    {'status': 'error', 'message': str(e)}))
+                send_message(self.request, '')
+                continue
+            response = {'status': 'found' if len(result.valid) else
+                        'notfound',
+                        'decoded': np.flatnonzero(result.valid).tolist(),
+                        'fragment_size': result.data.shape[1]}
+            send_message(self.request, json.dumps(response))
+            send_message(self.request, result.data[result.valid].tostring())
+
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, max_batch=16):
+        if os.path.exists(path):
+            # Remove the socket of a previous server
+            os.unlink(path)
+        SocketServer.UnixStreamServer.__init__(self, path, Handler)
+        self.pool = ReceiverPool(max_batch)
+
+
+def start_server(path, max_batch=16):
+    '''Serve from a background thread, and return the server.'''
+    server = Server(path, max_batch)
+    thread = threading.Thread(target=server.serve_forever, name='server')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+class Client(object):
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+
+    def decode(self, frame, nsubchannels=16, shape=(512, 512),
+               cyclic_prefix=8):
+        '''Decode `frame`, a 2D uint8 array or PNG data.
+
+        Returns a dict with the status and the fragments of all subchannels
+        (None for those that were not decoded).'''
+        header = {'nsubchannels': nsubchannels, 'shape': shape,
+                  'cyclic_prefix': cyclic_prefix}
+        if isinstance(frame, np.ndarray):
+            header.update({'format': 'raw', 'resolution': frame.shape})
+            data = np.ascontiguousarray(frame, dtype=np.uint8).tostring()
+        else:
+            header['format'] = 'png'
+            data = frame
+        send_message(self.sock, json.dumps(header))
+        send_message(self.sock, data)
+        response = json.loads(recv_message(self.sock))
+        data = recv_message(self.sock)
+        if response['status'] == 'error':
+            raise ValueError(response['message'])
+        fragments = [None] * nsubchannels
+        size = response['fragment_size']
+        for i, channel_idx in enumerate(response['decoded']):
+            fragments[channel_idx] = np.frombuffer(
+                data[i*size:(i+1)*size], dtype=np.uint8)
+        return {'status': response['status'], 'fragments': fragments}
+
+    def close(self):
+        self.sock.close()
+
+
+def _png(frame):
+    buf = io.BytesIO()
+    PIL.Image.fromarray(frame).save(buf, 'PNG')
+    return buf.getvalue()
+
+
+def test_server(nsubchannels=8, shape=(256, 256)):
+    data = np.random.randint(0, 255, 64*nsubchannels).astype(np.uint8)
+    transmitter = focus.transmitter.Transmitter(nsubchannels, shape=shape)
+    frame = transmitter.encode(data.copy())
+    data = data.reshape((nsubchannels, -1))
+
+    path = tempfile.mktemp(suffix='.sock')
+    server = start_server(path)
+    try:
+        client = Client(path)
+        for f in (frame, _png(frame)):
+            result = client.decode(f, nsubchannels, shape)
+            if not np.all(np.array(result['fragments']) == data):
+                raise RuntimeError('test_server: Fragments do not match.')
+        client.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.unlink(path)
+
+
+def benchmark(socket_path='', nclients=4, nrequests=50, nsubchannels=16,
+              png=False):
+    '''Measure request latency and throughput with concurrent clients.
+
+    Starts a server in this process unless `socket_path` is given.'''
+    shape = (512, 512)
+    data = np.random.randint(0, 255, 64*nsubchannels).astype(np.uint8)
+    frame = focus.transmitter.Transmitter(nsubchannels, shape=shape).encode(
+        data)
+    frame = np.pad(frame, frame.shape[0]/8, 'constant', constant_values=255)
+    if png:
+        frame = _png(frame)
+
+    server = None
+    if socket_path == '':
+        socket_path = tempfile.mktemp(suffix='.sock')
+        server = start_server(socket_path)
+    # Create the receiver before measuring
+    Client(socket_path).decode(frame, nsubchannels, shape)
+
+    latencies = list()
+
+    def run_client():
+        client = Client(socket_path)
+        for _ in xrange(nrequests):
+            start = time.time()
+            client.decode(frame, nsubchannels, shape)
+            latencies.append(time.time() - start)
+        client.close()
+
+    threads = [threading.Thread(target=run_client) for _ in xrange(nclients)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stop = time.time()
+
+    print 'Processed {} requests from {} clients'.format(len(latencies),
+                                                         nclients)
+    print 'Throughput: {:.2f} frames/s'.format(len(latencies) / (stop-start))
+    print ('Latency: p50={:.1f} ms, p90={:.1f} ms, p99={:.1f} ms').format(
+        *(1000. * np.percentile(latencies, (50, 90, 99))))
+    if server is not None:
+        for queue in server.pool.queues.itervalues():
+            print 'Mean batch size: {:.2f}'.format(
+                float(queue.nframes) / max(queue.nbatches, 1))
+        server.shutdown()
+        server.server_close()
+        os.unlink(socket_path)
+
+
+@click.command('serve')
+@click.option('--socket', 'path', type=str, default='/tmp/focus.sock')
+@click.option('--max-batch', type=int, default=16)
+def main(path, max_batch):
+    '''Decode frames sent over a Unix domain socket.'''
+    server = Server(path, max_batch)
+    print 'Listening on {}'.format(path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
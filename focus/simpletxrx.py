@@ -3,7 +3,11 @@
 # This file is part of FOCUS and is licensed under the 3-clause BSD license.
 # The full license can be found in the file COPYING.
 
-import itertools
+import base64
+import glob
+import json
+import multiprocessing
+import os
 import struct
 import sys
 
@@ -14,19 +18,35 @@ import PIL.Image
 import focus
 
 
-def pack_header(nfragments, payload_len):
-    return tuple(bytearray(struct.pack('!HH', nfragments, payload_len)))
+HEADER = struct.Struct('!HH')
+# Header of a code that carries one part of a larger payload: the index of
+# the code, with the high bit set to distinguish it from HEADER, the number
+# of codes, and the length of the whole payload.
+MULTI_HEADER = struct.Struct('!HHI')
+MULTI_FLAG = 0x8000
+
+
+def pack_header(nfragments, payload_len, code_idx=None, ncodes=None):
+    if code_idx is None:
+        return np.frombuffer(HEADER.pack(nfragments, payload_len),
+                             dtype=np.uint8)
+    return np.frombuffer(MULTI_HEADER.pack(MULTI_FLAG | code_idx, ncodes,
+                                           payload_len), dtype=np.uint8)
 
 
 def unpack_header(fragment):
-    return struct.unpack('!HH', fragment[:4].tostring())
+    '''Return (nfragments, payload_len) or, for a part of a multi-code
+    payload, (code_idx, ncodes, payload_len).'''
+    first, = struct.unpack('!H', fragment[:2].tostring())
+    if first & MULTI_FLAG:
+        code_idx, ncodes, payload_len = MULTI_HEADER.unpack(
+            fragment[:MULTI_HEADER.size].tostring())
+        return code_idx & ~MULTI_FLAG, ncodes, payload_len
+    return HEADER.unpack(fragment[:HEADER.size].tostring())
 
 
-def grouper(iterable, n, fillvalue=None):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
-    args = [iter(iterable)] * n
-    return itertools.izip_longest(fillvalue=fillvalue, *args)
+def header_size(header):
+    return MULTI_HEADER.size if len(header) == 3 else HEADER.size
 
 
 def get_nrequired_fragments(payload_len, fragment_size=64):
@@ -35,32 +55,68 @@ def get_nrequired_fragments(payload_len, fragment_size=64):
 
 
 def create_fragments(payload, header, nfragments, fragment_size=64):
-    if len(payload) == 0:
-        assert nfragments == 1
-        fragments = np.zeros((1, fragment_size), dtype=np.uint8)
-        fragments[0, :len(header)] = header
-        return fragments
-    else:
-        fragments = list()
-        for bytes in grouper(payload, fragment_size-len(header), 0):
-            fragments.append(header + bytes)
-        return np.array(fragments, dtype=np.uint8)
-
-
-def fragments_to_string(fragments, header_len, payload_len):
-    if len(fragments) == 0:
-        return ''
-    empty = 'X'*max(len(f) for f in fragments if f is not None)
-    res = ''
-    for frag in fragments:
-        if frag is None:
-            res += empty
-        else:
-            res += frag[header_len:].tostring()
-    return res[:payload_len]
+    '''Split `payload` into `nfragments` fragments, each preceded by `header`.
+    The last fragments are padded with zeros.'''
+    nbytes = fragment_size - len(header)
+    data = np.zeros(nfragments*nbytes, dtype=np.uint8)
+    data[:len(payload)] = np.frombuffer(str(payload), dtype=np.uint8)
+    fragments = np.empty((nfragments, fragment_size), dtype=np.uint8)
+    fragments[:, :len(header)] = header
+    fragments[:, len(header):] = data.reshape((nfragments, nbytes))
+    return fragments
+
+
+def create_codes(payload, nsubchannels, fragment_size=64):
+    '''Split `payload` across codes of `nsubchannels` fragments each.
+
+    Returns a list with one array of fragments per code.'''
+    nbytes = nsubchannels * (fragment_size - MULTI_HEADER.size)
+    ncodes = get_nrequired_fragments(len(payload), nbytes)
+    return [create_fragments(payload[i*nbytes:(i+1)*nbytes],
+                             pack_header(None, len(payload), i, ncodes),
+                             nsubchannels, fragment_size)
+            for i in xrange(ncodes)]
+
+
+def fragments_to_string(fragments, header_len, payload_len,
+                        fragment_size=64):
+    nbytes = fragment_size - header_len
+    # Missing fragments are represented by 'X's.
+    buf = bytearray('X') * (len(fragments) * nbytes)
+    for i, frag in enumerate(fragments):
+        if frag is not None:
+            buf[i*nbytes:(i+1)*nbytes] = frag[header_len:].tostring()
+    return str(buf[:payload_len])
+
+
+def reassemble(decoded, nsubchannels, fragment_size=64):
+    '''Reassemble a multi-code payload from decoded codes in any order.
+
+    Returns the payload, with 'X's for missing fragments, and the sorted
+    indices of the codes that were not decoded.'''
+    codes = dict()
+    for d in decoded:
+        if len(d['header']) == 3:
+            codes[d['header'][0]] = d
+    if len(codes) == 0:
+        return '', list()
+    _, ncodes, payload_len = codes.values()[0]['header']
+    nbytes = fragment_size - MULTI_HEADER.size
+    code_nbytes = nsubchannels * nbytes
+    buf = bytearray('X') * (ncodes * code_nbytes)
+    for code_idx, d in codes.iteritems():
+        if code_idx >= ncodes:
+            continue
+        for i, frag in enumerate(d['fragments'][:nsubchannels]):
+            if frag is not None:
+                offset = code_idx*code_nbytes + i*nbytes
+                buf[offset:offset+nbytes] = \
+                    frag[MULTI_HEADER.size:].tostring()
+    missing = sorted(set(xrange(ncodes)) - set(codes))
+    return str(buf[:payload_len]), missing
 
 
-def extract_header(fragments):
+def extract_header(fragments, verbose=True):
     headers = set()
 
     for fragment in fragments:
@@ -70,7 +126,9 @@ def extract_header(fragments):
     if len(headers) == 1:
         return tuple(headers)[0]
     else:
-        if len(headers) == 0:
+        if not verbose:
+            pass
+        elif len(headers) == 0:
             print 'Decoding failed.'
         elif len(headers) > 1:
             # XXX Depending on how commonly this situation occurs, we
@@ -80,8 +138,10 @@ def extract_header(fragments):
         return 0, 0
 
 
-def load_img(imgfile):
+def load_img(imgfile, color=False):
     img = np.array(PIL.Image.open(imgfile))
+    if color:
+        return img[:, :, :3]
     if len(img.shape) == 3:
         # Convert to grayscale by discarding red and blue
         img = img[:, :, 1]
@@ -97,45 +157,245 @@ def get_status(fragment_decoded):
     return status
 
 
-@click.command('simplerx')
-@click.option('--nsubchannels', type=int, default=32)
-@click.option('--shape', type=str, default='768x768')
-@click.argument('imgfile', type=click.File('rb'))
-def rx(imgfile, nsubchannels, shape):
-    recv = focus.receiver.Receiver(nsubchannels,
-                                   shape=focus.util.parse_resolution(shape))
-    print 'Receiver initialized'
-
-    frame = load_img(imgfile)
+def decode_image(recv, frame, verbose=True):
     decoded = recv.decode(frame, debug=True)
-    nfragments, payload_len = extract_header(decoded['fragments'])
-    decoded['fragments'] = decoded['fragments'][:nfragments]
-    decoded['payload_str'] = fragments_to_string(decoded['fragments'],
-                                                 4, payload_len)
+    header = extract_header(decoded['fragments'], verbose)
+    decoded['header'] = header
+    if len(header) == 3:
+        # Part of a multi-code payload, see reassemble()
+        decoded['payload_str'] = ''
+    else:
+        nfragments, payload_len = header
+        decoded['fragments'] = decoded['fragments'][:nfragments]
+        decoded['payload_str'] = fragments_to_string(
+            decoded['fragments'], header_size(header), payload_len)
     decoded['fragment_decoded'] = [f is not None for
                                    f in decoded['fragments']]
     decoded['ndecoded'] = sum(decoded['fragment_decoded'])
     if decoded['status'] == 'found':
         decoded['status'] = get_status(decoded['fragment_decoded'])
+    return decoded
 
-    if len(decoded['payload_str']) > 0:
-        print 'Payload: <<<{}>>>'.format(decoded['payload_str'])
-    print 'Status: {}'.format(decoded['status'])
-    print 'Number of decoded fragments: {}'.format(decoded['ndecoded'])
+
+@click.command('simplerx')
+@click.option('--nsubchannels', type=int, default=32)
+@click.option('--shape', type=str, default='768x768')
+@click.option('--modulation', type=str, default='qpsk')
+@click.option('--output', type=click.File('wb'), default=None,
+              help='Write the payload to this file instead of printing it.')
+@click.option('--color', is_flag=True,
+              help='Decode a code in each color plane.')
+@click.argument('imgfiles', nargs=-1, required=True, type=click.File('rb'))
+def rx(imgfiles, nsubchannels, shape, modulation, output, color):
+    '''Decode a code, or the codes of a multi-code payload in any order.'''
+    # PIL loads images as RGB
+    kwargs = {'bgr': False} if color else dict()
+    recv = focus.tiling.get_receiver(nsubchannels, color=color,
+                                     shape=focus.util.parse_resolution(shape),
+                                     modulation=modulation, **kwargs)
+    print 'Receiver initialized'
+
+    decoded = [decode_image(recv, load_img(imgfile, color), verbose=False)
+               for imgfile in imgfiles]
+    parts = [d for d in decoded if len(d['header']) == 3]
+    if len(parts) > 0:
+        nplanes = focus.color.NPLANES if color else 1
+        payload, missing = reassemble(parts, nplanes*nsubchannels)
+        status = get_status([d['ndecoded'] > 0 for d in parts] +
+                            [False] * len(missing))
+        ndecoded = sum(d['ndecoded'] for d in parts)
+        if len(missing) > 0:
+            print 'Missing codes: {}'.format(
+                ', '.join(str(i) for i in missing))
+    else:
+        if len(decoded) > 1:
+            print 'Decoding only the first code.'
+        payload = decoded[0]['payload_str']
+        status = decoded[0]['status']
+        ndecoded = decoded[0]['ndecoded']
+
+    if output is not None:
+        output.write(payload)
+    elif len(payload) > 0:
+        print 'Payload: <<<{}>>>'.format(payload)
+    print 'Status: {}'.format(status)
+    print 'Number of decoded fragments: {}'.format(ndecoded)
+
+
+_batch_receiver = None
+
+
+def _init_batch_worker(nsubchannels, shape, modulation):
+    global _batch_receiver
+    _batch_receiver = focus.receiver.Receiver(nsubchannels, shape=shape,
+                                              modulation=modulation)
+    # Plan the FFTs now rather than when decoding the first image
+    _batch_receiver.decode_codes([np.zeros(_batch_receiver.extract_shape)])
+
+
+def _decode_batch_file(fname):
+    result = {'file': fname}
+    try:
+        with open(fname, 'rb') as fin:
+            frame = load_img(fin)
+    except IOError as ioe:
+        result.update({'status': 'error', 'message': str(ioe)})
+        return result
+    decoded = decode_image(_batch_receiver, frame, verbose=False)
+    result.update({'status': decoded['status'],
+                   'header': decoded['header'],
+                   'ndecoded': decoded['ndecoded'],
+                   'payload': base64.b64encode(decoded['payload_str'])})
+    return result
+
+
+def expand_paths(paths):
+    '''Expand directories and glob patterns. "-" reads paths from stdin.'''
+    for path in paths:
+        if path == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif os.path.isdir(path):
+            for fname in sorted(os.listdir(path)):
+                if os.path.isfile(os.path.join(path, fname)):
+                    yield os.path.join(path, fname)
+        elif glob.has_magic(path):
+            for fname in sorted(glob.glob(path)):
+                yield fname
+        else:
+            yield path
+
+
+@click.command('batchrx')
+@click.option('--nsubchannels', type=int, default=32)
+@click.option('--shape', type=str, default='768x768')
+@click.option('--nprocesses', type=int, default=multiprocessing.cpu_count())
+@click.option('--modulation', type=str, default='qpsk')
+@click.argument('paths', nargs=-1)
+def batchrx(paths, nsubchannels, shape, nprocesses, modulation):
+    '''Decode many images, printing one JSON line per image.
+
+    PATHS are image files, directories or glob patterns; "-" reads a list of
+    files from stdin. Each line holds the file name, status, header
+    (nfragments, payload length), number of decoded fragments and the
+    base64-encoded payload. For a part of a multi-code payload, the header
+    is (code index, number of codes, payload length) and the payload is
+    empty.'''
+    shape = focus.util.parse_resolution(shape)
+    pool = multiprocessing.Pool(nprocesses, _init_batch_worker,
+                                (nsubchannels, shape, modulation))
+    try:
+        for result in pool.imap(_decode_batch_file, expand_paths(paths),
+                                chunksize=4):
+            print json.dumps(result)
+            sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
 
 
 @click.command('simpletx')
 @click.option('--shape', type=str, default='768x768')
-@click.argument('outfile', type=click.File('wb'))
-def tx(outfile, shape):
-    payload = bytearray(sys.stdin.read())
+@click.option('--modulation', type=str, default='qpsk')
+@click.option('--nsubchannels', type=int, default=32,
+              help='Maximum number of sub-channels per code.')
+@click.option('--color', is_flag=True,
+              help='Encode a code in each color plane.')
+@click.argument('outfile', type=str)
+def tx(outfile, shape, modulation, nsubchannels, color):
+    '''Encode stdin as one code, or as a sequence of codes if it does not
+    fit into one. The codes of a sequence are written to OUTFILE with the
+    code index appended, e.g., code-0000.png, code-0001.png, ...
+
+    With --color, there are --nsubchannels sub-channels per color plane.'''
+    payload = sys.stdin.read()
     payload_len = len(payload)
-    nfragments = get_nrequired_fragments(payload_len, 64-4)
-    header = pack_header(nfragments, payload_len)
-    fragments = create_fragments(payload, header, nfragments)
+    nfragments = get_nrequired_fragments(payload_len, 64-HEADER.size)
     shape = focus.util.parse_resolution(shape)
-    transmitter = focus.transmitter.Transmitter(nfragments, shape=shape)
-    frame = transmitter.encode(fragments)
-    pil_img = PIL.Image.fromarray(frame)
-    pil_img.save(outfile)
-    print 'Wrote code with {} sub-channel(s).'.format(nfragments)
+    nplanes = focus.color.NPLANES if color else 1
+    if nfragments <= nplanes*nsubchannels:
+        header = pack_header(nfragments, payload_len)
+        # The receiver expects plane p to start at sub-channel
+        # p*nsubchannels, so color codes use all sub-channels and the
+        # surplus fragments hold no payload.
+        nplane = nsubchannels if color else nfragments
+        fragments = create_fragments(payload, header, nplanes*nplane)
+        transmitter = focus.tiling.get_transmitter(
+            nplane, color=color, shape=shape, modulation=modulation)
+        PIL.Image.fromarray(transmitter.encode(fragments)).save(outfile)
+        print 'Wrote code with {} sub-channel(s).'.format(nplanes*nplane)
+        return
+
+    codes = create_codes(payload, nplanes*nsubchannels)
+    if len(codes) > MULTI_FLAG:
+        raise click.BadParameter('Payload needs too many codes, increase '
+                                 '--nsubchannels.')
+    transmitter = focus.tiling.get_transmitter(
+        nsubchannels, color=color, shape=shape, modulation=modulation)
+    root, ext = os.path.splitext(outfile)
+    for code_idx, fragments in enumerate(codes):
+        frame = transmitter.encode(fragments)
+        PIL.Image.fromarray(frame).save('{}-{:04d}{}'.format(root, code_idx,
+                                                            ext or '.png'))
+    print 'Wrote {} codes with {} sub-channel(s) each.'.format(
+        len(codes), transmitter.nsubchannels)
+
+
+def test_reassemble(nsubchannels=4):
+    payload = np.random.randint(0, 256, 1000).astype(np.uint8).tostring()
+    codes = create_codes(payload, nsubchannels)
+    decoded = list()
+    for fragments in codes:
+        header = unpack_header(fragments[0])
+        decoded.append({'header': header, 'fragments': list(fragments)})
+    decoded[2]['fragments'][1] = None
+    missing_code = decoded.pop(3)
+    decoded.reverse()
+    result, missing = reassemble(decoded, nsubchannels)
+    nbytes = 64 - MULTI_HEADER.size
+    expected = bytearray(payload)
+    expected[(2*nsubchannels+1)*nbytes:(2*nsubchannels+2)*nbytes] = \
+        'X' * nbytes
+    code_nbytes = nsubchannels * nbytes
+    expected[3*code_nbytes:4*code_nbytes] = 'X' * code_nbytes
+    if len(codes) != 5 or missing != [3] or \
+       missing_code['header'] != (3, 5, 1000) or result != str(expected):
+        raise RuntimeError('test_reassemble: Unexpected payload.')
+
+
+def test_tx_rx(nsubchannels=4, shape='256x256'):
+    import shutil
+    import tempfile
+    import click.testing
+    runner = click.testing.CliRunner()
+    # Multi-code payloads, and single codes of a few sub-channels
+    for color, nbytes, ncodes in ((False, 1000, 5), (True, 1000, 2),
+                                  (False, 100, 1), (True, 100, 1)):
+        payload = np.random.randint(0, 256, nbytes).astype(np.uint8)
+        payload = payload.tostring()
+        tmpdir = tempfile.mkdtemp()
+        try:
+            args = ['--nsubchannels', str(nsubchannels), '--shape', shape]
+            if color:
+                args.append('--color')
+            result = runner.invoke(tx, args + [os.path.join(tmpdir,
+                                                            'code.png')],
+                                   input=payload)
+            if result.exit_code != 0:
+                raise RuntimeError('test_tx_rx: simpletx failed: {}'.format(
+                    result.output))
+            fnames = sorted(glob.glob(os.path.join(tmpdir, 'code*.png')),
+                            reverse=True)
+            outfile = os.path.join(tmpdir, 'payload')
+            result = runner.invoke(rx, args + ['--output', outfile] + fnames)
+            if result.exit_code != 0:
+                raise RuntimeError('test_tx_rx: simplerx failed: {}'.format(
+                    result.output))
+            with open(outfile, 'rb') as fin:
+                received = fin.read()
+        finally:
+            shutil.rmtree(tmpdir)
+        if len(fnames) != ncodes or received != payload:
+            raise RuntimeError('test_tx_rx: Payload of {} bytes does not '
+                               'match (color: {}).'.format(nbytes, color))
@@ -3,23 +3,57 @@
 # This file is part of FOCUS and is licensed under the 3-clause BSD license.
 # The full license can be found in the file COPYING.
 
+import fractions
+
 import numpy as np
 
 import focus.mapping
 
 
-def subchannel_idxs(nsubchannels, nelements_per_subchannel, shape):
-    mapping = focus.mapping.halfring(nsubchannels*nelements_per_subchannel,
-                                     shape)
-    res = np.zeros((nsubchannels, ) + shape, dtype=np.bool)
+def layout(nsubchannels, nelements_per_subchannel, shape, npilots=0,
+           nsignal=0):
+    '''Place subchannels, pilots and signalling elements in the halfring.
+
+    `nelements_per_subchannel` is a number for all subchannels, or a
+    sequence with one number per subchannel. Returns the subchannel indices
+    and boolean matrices marking the pilot and the signalling positions
+    (see focus.papr). Both are spread evenly over the halfring.'''
+    if np.isscalar(nelements_per_subchannel):
+        nelements_per_subchannel = [nelements_per_subchannel] * nsubchannels
+    starts = np.cumsum([0] + list(nelements_per_subchannel))
+    nelements = starts[-1] + npilots + nsignal
+    mapping = focus.mapping.halfring(nelements, shape)
+    is_pilot = np.zeros(nelements, dtype=np.bool)
+    if npilots > 0:
+        is_pilot[((np.arange(npilots) + 0.5) *
+                  nelements / npilots).astype(np.int)] = True
+    is_signal = np.zeros(nelements, dtype=np.bool)
+    if nsignal > 0:
+        remaining = np.flatnonzero(~is_pilot)
+        is_signal[remaining[((np.arange(nsignal) + 0.25) *
+                             len(remaining) / nsignal).astype(np.int)]] = True
+
+    pilot_idx = np.zeros(shape, dtype=np.bool)
+    signal_idx = np.zeros(shape, dtype=np.bool)
+    data_mapping = list()
+    for (u, v), pilot, signal in zip(mapping, is_pilot, is_signal):
+        if pilot:
+            pilot_idx[u, v] = True
+        elif signal:
+            signal_idx[u, v] = True
+        else:
+            data_mapping.append((u, v))
 
+    res = np.zeros((nsubchannels, ) + shape, dtype=np.bool)
     for i in xrange(nsubchannels):
-        start = i*nelements_per_subchannel
-        stop = start + nelements_per_subchannel
-        for u, v in mapping[start:stop]:
+        for u, v in data_mapping[starts[i]:starts[i+1]]:
             res[i, u, v] = True
 
-    return res
+    return res, pilot_idx, signal_idx
+
+
+def subchannel_idxs(nsubchannels, nelements_per_subchannel, shape):
+    return layout(nsubchannels, nelements_per_subchannel, shape)[0]
 
 
 def load_subchannel(spectrum, subchannel_idx, symbols):
@@ -96,6 +130,26 @@ def get_bbox(idxs):
     return height, width
 
 
+def reduced_shape(shape, cyclic_prefix, bbox, margin=3.):
+    '''Return the smallest shape and cyclic prefix at which a code of
+    `shape` still holds the elements within `bbox` (see get_bbox()).
+
+    The code is scaled by the same factor in both dimensions, such that the
+    cyclic prefix scales to whole pixels, and such that the highest
+    frequency in the bbox is at most 1/`margin` of the Nyquist frequency.
+    Smaller margins lose fragments of codes with many subchannels, since
+    resampling the frame attenuates the high frequencies (see
+    focus.receiver.benchmark_extraction()).'''
+    height, width = bbox
+    step = fractions.gcd(fractions.gcd(shape[0], shape[1]), cyclic_prefix)
+    for i in xrange(1, step+1):
+        reduced = (shape[0] * i // step, shape[1] * i // step)
+        if reduced[0] >= margin * 2*height and \
+           reduced[1] >= margin * 2*(width-1):
+            return reduced, cyclic_prefix * i // step
+    return tuple(shape), cyclic_prefix
+
+
 def test_bbox(nchannels=321, shape=(512, 512)):
     try:
         focus.receiver.Receiver(nchannels, shape=shape, use_hints=False)
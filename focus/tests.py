@@ -10,11 +10,37 @@ import focus
 
 def run_tests():
     tests = (focus.transmitter.test_tx_rx,
+             focus.carousel.test_carousel,
+             focus.color.test_color_tx_rx,
+             focus.equalization.test_equalize,
              focus.fft.test_irfft2, focus.fft.test_rfft2,
+             focus.fft.test_rfft2_crop,
+             focus.fountain.test_encode_decode,
+             focus.framestore.test_write_read,
              focus.link.test_mask_fragments,
+             focus.link.test_parity_profile,
+             focus.live.test_frame_queue,
+             focus.multiprocreceiver.test_scheduler,
+             focus.multiprocreceiver.test_cli_options,
              focus.modulation.test_mod_demod,
+             focus.modulation.test_demod_reliability,
+             focus.papr.test_encode_decode_index,
              focus.phy.test_add_strip_cyclic_prefix,
-             focus.spectrum.test_bbox)
+             focus.receiver.test_decode_result,
+             focus.receiver.test_combine,
+             focus.receiver.test_decode_erasures,
+             focus.receiver.test_decode_subchannels,
+             focus.receiver.test_decode_batches,
+             focus.receiver.test_read_only_frame,
+             focus.receiver.test_detect_nsubchannels,
+             focus.receiver.test_reduced_extraction,
+             focus.server.test_server,
+             focus.simpletxrx.test_reassemble, focus.simpletxrx.test_tx_rx,
+             focus.spectrum.test_bbox,
+             focus.tiling.test_tiled_tx_rx,
+             focus.tune.test_sweep,
+             focus.video.test_shards,
+             focus.video.test_fragment_writer)
     count = 0
     success = 0
     for test_func in tests:
@@ -0,0 +1,210 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+'''Several independent codes side by side on one displayed frame.
+
+Each tile is a complete code with its own markers. Tiles are numbered row by
+row, and the subchannels of tile t are subchannels t*nsubchannels, ... of
+the tiled frame, so a tiled transmitter and receiver can be used in place of
+a Transmitter and Receiver with ntiles*nsubchannels subchannels.'''
+
+import multiprocessing.pool
+
+import numpy as np
+
+import focus
+
+
+def parse_tiles(tiles):
+    '''Return (rows, columns) for a string 'COLUMNSxROWS' or a tuple.'''
+    if isinstance(tiles, basestring):
+        return focus.util.parse_resolution(tiles)
+    return tuple(tiles)
+
+
+def get_transmitter(nsubchannels, tiles=(1, 1), color=False, **kwargs):
+    '''Return a Transmitter, a TiledTransmitter for several tiles, or a
+    ColorTransmitter for color codes (see focus.color).'''
+    tiled = parse_tiles(tiles) != (1, 1)
+    if tiled and color:
+        raise ValueError('Tiled color codes are not supported.')
+    if tiled:
+        return TiledTransmitter(tiles, nsubchannels, **kwargs)
+    if color:
+        return focus.color.ColorTransmitter(nsubchannels, **kwargs)
+    return focus.transmitter.Transmitter(nsubchannels, **kwargs)
+
+
+def get_receiver(nsubchannels, tiles=(1, 1), color=False, **kwargs):
+    '''Return a Receiver, a TiledReceiver for several tiles, or a
+    ColorReceiver for color codes (see focus.color).'''
+    tiled = parse_tiles(tiles) != (1, 1)
+    if tiled and color:
+        raise ValueError('Tiled color codes are not supported.')
+    if tiled:
+        return TiledReceiver(tiles, nsubchannels, **kwargs)
+    if color:
+        return focus.color.ColorReceiver(nsubchannels, **kwargs)
+    return focus.receiver.Receiver(nsubchannels, **kwargs)
+
+
+class TiledTransmitter(object):
+    '''Encodes blocks of fragments into frames of rows x columns codes.
+
+    The frame is divided evenly into cells, and each tile is centred in its
+    cell. The frame has the given `size` (height, width), e.g., that of the
+    display, so that the receiver finds each tile in the matching cell of a
+    camera frame of the display. Without `size`, cells are `gap` pixels
+    larger than the tiles.'''
+
+    def __init__(self, tiles, nsubchannels, size=None, gap=32, **kwargs):
+        self.rows, self.cols = parse_tiles(tiles)
+        self.ntiles = self.rows * self.cols
+        self.transmitter = focus.transmitter.Transmitter(nsubchannels,
+                                                         **kwargs)
+        self.nsubchannels = self.ntiles * nsubchannels
+        self.fragment_size = self.transmitter.fragment_size
+        self.size = size
+        self.gap = gap
+
+    def encode(self, data):
+        data = data.reshape((self.ntiles, -1))
+        frame = None
+        for t, tile_data in enumerate(data):
+            tile = self.transmitter.encode(tile_data)
+            height, width = tile.shape[:2]
+            if frame is None:
+                if self.size is None:
+                    size = (self.rows * (height + self.gap),
+                            self.cols * (width + self.gap))
+                else:
+                    size = self.size
+                frame = np.empty(size + tile.shape[2:], dtype=tile.dtype)
+                frame.fill(255)
+            row, col = divmod(t, self.cols)
+            y0, y1 = row*size[0] // self.rows, (row+1)*size[0] // self.rows
+            x0, x1 = col*size[1] // self.cols, (col+1)*size[1] // self.cols
+            if height > y1 - y0 or width > x1 - x0:
+                raise ValueError('Tiles of {}x{} do not fit into a {}x{} '
+                                 'frame.'.format(width, height, size[1],
+                                                 size[0]))
+            y = y0 + (y1 - y0 - height) // 2
+            x = x0 + (x1 - x0 - width) // 2
+            frame[y:y+height, x:x+width] = tile
+        return frame
+
+
+class TiledReceiver(object):
+    '''Decodes frames of rows x columns codes.
+
+    The captured frame is split evenly into one region per tile (see
+    TiledTransmitter), in which a
+    Receiver of its own locates the code, so that each tile keeps its own
+    hints and history. The tiles are processed by `nthreads` threads (one
+    per tile by default).'''
+
+    def __init__(self, tiles, nsubchannels, nthreads=None, **kwargs):
+        self.rows, self.cols = parse_tiles(tiles)
+        self.ntiles = self.rows * self.cols
+        self.receivers = [focus.receiver.Receiver(nsubchannels, **kwargs)
+                          for _ in xrange(self.ntiles)]
+        self.nsubchannels = self.ntiles * nsubchannels
+        self.fragment_size = self.receivers[0].fragment_size
+        if nthreads is None:
+            nthreads = self.ntiles
+        self.pool = None
+        if nthreads > 1 and self.ntiles > 1:
+            self.pool = multiprocessing.pool.ThreadPool(nthreads)
+
+    def map(self, func):
+        '''Call func(t) for every tile t and return the results.'''
+        if self.pool is None:
+            return map(func, xrange(self.ntiles))
+        return self.pool.map(func, xrange(self.ntiles))
+
+    def region(self, frame, t):
+        '''Return the region of `frame` that holds tile `t`, and its offset.'''
+        height, width = frame.shape[:2]
+        row, col = divmod(t, self.cols)
+        y0, y1 = row*height // self.rows, (row+1)*height // self.rows
+        x0, x1 = col*width // self.cols, (col+1)*width // self.cols
+        return frame[y0:y1, x0:x1], (x0, y0)
+
+    def extract_tile(self, frames, t, copy_frame=True):
+        extracted = list()
+        for frame in frames:
+            region, offset = self.region(frame, t)
+            code, corners = self.receivers[t].extract_many(
+                [region], copy_frame)[0]
+            if code is not None:
+                # Corners relative to the whole frame
+                corners = np.asarray(corners) + offset
+            extracted.append((code, corners))
+        return extracted
+
+    def extract_many(self, frames, copy_frame=True):
+        '''Extract the codes of a batch of frames.
+
+        Returns, for each frame, a list of the (code, corners) tuples of its
+        tiles (see Receiver.extract_many()).'''
+        per_tile = self.map(lambda t: self.extract_tile(frames, t,
+                                                        copy_frame))
+        return [list(tiles) for tiles in zip(*per_tile)]
+
+    def decode_extracted(self, extracted, debug=False):
+        '''Decode the output of extract_many().'''
+        per_tile = self.map(lambda t: self.receivers[t].decode_extracted(
+            [tiles[t] for tiles in extracted], debug))
+        return tuple(self.merge(tiles, debug) for tiles in zip(*per_tile))
+
+    def decode_many(self, frames, debug=False, copy_frame=True):
+        '''Decode a batch of frames. Each tile is located and decoded on its
+        own thread.'''
+        def decode_tile(t):
+            receiver = self.receivers[t]
+            return receiver.decode_extracted(
+                self.extract_tile(frames, t, copy_frame), debug)
+        return tuple(self.merge(tiles, debug)
+                     for tiles in zip(*self.map(decode_tile)))
+
+    def decode(self, frame, debug=False, copy_frame=True):
+        return self.decode_many([frame], debug, copy_frame)[0]
+
+    def merge(self, tiles, debug=False):
+        '''Combine the DecodeResults of the tiles of one frame.'''
+        nsubchannels = self.nsubchannels // self.ntiles
+        data = np.zeros((self.nsubchannels, self.fragment_size),
+                        dtype=np.uint8)
+        nerrors = np.empty(self.nsubchannels, dtype=np.int)
+        nerrors.fill(-1)
+        for t, tile in enumerate(tiles):
+            n = len(tile.valid)
+            data[t*nsubchannels:t*nsubchannels+n] = tile.data
+            nerrors[t*nsubchannels:t*nsubchannels+n] = tile.nerrors
+        result = focus.receiver.DecodeResult(data, nerrors)
+        if debug:
+            status = [tile['status'] for tile in tiles]
+            result['status'] = 'found' if 'found' in status else 'notfound'
+            result['tiles'] = [tile.info for tile in tiles]
+        return result
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+def test_tiled_tx_rx(tiles=(2, 3), nsubchannels=4, shape=(128, 128)):
+    transmitter = TiledTransmitter(tiles, nsubchannels, shape=shape)
+    receiver = TiledReceiver(tiles, nsubchannels, shape=shape)
+    data = np.random.randint(0, 256, (transmitter.nsubchannels, 64))
+    data = data.astype(np.uint8)
+    frame = transmitter.encode(data.copy())
+    result = receiver.decode(frame, debug=True)
+    receiver.close()
+    if result['status'] != 'found' or not np.all(result.valid) or \
+       not np.all(result.data == data):
+        raise RuntimeError('test_tiled_tx_rx: Fragments do not match.')
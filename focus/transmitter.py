@@ -12,26 +12,52 @@ import focus
 
 
 class Transmitter(object):
-    def __init__(self, nsubchannels, nelements_per_subchannel=(64+16)*8/2,
-                 parity=16, shape=(512, 512), border=0.15, cyclic_prefix=8):
+    def __init__(self, nsubchannels, nelements_per_subchannel=None,
+                 parity=16, shape=(512, 512), border=0.15, cyclic_prefix=8,
+                 npilots=0, modulation='qpsk', slm=1):
         self.nsubchannels = nsubchannels
+        # Parity may differ between subchannels (see
+        # focus.link.parity_profile()), and so may their numbers of elements.
+        self.parity = focus.link.parity_profile(parity, nsubchannels)
+        codes = {p: rscode.RSCode(p) for p in set(self.parity)}
+        self.rs = [codes[p] for p in self.parity]
+        self.modulation = focus.modulation.get(modulation)
+        if nelements_per_subchannel is None:
+            nelements_per_subchannel = [self.modulation.nsymbols(64+p)
+                                        for p in self.parity]
+        elif np.isscalar(nelements_per_subchannel):
+            nelements_per_subchannel = \
+                [nelements_per_subchannel] * nsubchannels
         self.nelements_per_subchannel = nelements_per_subchannel
-        self.rs = rscode.RSCode(parity)
-        self.qpsk = focus.modulation.QPSK()
-        self.idxs = focus.spectrum.subchannel_idxs(nsubchannels,
-                                                   nelements_per_subchannel,
-                                                   shape)
+        fragment_sizes = set(self.modulation.nbytes(n) - p for n, p in
+                             zip(nelements_per_subchannel, self.parity))
+        if len(fragment_sizes) != 1:
+            raise ValueError('Subchannels must carry fragments of the same '
+                             'size.')
+        self.fragment_size = fragment_sizes.pop()
+        self.uniform = len(set(nelements_per_subchannel)) == 1
+        if not self.uniform and slm > 1:
+            raise ValueError('Selective mapping requires the same parity on '
+                             'all subchannels.')
+        self.idxs, self.pilot_idx, self.signal_idx = focus.spectrum.layout(
+            nsubchannels, nelements_per_subchannel, shape, npilots,
+            focus.papr.nsignal(slm))
+        self.pilots = focus.equalization.pilot_symbols(npilots)
+        # Selective mapping: try `slm` candidate masks per code
+        self.slm = slm
+        if slm > 1:
+            self.slm_masks = focus.papr.masks(
+                slm, (nsubchannels, nelements_per_subchannel[0]))
+            self.flat_idxs = np.array([np.flatnonzero(idx)
+                                       for idx in self.idxs])
         self.shape = shape
         self.shape_with_cp = tuple(np.array(shape) + 2*cyclic_prefix)
         self.framer = imageframer.Framer(self.shape_with_cp, border)
         self.cyclic_prefix = cyclic_prefix
 
     def encode(self, data, debug_info=None):
-        ndataelements_per_subchannel = self.nelements_per_subchannel - \
-            4*self.rs.parity_len
-
         if data.dtype != np.uint8 or \
-           data.size * 4 != self.nsubchannels * ndataelements_per_subchannel:
+           data.size != self.nsubchannels * self.fragment_size:
             raise ValueError('Data has incorrect format or wrong number of '
                              'elements.')
 
@@ -39,14 +65,33 @@ class Transmitter(object):
         for i in xrange(self.nsubchannels):
             focus.link.mask_fragments(fragments[i], i)
         # RS encode
-        coded_fragments = np.array([self.rs.encode(f) for f in fragments])
+        coded_fragments = [rs.encode(f) for rs, f in zip(self.rs, fragments)]
         # Modulate
-        symbols = self.qpsk.modulate(coded_fragments.reshape(-1))
-        symbols = symbols.reshape((self.nsubchannels, -1))
+        if self.uniform:
+            coded_fragments = np.array(coded_fragments)
+            symbols = self.modulation.modulate(coded_fragments)
+        else:
+            symbols = [self.modulation.modulate(f) for f in coded_fragments]
         # Load spectrum
         spectrum = focus.spectrum.construct(symbols, self.shape, self.idxs)
-        # Compute inverse FFT
-        code = focus.phy.tx(spectrum)
+        focus.spectrum.load_subchannel(spectrum, self.pilot_idx, self.pilots)
+        if self.slm > 1:
+            # Load the spectra of all candidates
+            spectra = np.empty((self.slm, ) + self.shape, dtype=np.complex)
+            spectra[:] = spectrum
+            masked = (symbols * self.slm_masks).reshape((self.slm, -1))
+            spectra.reshape((self.slm, -1))[:, self.flat_idxs.reshape(-1)] = \
+                masked
+            for i, candidate in enumerate(spectra):
+                focus.spectrum.load_subchannel(
+                    candidate, self.signal_idx,
+                    focus.papr.encode_index(i, self.slm))
+            # Compute all inverse FFTs and pick the best candidate
+            slm_index, code, ranges = focus.papr.select(spectra)
+            code = focus.phy.clip_and_quantize(code)
+        else:
+            # Compute inverse FFT
+            code = focus.phy.tx(spectrum)
         # Add cyclic prefix
         code = focus.phy.add_cyclic_prefix(code, self.cyclic_prefix)
         # Add markers
@@ -54,22 +99,35 @@ class Transmitter(object):
         if debug_info is not None:
             debug_info['coded_fragments'] = coded_fragments
             debug_info['symbols'] = symbols
+            if self.slm > 1:
+                debug_info['slm_index'] = slm_index
+                debug_info['intensity_range'] = ranges[slm_index]
+            else:
+                debug_info['intensity_range'] = \
+                    focus.papr.intensity_range(focus.phy.tx(
+                        spectrum, normalize=False)[np.newaxis])[0]
         return frame
 
 
 def test_tx_rx():
-    data = np.random.randint(0, 255, 64*16).astype(np.uint8)
-
     shape = (512, 512)
 
-    transmitter = Transmitter(16, shape=shape)
-    frame = transmitter.encode(data.copy())
+    configs = [{'modulation': modulation}
+               for modulation in sorted(focus.modulation.CONSTELLATIONS)]
+    configs.append({'slm': 8, 'npilots': 16})
+    configs.append({'parity': '8:24'})
+    for config in configs:
+        data = np.random.randint(0, 255, 64*16).astype(np.uint8)
+
+        transmitter = Transmitter(16, shape=shape, **config)
+        frame = transmitter.encode(data.copy())
 
-    receiver = focus.receiver.Receiver(16, shape=shape)
-    rxdata = receiver.decode(frame)
+        receiver = focus.receiver.Receiver(16, shape=shape, **config)
+        rxdata = receiver.decode(frame)
 
-    rxdata = np.array(rxdata['fragments'])
-    data = data.reshape((16, -1))
+        rxdata = np.array(rxdata['fragments'])
+        data = data.reshape((16, -1))
 
-    if not np.all(rxdata == data):
-        raise RuntimeError('RX data does not match TX data.')
+        if not np.all(rxdata == data):
+            raise RuntimeError('RX data does not match TX data '
+                               '({}).'.format(config))
@@ -0,0 +1,161 @@
+# Copyright (c) 2016, Frederik Hermans, Liam McNamara
+#
+# This file is part of FOCUS and is licensed under the 3-clause BSD license.
+# The full license can be found in the file COPYING.
+
+import time
+
+import click
+import cv2
+import numpy as np
+
+import focus
+
+
+def impair(frame, blur=0., noise=0., scale=1.):
+    '''Apply a simple capture model (scaling, blur, noise) to a frame.'''
+    frame = frame.astype(np.float32)
+    if scale != 1.:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale,
+                           interpolation=cv2.INTER_AREA)
+    if blur > 0:
+        frame = cv2.GaussianBlur(frame, (0, 0), blur)
+    if noise > 0:
+        frame += np.random.normal(0, noise, frame.shape).astype(np.float32)
+    return np.clip(np.round(frame), 0, 255).astype(np.uint8)
+
+
+def synthetic_frames(nsubchannels, shape, nframes, blur=0., noise=0.,
+                     scale=1., cyclic_prefix=8, transmitter=None):
+    '''Generate impaired frames carrying random codes.'''
+    if transmitter is None:
+        transmitter = focus.transmitter.Transmitter(
+            nsubchannels, shape=shape, cyclic_prefix=cyclic_prefix)
+    frames = list()
+    for _ in xrange(nframes):
+        data = np.random.randint(0, 256, nsubchannels*64).astype(np.uint8)
+        frame = transmitter.encode(data)
+        # Surround the code with some white space, like a display would.
+        pad = frame.shape[0] / 8
+        frame = np.pad(frame, pad, 'constant', constant_values=255)
+        frames.append(impair(frame, blur, noise, scale))
+    return frames
+
+
+def extract_codes(frames, shape, cyclic_prefix=8):
+    '''Locate and extract the codes in `frames`.
+
+    Returns the extracted codes (None if a code was not found) and the
+    total time spent on extraction.'''
+    # The locator only depends on the geometry, so any subchannel count will
+    # do here. Extract at full resolution, since the codes are decoded with
+    # different subchannel counts.
+    recv = focus.receiver.Receiver(1, shape=shape,
+                                   cyclic_prefix=cyclic_prefix,
+                                   reduce_extraction=False)
+    codes = list()
+    duration = 0.
+    for frame in frames:
+        start = time.time()
+        try:
+            code, _ = recv.extract(frame)
+        except ValueError:
+            code = None
+        duration += time.time() - start
+        codes.append(code)
+    return codes, duration
+
+
+def sweep(codes, nsubchannels, shape, cyclic_prefix=8, txrate=15,
+          extract_duration=0.):
+    '''Decode extracted codes with each subchannel count in `nsubchannels`.
+
+    Subchannels are laid out from the inside of the halfring outwards, so
+    the first n subchannels of a code are identical for any code with n or
+    more subchannels. Hence codes captured with the largest subchannel
+    count can be used to evaluate all smaller counts.'''
+    ncodes = max(1, len(codes))
+    results = list()
+    for n in nsubchannels:
+        recv = focus.receiver.Receiver(n, shape=shape,
+                                       cyclic_prefix=cyclic_prefix,
+                                       use_hints=False)
+        fragments_ok = 0
+        start = time.time()
+        for code in codes:
+            if code is None:
+                continue
+            fragments = recv.decode_code(code)['fragments']
+            fragments_ok += sum(f is not None for f in fragments)
+        duration = time.time() - start
+        ratio = fragments_ok / float(ncodes * n)
+        results.append({'shape': shape,
+                        'nsubchannels': n,
+                        'fragment_ratio': ratio,
+                        'goodput': ratio * n * 64 * txrate,
+                        'ms_per_frame': (duration + extract_duration) /
+                                        ncodes * 1000.})
+    return results
+
+
+def print_results(results):
+    fmt = '{:>9} {:>12} {:>10} {:>12} {:>10}'
+    print fmt.format('shape', 'nsubchannels', 'fragments', 'goodput',
+                     'ms/frame')
+    for r in results:
+        print fmt.format('{}x{}'.format(r['shape'][1], r['shape'][0]),
+                         r['nsubchannels'],
+                         '{:.1f}%'.format(100.*r['fragment_ratio']),
+                         focus.util.sizeof_fmt(r['goodput'], suffix='B/s'),
+                         '{:.1f}'.format(r['ms_per_frame']))
+    best = max(results, key=lambda r: r['goodput'])
+    print 'Best: --nsubchannels {} --shape {}x{}'.format(best['nsubchannels'],
+                                                        best['shape'][1],
+                                                        best['shape'][0])
+
+
+def test_sweep():
+    shape = (256, 256)
+    frames = synthetic_frames(4, shape, 2)
+    codes, _ = extract_codes(frames, shape)
+    for r in sweep(codes, (2, 4), shape):
+        if r['fragment_ratio'] != 1.:
+            raise RuntimeError('test_sweep: Failed to decode unimpaired '
+                               'synthetic frames.')
+
+
+@click.command('tune')
+@click.argument('filename', required=False)
+@click.option('--nsubchannels', type=str, default='8,16,24,32')
+@click.option('--shape', type=str, default='512x512')
+@click.option('--cyclic-prefix', type=int, default=8)
+@click.option('--txrate', type=int, default=15)
+@click.option('--resolution', type=str, default='1920x1080')
+@click.option('--video-start', type=float, default=0.0)
+@click.option('--video-duration', type=float)
+@click.option('--nframes', type=int, default=30)
+@click.option('--blur', type=float, default=0.)
+@click.option('--noise', type=float, default=0.)
+@click.option('--scale', type=float, default=1.)
+def main(filename, nsubchannels, shape, cyclic_prefix, txrate, resolution,
+         video_start, video_duration, nframes, blur, noise, scale):
+    '''Find the subchannel count and shape with the highest goodput.
+
+    Decodes FILENAME, a calibration video encoded with the largest
+    subchannel count, or synthetic frames if FILENAME is omitted.'''
+    nsubchannels = sorted(int(n) for n in nsubchannels.split(','))
+    shapes = [focus.util.parse_resolution(s) for s in shape.split(',')]
+    resolution = focus.util.parse_resolution(resolution)
+
+    results = list()
+    for shape in shapes:
+        if filename is None:
+            frames = synthetic_frames(nsubchannels[-1], shape, nframes, blur,
+                                      noise, scale, cyclic_prefix)
+        else:
+            frames = focus.video.video_frame_src(filename, resolution,
+                                                 video_start, video_duration)
+        codes, extract_duration = extract_codes(frames, shape, cyclic_prefix)
+        results += sweep(codes, nsubchannels, shape, cyclic_prefix, txrate,
+                         extract_duration)
+    print_results(results)
@@ -30,10 +30,25 @@ def load_frames(fname):
     if fname.endswith('.pickle'):
         with open(fname, 'rb') as fin:
             return pickle.load(fin)
+    elif fname.endswith('.frames') or fname.endswith('.npy'):
+        # Imported here, since focus.framestore depends on this module.
+        from focus.framestore import FrameStore
+        return FrameStore(fname)
     else:
         raise ValueError('Don\'t know how to load frames from {}'.format(fname))
 
 
+def take_n(iterable, n):
+    elems = list()
+    for element in iterable:
+        elems.append(element)
+        if len(elems) == n:
+            yield elems
+            elems = list()
+    if len(elems) > 0:
+        yield elems
+
+
 def parse_resolution(resolution_str):
     return tuple([int(v) for v in resolution_str.split('x')][::-1])
 
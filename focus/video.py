@@ -4,7 +4,10 @@
 # The full license can be found in the file COPYING.
 
 import collections
+import io
 import itertools
+import multiprocessing
+import struct
 import sys
 import subprocess
 import time
@@ -12,10 +15,13 @@ import time
 import click
 import cv2
 import numpy as np
-import PIL
+import PIL.Image
 
+import carousel
+import fountain
 import multiprocreceiver
-import transmitter
+import receiver
+import tiling
 import util
 
 
@@ -32,27 +38,279 @@ def video_frame_src(filename, resolution, start_at, duration=None,
     ffmpeg = subprocess.Popen(cmd.split(), stdout=subprocess.PIPE,
                               close_fds=True)
 
-    while True:
-        bytes = ffmpeg.stdout.read(bytes_per_frame*3/2)
-        if len(bytes) != bytes_per_frame*3/2:
+    try:
+        while True:
+            bytes = ffmpeg.stdout.read(bytes_per_frame*3/2)
+            if len(bytes) != bytes_per_frame*3/2:
+                break
+            if grayscale:
+                bytes = bytes[:bytes_per_frame]
+                frame = np.fromstring(bytes, dtype=np.uint8)
+                frame = frame.reshape(*resolution)
+            else:
+                frame = np.fromstring(bytes, dtype=np.uint8)
+                frame = frame.reshape((resolution[0]+resolution[0]/2,
+                                       resolution[1]))
+                frame = cv2.cvtColor(frame, cv2.COLOR_YUV420P2BGR)
+            yield frame
+    finally:
+        # Also runs if the consumer closes the generator early; closing the
+        # pipe makes ffmpeg exit.
+        ffmpeg.stdout.close()
+        ffmpeg.wait()
+
+
+def probe_duration(filename):
+    '''Return the duration of the video `filename` in seconds.'''
+    cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration',
+           '-of', 'default=noprint_wrappers=1:nokey=1', filename]
+    return float(subprocess.check_output(cmd, close_fds=True))
+
+
+def time_shards(start, duration, nshards):
+    '''Split the time range into `nshards` (start, duration) tuples.'''
+    bounds = np.linspace(start, start+duration, nshards+1)
+    return zip(bounds[:-1], np.diff(bounds))
+
+
+def merge_shards(shards, callback, until=None):
+    '''Pass the results of consecutive shards to `callback`, tagging each
+    with its frame index in the whole range. Stops once `until()` returns
+    True.'''
+    frame_idx = 0
+    for results in shards:
+        for result in results:
+            result.frame = frame_idx
+            frame_idx += 1
+        callback(results)
+        if until is not None and until():
             break
-        if grayscale:
-            bytes = bytes[:bytes_per_frame]
-            frame = np.fromstring(bytes, dtype=np.uint8).reshape(*resolution)
-        else:
-            frame = np.fromstring(bytes, dtype=np.uint8)
-            frame = frame.reshape((resolution[0]+resolution[0]/2,
-                                   resolution[1]))
-            frame = cv2.cvtColor(frame, cv2.COLOR_YUV420P2BGR)
-        yield frame
 
-    ffmpeg.stdout.close()
-    ffmpeg.wait()
 
+_shard_receiver = None
+
+
+def _init_shard_worker(nsubchannels, receiver_args):
+    global _shard_receiver
+    _shard_receiver = tiling.get_receiver(nsubchannels, **receiver_args)
+
+
+def _decode_shard(args):
+    filename, resolution, start, duration, grayscale = args
+    frames = video_frame_src(filename, resolution, start, duration,
+                             grayscale)
+    return [_shard_receiver.decode(frame, copy_frame=False)
+            for frame in frames]
+
+
+def decode_shards(filename, resolution, nsubchannels, nprocesses, nshards,
+                  start_at, duration, callback, until=None,
+                  receiver_args=None):
+    '''Decode a video in `nshards` time ranges on a pool of processes.
+
+    Each worker runs its own ffmpeg and Receiver, so only decoded fragments
+    are passed between processes. Shards are passed to `callback` in order,
+    with results tagged by their frame index in the whole range.'''
+    if duration is None:
+        duration = probe_duration(filename) - start_at
+    grayscale = not (receiver_args or dict()).get('color', False)
+    shards = [(filename, resolution, start, length, grayscale)
+              for start, length in time_shards(start_at, duration, nshards)]
+    pool = multiprocessing.Pool(nprocesses, _init_shard_worker,
+                                (nsubchannels, receiver_args or dict()))
+    try:
+        merge_shards(pool.imap(_decode_shard, shards), callback, until)
+    finally:
+        # Also stops the workers (and their ffmpeg processes) early
+        pool.terminate()
+        pool.join()
+
+
+class FragmentWriter(object):
+    '''Writes decoded fragments to `out` in large batches.
+
+    With `dedup_window` > 0, fragments that were recently written for the
+    same subchannel are dropped; the last `dedup_window` distinct fragments
+    are remembered. Fragments are only told apart by their content, so this
+    also drops fragments that the payload repeats, e.g., blocks of zeros.
+    In framed format, each fragment is preceded by the index of the frame
+    and of the subchannel it was decoded from. `nbytes` counts all bytes
+    written, including these headers.'''
+    frame_header = struct.Struct('!IH')
+
+    def __init__(self, out, dedup_window=0, framed=False, bufsize=1 << 16):
+        self.out = out
+        self.dedup_window = dedup_window
+        self.framed = framed
+        self.bufsize = bufsize
+        self.recent = collections.OrderedDict()
+        self.buf = list()
+        self.buflen = 0
+        self.nfragments = 0
+        self.nduplicates = 0
+        self.nbytes = 0
+        self.nwrites = 0
+
+    def is_duplicate(self, fragment, channel_idx):
+        # The fragment content serves as its own (collision-free) hash key.
+        key = (channel_idx, fragment)
+        if key in self.recent:
+            # Move to the end of the LRU window
+            del self.recent[key]
+            self.recent[key] = None
+            return True
+        self.recent[key] = None
+        if len(self.recent) > self.dedup_window:
+            self.recent.popitem(last=False)
+        return False
+
+    def write(self, fragment, frame_idx, channel_idx):
+        self.write_string(fragment.tostring(), frame_idx, channel_idx)
+
+    def write_block(self, fragments, frame_idx, channel_idxs):
+        '''Write the rows of `fragments`, decoded from `channel_idxs`.'''
+        data = fragments.tostring()
+        size = fragments.shape[1]
+        for i, channel_idx in enumerate(channel_idxs):
+            self.write_string(data[i*size:(i+1)*size], frame_idx, channel_idx)
+
+    def write_string(self, fragment, frame_idx, channel_idx):
+        self.nfragments += 1
+        if self.dedup_window > 0 and self.is_duplicate(fragment, channel_idx):
+            self.nduplicates += 1
+            return
+        if self.framed:
+            self.buf.append(self.frame_header.pack(frame_idx, channel_idx))
+            self.buflen += self.frame_header.size
+        self.buf.append(fragment)
+        self.buflen += len(fragment)
+        if self.buflen >= self.bufsize:
+            self.flush()
+
+    def flush(self):
+        if self.buflen == 0:
+            return
+        self.out.write(''.join(self.buf))
+        self.out.flush()
+        self.nbytes += self.buflen
+        self.nwrites += 1
+        self.buf = list()
+        self.buflen = 0
+
+
+def test_shards(nframes=(3, 0, 5, 1)):
+    for start, duration, nshards in ((0., 10., 1), (2.5, 7.3, 3),
+                                     (1., 60., 7)):
+        shards = time_shards(start, duration, nshards)
+        starts = np.array([s for s, _ in shards])
+        stops = starts + [d for _, d in shards]
+        if len(shards) != nshards or starts[0] != start or \
+           not np.allclose(stops[-1], start+duration) or \
+           not np.allclose(starts[1:], stops[:-1]):
+            raise RuntimeError('test_shards: Shards do not cover {} + {} '
+                               's.'.format(start, duration))
+
+    # Results of consecutive shards, whose data is their frame index
+    shards = list()
+    for n in nframes:
+        first = sum(len(s) for s in shards)
+        shards.append([receiver.DecodeResult(
+            np.array([[i]], dtype=np.uint8), np.zeros(1, dtype=np.int))
+            for i in xrange(first, first+n)])
+    merged = list()
+    merge_shards(iter(shards), merged.extend)
+    if [r.frame for r in merged] != range(sum(nframes)) or \
+       any(r.data[0, 0] != r.frame for r in merged):
+        raise RuntimeError('test_shards: Results are not merged in order.')
+    merged = list()
+    merge_shards(iter(shards), merged.extend, until=lambda: len(merged) > 0)
+    if len(merged) != nframes[0]:
+        raise RuntimeError('test_shards: Did not stop early.')
+
+    import click.testing
+    result = click.testing.CliRunner().invoke(
+        rx, ['--nsubchannels', '4', '--shards', '2', '--profile',
+             'video.mp4'])
+    if result.exit_code != 2 or '--shards' not in result.output:
+        raise RuntimeError('test_shards: Profiling shards was not rejected.')
+
+
+def test_fragment_writer():
+    import StringIO
+    out = StringIO.StringIO()
+    writer = FragmentWriter(out, dedup_window=2, framed=True)
+    frags = np.random.randint(0, 256, (3, 64)).astype(np.uint8)
+    for frame_idx, frag_idx in enumerate((0, 1, 0, 2, 0, 1)):
+        writer.write(frags[frag_idx], frame_idx, 0)
+    writer.write(frags[0], 6, 1)
+    writer.flush()
+    # Fragment 0 is a duplicate in frames 2 and 4, whereas fragment 1 has
+    # left the window by frame 5. Subchannels are deduplicated separately.
+    expected = [(0, 0, 0), (1, 0, 1), (3, 0, 2), (5, 0, 1), (6, 1, 0)]
+    data = out.getvalue()
+    size = FragmentWriter.frame_header.size + 64
+    if writer.nduplicates != 2 or len(data) != len(expected)*size or \
+       writer.nbytes != len(data):
+        raise RuntimeError('test_fragment_writer: Wrong number of fragments.')
+    for i, (frame_idx, channel_idx, frag_idx) in enumerate(expected):
+        record = data[i*size:(i+1)*size]
+        if FragmentWriter.frame_header.unpack(record[:6]) != \
+           (frame_idx, channel_idx) or record[6:] != frags[frag_idx].tostring():
+            raise RuntimeError('test_fragment_writer: Unexpected output.')
+    # By default, repeated fragments, e.g., of zero padding, are kept
+    out = StringIO.StringIO()
+    writer = FragmentWriter(out)
+    for frame_idx in xrange(3):
+        writer.write(frags[0], frame_idx, 0)
+    writer.flush()
+    if out.getvalue() != frags[0].tostring() * 3 or writer.nbytes != 3*64:
+        raise RuntimeError('test_fragment_writer: Dropped repeated fragments.')
+
+
+class FountainWriter(object):
+    '''Fountain-decodes fragments and writes the object once complete.'''
 
-class DecodeCallback(object):
     def __init__(self, out):
         self.out = out
+        self.decoder = fountain.Decoder()
+        self.nfragments = 0
+        self.nbytes = 0
+        self.nwrites = 0
+
+    @property
+    def nduplicates(self):
+        return self.decoder.nduplicates
+
+    @property
+    def complete(self):
+        return self.decoder.complete
+
+    def write(self, fragment, frame_idx, channel_idx):
+        if self.complete:
+            return
+        self.nfragments += 1
+        if self.decoder.add_fragment(fragment):
+            data = self.decoder.data()
+            self.out.write(data)
+            self.out.flush()
+            self.nbytes += len(data)
+            self.nwrites += 1
+
+    def write_block(self, fragments, frame_idx, channel_idxs):
+        for fragment, channel_idx in zip(fragments, channel_idxs):
+            self.write(fragment, frame_idx, channel_idx)
+
+    def flush(self):
+        pass
+
+
+class DecodeCallback(object):
+    def __init__(self, out, dedup_window=0, framed=False,
+                 use_fountain=False):
+        if use_fountain:
+            self.writer = FountainWriter(out)
+        else:
+            self.writer = FragmentWriter(out, dedup_window, framed)
         self.framecount = 0
         self.fragments_total = 0
         self.fragments_ok = 0
@@ -63,16 +321,23 @@ class DecodeCallback(object):
         if self.start is None:
             self.start = time.time()
         for d in data:
+            frame_idx = self.framecount if d.frame is None else d.frame
             self.framecount += 1
-            for fragment in d['fragments']:
-                if fragment is not None:
-                    self.fragments_ok += 1
-                    fragment.tofile(self.out)
-            self.fragments_total += len(d['fragments'])
-            if 'status' in d:
-                self.status_count[d['status']] += 1
+            decoded = np.flatnonzero(d.valid)
+            self.writer.write_block(d.data[decoded], frame_idx,
+                                    decoded.tolist())
+            self.fragments_ok += len(decoded)
+            self.fragments_total += len(d.valid)
+            if d.info is not None and 'status' in d.info:
+                self.status_count[d.info['status']] += 1
         self.status_stats()
 
+    def done(self):
+        return isinstance(self.writer, FountainWriter) and self.writer.complete
+
+    def close(self):
+        self.writer.flush()
+
     def status_stats(self):
         fmt_string = ('frames={s.framecount}, '
                       'fragments={s.fragments_ok}/{s.fragments_total} '
@@ -101,6 +366,17 @@ class DecodeCallback(object):
         print fmt.format(s=self, nbytes=nbytes, duration=duration)
         print 'Data rate: {}, frame rate: {:3.1f} frames/s'.format(datarate,
                                                                    framerate)
+        writer = self.writer
+        if writer.nfragments > 0:
+            print ('Wrote {} in {} writes, dropped {} duplicate fragments '
+                   '({:.1f}%)').format(util.sizeof_fmt(writer.nbytes),
+                                       writer.nwrites, writer.nduplicates,
+                                       100. * writer.nduplicates /
+                                       writer.nfragments)
+        if isinstance(writer, FountainWriter) and not writer.complete:
+            decoder = writer.decoder
+            print 'Fountain decoding incomplete: {}/{} source symbols'.format(
+                decoder.nknown if decoder.nsource else 0, decoder.nsource)
         if len(self.status_count) > 0:
             print 'Status:',
             print ', '.join('{}={}'.format(key, value)
@@ -113,23 +389,67 @@ class DecodeCallback(object):
 @click.option('--nsubchannels', type=int, required=True)
 @click.option('--nprocesses', type=int, default=6)
 @click.option('--nframes-per-process', type=int, default=20)
+@click.option('--nextractors', type=int, default=0)
 @click.option('--receiver-args', type=str, default='')
+@click.option('--tiles', type=str, default='1x1')
+@click.option('--color', is_flag=True)
 @click.option('--video-start', type=float, default=0.0)
 @click.option('--video-duration', type=float)
+@click.option('--dedup-window', type=int, default=0,
+              help='Drop fragments repeated on a subchannel within this '
+                   'many distinct fragments.')
+@click.option('--framed', is_flag=True)
+@click.option('--fountain', 'use_fountain', is_flag=True)
+@click.option('--shards', type=int, default=0)
+@click.option('--profile', is_flag=True)
+@click.option('--trace', type=str)
 def rx(filename, resolution, nsubchannels, nprocesses, nframes_per_process,
-       receiver_args, video_start, video_duration):
+       nextractors, receiver_args, tiles, color, video_start, video_duration,
+       dedup_window, framed, use_fountain, shards, profile, trace):
+    '''Decode a video. With --tiles COLUMNSxROWS, each frame shows that
+    many codes of --nsubchannels subchannels each (see focus.tiling). With
+    --color, each frame shows a code in each color plane (see focus.color);
+    pass a cross-talk matrix as crosstalk=[[...], ...] in --receiver-args.'''
+    if shards > 0 and (profile or trace):
+        # Shard workers run their own receivers, not MultiProcReceiver's
+        raise click.BadParameter('cannot be combined with --profile or '
+                                 '--trace.', param_hint='--shards')
     receiver_args = eval('dict({})'.format(receiver_args))
+    if tiling.parse_tiles(tiles) != (1, 1):
+        receiver_args['tiles'] = tiles
+    if color:
+        receiver_args['color'] = True
     resolution = util.parse_resolution(resolution)
 
     out = sys.stdout
     sys.stdout = sys.stderr
-    cb = DecodeCallback(out)
-    frames = video_frame_src(filename, resolution, video_start, video_duration)
+    cb = DecodeCallback(out, dedup_window, framed, use_fountain)
+    if shards > 0:
+        # Each worker decodes its own time range of the video
+        decode_shards(filename, resolution, nsubchannels, nprocesses, shards,
+                      video_start, video_duration, cb.callback, cb.done,
+                      receiver_args)
+        cb.close()
+        print
+        cb.final_stats()
+        return
+    if filename.endswith('.frames') or filename.endswith('.npy'):
+        # Replay frames from a frame store
+        frames = util.load_frames(filename)
+    else:
+        frames = video_frame_src(filename, resolution, video_start,
+                                 video_duration, grayscale=not color)
     recv = multiprocreceiver.MultiProcReceiver(nsubchannels, nprocesses,
                                                nframes_per_process,
                                                callback=cb.callback,
+                                               profile=profile, trace=trace,
+                                               nextractors=nextractors,
                                                **receiver_args)
-    recv.decode_many(frames)
+    # With fountain coding, stop as soon as the object is decoded.
+    recv.decode_many(frames, until=cb.done)
+    if hasattr(frames, 'close'):
+        frames.close()
+    cb.close()
     print
     cb.final_stats()
     recv.close()
@@ -150,7 +470,8 @@ def add_frame_number(tx_img, frame_no):
     return np.hstack((strip, tx_img, strip))
 
 
-def render(codes, fname, fps=30, height=1080, width=1920, video_fps=30):
+def render(codes, fname, fps=30, height=1080, width=1920, video_fps=30,
+           frame_numbers=True):
     # XXX There seems to be an issue with the first frame.
     if video_fps > 30:
         print 'WARNING: Video will not play on iPad.'
@@ -158,20 +479,34 @@ def render(codes, fname, fps=30, height=1080, width=1920, video_fps=30):
            '-f image2pipe -vcodec png -i - '
            '-pix_fmt yuv420p -r {} -c:v libx264 -crf 1 '
            '-profile:v high -level 4.1 '
-           '-vf pad=1920:1080:(ow-iw)/2:(oh-ih)/2:white '
-           '-y {}').format(fps, video_fps, fname)
+           '-vf pad={}:{}:(ow-iw)/2:(oh-ih)/2:white '
+           '-y {}').format(fps, video_fps, width, height, fname)
 
     ffmpeg = subprocess.Popen(cmd.split(), stdin=subprocess.PIPE)
     spinner = itertools.cycle('|/-\\')
 
     for frame_no, code in enumerate(codes):
-        code = add_frame_number(code, frame_no)
+        if isinstance(code, str):
+            # Already rendered to PNG, e.g., by focus.carousel
+            png = code
+            code_width, code_height = PIL.Image.open(io.BytesIO(png)).size
+        else:
+            if frame_numbers:
+                code = add_frame_number(code, frame_no)
+            png = None
+            code_height, code_width = code.shape[:2]
+        if code_height > height or code_width > width:
+            ffmpeg.stdin.close()
+            ffmpeg.wait()
+            raise ValueError('Frames of {}x{} do not fit into {}x{}.'.format(
+                code_width, code_height, width, height))
 
         # Render PNG and write to ffmpeg
-        pil_img = PIL.Image.fromarray(code)
-        pil_img.save(ffmpeg.stdin, format='png')
+        if png is None:
+            png = carousel.encode_png(code)
+        ffmpeg.stdin.write(png)
         if frame_no == 0:
-            pil_img.save(ffmpeg.stdin, format='png')
+            ffmpeg.stdin.write(png)
         print '\r{} txframe={}'.format(next(spinner), frame_no),
         sys.stdout.flush()
     print '\rCompleted.        '
@@ -181,19 +516,36 @@ def render(codes, fname, fps=30, height=1080, width=1920, video_fps=30):
         raise RuntimeError('ffmpeg failed.')
 
 
-def code_generator(transmitter, infile=sys.stdin):
-    nsubchannels = transmitter.nsubchannels
+def pad_fragments(fragments, nsubchannels):
+    '''Fill up an incomplete block of fragments by repeating it.'''
+    if len(fragments) == nsubchannels:
+        return fragments
+    padded = np.zeros((nsubchannels, 64), dtype=np.uint8)
+    for i in xrange(0, nsubchannels, len(fragments)):
+        j = min(i+len(fragments), nsubchannels)
+        padded[i:j] = fragments[:j-i]
+    return padded
+
+
+def file_blocks(infile, nsubchannels):
     while True:
         fragments = np.fromfile(infile, dtype=np.uint8, count=nsubchannels*64)
         fragments = fragments.reshape(-1, 64)
         if len(fragments) == 0:
             return
-        if len(fragments) != nsubchannels:
-            padded = np.zeros((nsubchannels, 64), dtype=np.uint8)
-            for i in xrange(0, nsubchannels, len(fragments)):
-                j = min(i+len(fragments), nsubchannels)
-                padded[i:j] = fragments[:j-i]
-            fragments = padded
+        yield pad_fragments(fragments, nsubchannels)
+
+
+def array_blocks(fragments, nsubchannels):
+    for i in xrange(0, len(fragments), nsubchannels):
+        # Copy, since Transmitter.encode() masks the fragments in-place.
+        yield pad_fragments(fragments[i:i+nsubchannels].copy(), nsubchannels)
+
+
+def code_generator(transmitter, infile=sys.stdin, blocks=None):
+    if blocks is None:
+        blocks = file_blocks(infile, transmitter.nsubchannels)
+    for fragments in blocks:
         yield transmitter.encode(fragments)
 
 
@@ -202,11 +554,57 @@ def code_generator(transmitter, infile=sys.stdin):
 @click.option('--transmitter-args', type=str, default='')
 @click.option('--txrate', type=int, default=15)
 @click.option('--nsubchannels', type=int, required=True)
+@click.option('--tiles', type=str, default='1x1')
+@click.option('--color', is_flag=True)
 @click.option('--video-fps', type=int, default=30)
-def tx(filename, transmitter_args, txrate, nsubchannels, video_fps):
+@click.option('--fountain', 'use_fountain', is_flag=True)
+@click.option('--fountain-overhead', type=float, default=1.0)
+@click.option('--loops', type=int, default=1)
+@click.option('--duration', type=float)
+@click.option('--cache-size', type=int, default=256)
+@click.option('--cache-file', type=str)
+def tx(filename, transmitter_args, txrate, nsubchannels, tiles, color,
+       video_fps, use_fountain, fountain_overhead, loops, duration,
+       cache_size, cache_file):
+    '''Encode stdin into a video.
+
+    With --loops or --duration (in seconds), the payload is repeated, and
+    each distinct code is encoded only once. Up to --cache-size MiB of codes
+    are kept in memory, more are spilled to --cache-file.
+
+    With --tiles COLUMNSxROWS, each frame shows that many codes of
+    --nsubchannels subchannels each, side by side. With --color, each frame
+    shows a code of --nsubchannels subchannels in each color plane.'''
     transmitter_args = eval('dict({})'.format(transmitter_args))
-    trans = transmitter.Transmitter(nsubchannels, **transmitter_args)
-    render(code_generator(trans), filename, fps=txrate, video_fps=video_fps)
+    tiled = tiling.parse_tiles(tiles) != (1, 1)
+    if tiled:
+        # Tiles fill the whole display, so leave out the frame numbers
+        transmitter_args.setdefault('size', (1080, 1920))
+    trans = tiling.get_transmitter(nsubchannels, tiles, color,
+                                   **transmitter_args)
+    nsubchannels = trans.nsubchannels
+    if use_fountain:
+        encoder = fountain.Encoder(sys.stdin.read())
+        fragments = encoder.fragments(int(np.ceil(encoder.nsource *
+                                                  fountain_overhead)))
+        blocks = array_blocks(fragments, nsubchannels)
+    else:
+        blocks = file_blocks(sys.stdin, nsubchannels)
+    if loops == 1 and duration is None:
+        render(code_generator(trans, blocks=blocks), filename, fps=txrate,
+               video_fps=video_fps, frame_numbers=not tiled)
+        return
+    cache = carousel.FrameCache(cache_size << 20, spill_file=cache_file)
+    nframes = None if duration is None else int(round(duration * txrate))
+    try:
+        # Codes come PNG-encoded, with frame numbers counted within a loop
+        decorate = None if tiled else add_frame_number
+        render(carousel.carousel(trans, blocks, loops, nframes, cache,
+                                 decorate),
+               filename, fps=txrate, video_fps=video_fps)
+    finally:
+        cache.close()
+    print 'Encoded {} codes, replayed {}.'.format(cache.nmisses, cache.nhits)
 
 
 @click.command('multirate')